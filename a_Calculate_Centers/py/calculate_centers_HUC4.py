@@ -0,0 +1,343 @@
+"""Vectorized Python engine for the HUC4 POI calculation in
+a_Calculate_Centers/src/calculate_centers_HUC4.R, run over HUC4s in a process
+pool. Import with reticulate::import_from_path() (not source_python), so that
+the worker function can be pickled to the pool's processes.
+"""
+
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import pandas as pd
+import shapely
+from pyproj import Transformer
+from nhd_cache import (archive_path, cached_waterbodies, clean_geometries, read_geoparquet,
+  read_waterbody_layer, resolve_source)
+
+
+# ftypes of interest. 390 = lake/pond; 436 = res; 361 = playa
+ftypes = (390, 436, 361)
+# minimum area, 1 hectare (0.01 km^2)
+min_area_sqkm = 0.01
+# attributes that are summarised per Permanent_Identifier
+summary_columns = ["GNIS_ID", "GNIS_Name", "REACHCODE", "FTYPE", "FCODE", "COMID", "VPUID"]
+# tolerance of the POI in meters, as polylabelr::poi(precision = 0.01)
+poi_tolerance = 0.01
+
+
+def load_waterbodies(layer_file):
+  """Load a cached waterbody layer, splitting off the multisurface waterbodies
+  that shapely (like {sf}) can't parse
+
+  Args:
+      layer_file: file path of a GeoParquet layer from nhd_cache.cached_waterbodies
+
+  Returns:
+      tuple of (DataFrame of attributes, array of shapely geometries, DataFrame
+      of the attributes of dropped multisurface waterbodies, CRS string)
+  """
+  attrs, wkb, crs = read_geoparquet(layer_file)
+  geoms = shapely.from_wkb(wkb, on_invalid = "ignore")
+  dropped = shapely.is_missing(geoms)
+  return (attrs[~dropped].reset_index(drop = True), geoms[~dropped],
+    attrs[dropped].reset_index(drop = True), crs)
+
+
+def _to_string(values):
+  """Collapse unique values to one string, like toString(unique(.)) in R"""
+  out = []
+  for v in pd.unique(values):
+    if isinstance(v, float) and v.is_integer():
+      v = int(v)
+    out.append("NA" if pd.isna(v) else str(v))
+  return ", ".join(out)
+
+
+def calculate_poi(geoms, crs):
+  """Calculate the pole of inaccessibility of every polygon, in the UTM zone of
+  the mean of each polygon's vertices, as in calculate_centers_HUC4.R
+
+  Args:
+      geoms: array of valid shapely (multi)polygons
+      crs: CRS of geoms (e.g. "EPSG:4269")
+
+  Returns:
+      tuple of arrays (poi_Longitude, poi_Latitude, poi_dist_m), with the POI in
+      WGS84 decimal degrees and the distance to shore in meters
+  """
+  n = len(geoms)
+  coords, index = shapely.get_coordinates(geoms, return_index = True)
+  n_coords = np.bincount(index, minlength = n)
+  mean_x = np.bincount(index, coords[:, 0], n) / n_coords
+  mean_y = np.bincount(index, coords[:, 1], n) / n_coords
+  # EPSG prefix 326 for N hemisphere, 327 for S hemisphere
+  utm_epsg = (np.where(mean_y >= 0, 32600, 32700)
+    + np.ceil((mean_x + 180) / 6).astype(int))
+
+  lon = np.full(n, np.nan)
+  lat = np.full(n, np.nan)
+  dist = np.full(n, np.nan)
+  to_wgs84 = Transformer.from_crs(crs, "EPSG:4326", always_xy = True)
+  for epsg in np.unique(utm_epsg):
+    zone = np.flatnonzero(utm_epsg == epsg)
+    to_utm = Transformer.from_crs(crs, "EPSG:" + str(epsg), always_xy = True)
+    utm = shapely.transform(geoms[zone],
+      lambda c: np.column_stack(to_utm.transform(c[:, 0], c[:, 1])))
+    # the maximum inscribed circle is the POI; the circle is returned as a line
+    # from its center to the nearest point on the shore
+    circles = shapely.maximum_inscribed_circle(utm, tolerance = poi_tolerance)
+    centers = shapely.get_coordinates(shapely.get_point(circles, 0))
+    dist[zone] = shapely.length(circles)
+    from_utm = Transformer.from_crs("EPSG:" + str(epsg), "EPSG:4326", always_xy = True)
+    x, y = from_utm.transform(centers[:, 0], centers[:, 1])
+    # the R workflow treats these WGS84 coordinates as the source CRS and
+    # transforms them again, keep that step so the outputs match
+    lon[zone], lat[zone] = to_wgs84.transform(x, y)
+  return lon, lat, dist
+
+
+def centers_for_waterbodies(attrs, geoms, crs):
+  """Calculate POI per waterbody and summarise per Permanent_Identifier, giving
+  the same columns as the R workflow's poi_centers_huc4_*.csv files
+
+  Args:
+      attrs: DataFrame of waterbody attributes
+      geoms: array of valid shapely geometries (see nhd_cache.clean_geometries),
+      one per row of attrs
+      crs: CRS of geoms
+
+  Returns:
+      DataFrame with one row per Permanent_Identifier
+  """
+  keep = ~shapely.is_empty(geoms)
+  attrs = attrs[keep].reset_index(drop = True)
+  geoms = geoms[keep]
+  attrs.insert(0, "rowid", np.arange(1, len(attrs) + 1))
+  lon, lat, dist = calculate_poi(geoms, crs)
+  poi_df = pd.DataFrame({"rowid": attrs["rowid"],
+    "Permanent_Identifier": attrs["Permanent_Identifier"].astype(str),
+    "poi_dist_m": dist,
+    "poi_Longitude": lon,
+    "poi_Latitude": lat})
+  # sometimes there is more than one geometry per PermId, keep the one that is
+  # the furthest distance from a shoreline
+  poi_df = (poi_df
+    .sort_values(["Permanent_Identifier", "poi_dist_m"], ascending = [True, False], kind = "stable")
+    .drop_duplicates("Permanent_Identifier"))
+  # aggregate the attributes if there are multiple features for any PermID
+  grouped = attrs.assign(Permanent_Identifier = attrs["Permanent_Identifier"].astype(str)).groupby("Permanent_Identifier", sort = True)
+  wbd_df = pd.DataFrame({"AreaSqKM": grouped["AreaSqKM"].sum(), "n_feat": grouped.size()})
+  for column in summary_columns:
+    wbd_df[column] = grouped[column].agg(_to_string)
+  wbd_df = wbd_df.reset_index()
+  out = wbd_df.merge(poi_df, on = "Permanent_Identifier", how = "right")
+  out["location_type"] = "poi_center"
+  return out[["Permanent_Identifier", "AreaSqKM", "n_feat"] + summary_columns
+    + ["rowid", "poi_dist_m", "location_type", "poi_Longitude", "poi_Latitude"]]
+
+
+def calculate_centers_HUC4_py(HUC4, out_dir = "a_Calculate_Centers/mid_py/",
+  multisurface_dir = "a_Calculate_Centers/multisurface/"):
+  """Get the waterbodies of one HUC4 from the NHDPlusHR cache, calculate the POI
+  of each waterbody and write it to a huc4= partition of out_dir. This is the
+  process pool's worker.
+
+  Args:
+      HUC4: text string; 4-digit huc from NHDPlus
+      out_dir: directory of the partitioned output
+      multisurface_dir: directory to save dropped multisurface waterbodies to
+
+  Returns:
+      tuple of (HUC4, number of waterbodies, seconds), with None as the number of
+      waterbodies if the NHDPlusHR for the HUC4 is empty
+  """
+  t0 = time.perf_counter()
+  layer_file = cached_waterbodies(HUC4, ftypes, min_area_sqkm)
+  if layer_file is None:
+    return HUC4, None, time.perf_counter() - t0
+  attrs, geoms, dropped, crs = load_waterbodies(layer_file)
+  if len(dropped) > 0:
+    os.makedirs(multisurface_dir, exist_ok = True)
+    dropped.to_csv(os.path.join(multisurface_dir, "dropped_multisurface_" + HUC4 + ".csv"), index = False)
+  if len(attrs) == 0:
+    return HUC4, 0, time.perf_counter() - t0
+  centers = centers_for_waterbodies(attrs, geoms, crs)
+  part_dir = os.path.join(out_dir, "huc4=" + HUC4)
+  os.makedirs(part_dir, exist_ok = True)
+  centers.to_parquet(os.path.join(part_dir, "part-0.parquet"), index = False)
+  return HUC4, len(centers), time.perf_counter() - t0
+
+
+def calculate_centers_HUC4s(HUC4_list, n_workers = None,
+  out_dir = "a_Calculate_Centers/mid_py/",
+  empty_file = "a_Calculate_Centers/out/empty_hucs.txt"):
+  """Run calculate_centers_HUC4_py over HUC4s in a process pool
+
+  Args:
+      HUC4_list: list of 4-digit hucs
+      n_workers: number of processes, defaults to the number of CPUs
+      out_dir: directory of the partitioned output (one huc4= folder per HUC4)
+      empty_file: text file that empty HUC4s are added to, as in the R workflow
+
+  Returns:
+      out_dir. Silently writes the partitioned output and a run log
+  """
+  # spawn (not fork) so this is safe to run from reticulate, which also means
+  # the workers need the python executable rather than R
+  context = multiprocessing.get_context("spawn")
+  # workers import this module by name, so its folder must be on their path
+  module_dir = os.path.dirname(os.path.abspath(__file__))
+  if module_dir not in sys.path:
+    sys.path.insert(0, module_dir)
+  if not os.path.basename(sys.executable).startswith("python"):
+    context.set_executable(os.path.join(sys.exec_prefix, "bin", "python"))
+  results = []
+  with ProcessPoolExecutor(max_workers = n_workers, mp_context = context) as pool:
+    futures = [pool.submit(calculate_centers_HUC4_py, str(h), out_dir = out_dir) for h in HUC4_list]
+    for future in as_completed(futures):
+      results.append(future.result())
+  log = pd.DataFrame(results, columns = ["HUC4", "n_waterbodies", "seconds"]).sort_values("HUC4")
+  os.makedirs(out_dir, exist_ok = True)
+  log.to_csv(os.path.join(out_dir, "_run_log.csv"), index = False)
+  empty = log[log["n_waterbodies"].isna()]["HUC4"].tolist()
+  if empty:
+    with open(empty_file, "a") as file:
+      file.write(", ".join(empty) + "\n")
+  return out_dir
+
+
+def compare_poi_to_R(HUC4, py_dir = "a_Calculate_Centers/mid_py/", r_dir = "a_Calculate_Centers/mid/",
+  layer_file = None):
+  """Compare the Python POI for a HUC4 with the R output for the same HUC4.
+  Differences are expected for lakes with islands: polylabelr::poi() is given
+  all rings as one coordinate list, while the maximum inscribed circle
+  respects holes.
+
+  Args:
+      HUC4: text string; 4-digit huc from NHDPlus
+      py_dir: directory of the Python partitioned output
+      r_dir: directory of the R poi_centers_huc4_*.csv files
+      layer_file: optional file path of the cached GeoParquet layer of the HUC4
+      (see nhd_cache.cached_waterbodies), used to flag lakes with islands
+
+  Returns:
+      DataFrame with one row per Permanent_Identifier of the distance between
+      the two POI in meters and the difference in poi_dist_m, and if layer_file
+      is given, whether any feature of the waterbody has an island
+  """
+  py = pd.read_parquet(os.path.join(py_dir, "huc4=" + HUC4, "part-0.parquet"))
+  r = pd.read_csv(os.path.join(r_dir, "poi_centers_huc4_" + HUC4 + ".csv"),
+    dtype = {"Permanent_Identifier": str})
+  both = py.merge(r, on = "Permanent_Identifier", suffixes = ("_py", "_r"))
+  # haversine distance between the two points
+  lon1, lat1, lon2, lat2 = [np.radians(both[c]) for c in
+    ["poi_Longitude_py", "poi_Latitude_py", "poi_Longitude_r", "poi_Latitude_r"]]
+  a = (np.sin((lat2 - lat1) / 2) ** 2
+    + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2)
+  out = pd.DataFrame({"Permanent_Identifier": both["Permanent_Identifier"],
+    "poi_offset_m": 2 * 6371008.8 * np.arcsin(np.sqrt(a)),
+    "poi_dist_diff_m": both["poi_dist_m_py"] - both["poi_dist_m_r"],
+    "n_feat_equal": both["n_feat_py"] == both["n_feat_r"]})
+  if layer_file is not None:
+    attrs, geoms, dropped, crs = load_waterbodies(layer_file)
+    parts, index = shapely.get_parts(geoms, return_index = True)
+    holes = np.bincount(index, shapely.get_num_interior_rings(parts), len(geoms)) > 0
+    islands = pd.Series(holes).groupby(attrs["Permanent_Identifier"].astype(str)).any()
+    out["has_island"] = out["Permanent_Identifier"].map(islands).fillna(False).astype(bool)
+  return out
+
+
+def summarise_poi_comparison(comparison, pixel_m = 30):
+  """Summarise compare_poi_to_R per lake type (with or without islands)
+
+  Args:
+      comparison: DataFrame from compare_poi_to_R, with has_island
+      pixel_m: size of a Landsat pixel in meters
+
+  Returns:
+      DataFrame with one row per value of has_island of the number of lakes, the
+      median and 95th percentile POI offset, the share of lakes whose POI moved
+      by more than one pixel, and the median absolute difference in poi_dist_m
+  """
+  grouped = comparison.groupby("has_island")
+  return pd.DataFrame({"n_lakes": grouped.size(),
+    "median_offset_m": grouped["poi_offset_m"].median(),
+    "p95_offset_m": grouped["poi_offset_m"].quantile(0.95),
+    "share_offset_gt_pixel": grouped["poi_offset_m"].apply(lambda x: (x > pixel_m).mean()),
+    "median_abs_dist_diff_m": grouped["poi_dist_diff_m"].apply(lambda x: x.abs().median())
+    }).reset_index()
+
+
+def record_poi_comparison(HUC4, py_dir = "a_Calculate_Centers/mid_py/", r_dir = "a_Calculate_Centers/mid/",
+  out_dir = "a_Calculate_Centers/out/", n_reps = 3):
+  """Compare the two engines on a HUC4 that both have been run on, and time the
+  Python engine on the same HUC4, saving both summaries for the record
+
+  Args:
+      HUC4: text string; 4-digit huc from NHDPlus
+      py_dir: directory of the Python partitioned output
+      r_dir: directory of the R poi_centers_huc4_*.csv files
+      out_dir: directory to save poi_comparison_<HUC4>.csv and
+      poi_benchmark_<HUC4>.csv to
+      n_reps: number of times to repeat the timing
+
+  Returns:
+      tuple of the two file paths
+  """
+  layer_file = cached_waterbodies(HUC4, ftypes, min_area_sqkm, revalidate = False)
+  summary = summarise_poi_comparison(compare_poi_to_R(HUC4, py_dir, r_dir, layer_file))
+  zip_path = archive_path(resolve_source(HUC4, revalidate = False))
+  timing = benchmark_poi(zip_path, layer_file, n_reps = n_reps)
+  os.makedirs(out_dir, exist_ok = True)
+  out_files = (os.path.join(out_dir, "poi_comparison_" + HUC4 + ".csv"),
+    os.path.join(out_dir, "poi_benchmark_" + HUC4 + ".csv"))
+  summary.to_csv(out_files[0], index = False)
+  timing.to_csv(out_files[1], index = False)
+  return out_files
+
+
+def benchmark_poi(zip_path, layer_file, n_polygons = 10000, n_reps = 3):
+  """Time reading the waterbodies from an NHDPlusHR archive against reading them
+  from the cache, and the POI calculation per 10k polygons
+
+  Args:
+      zip_path: file path of a downloaded NHDPlusHR .zip archive
+      layer_file: file path of the cached GeoParquet layer of the same HUC4
+      n_polygons: number of waterbodies to use (repeated if the HUC4 has fewer)
+      n_reps: number of times to repeat the timing
+
+  Returns:
+      DataFrame of the median seconds of parsing and validating the archive,
+      of loading the cached layer (both per HUC4), and of the POI calculation
+      per 10,000 polygons
+  """
+  def time_it(fun):
+    times = []
+    for i in range(n_reps):
+      t0 = time.perf_counter()
+      fun()
+      times.append(time.perf_counter() - t0)
+    return np.median(times)
+
+  def parse_archive():
+    attrs, wkb, crs = read_waterbody_layer(zip_path, ftypes, min_area_sqkm)
+    geoms = shapely.from_wkb(wkb, on_invalid = "ignore")
+    clean_geometries(geoms[~shapely.is_missing(geoms)])
+
+  parse_s = time_it(parse_archive)
+  load_s = time_it(lambda: load_waterbodies(layer_file))
+  attrs, geoms, dropped, crs = load_waterbodies(layer_file)
+  index = np.resize(np.arange(len(attrs)), n_polygons)
+  attrs = attrs.iloc[index].reset_index(drop = True)
+  geoms = geoms[index]
+  poi_s = time_it(lambda: centers_for_waterbodies(attrs, geoms, crs))
+  return pd.DataFrame({"step": ["parse archive (per HUC4)", "load cache (per HUC4)",
+      "poi (per 10k polygons)"],
+    "seconds": [parse_s, load_s, poi_s * 10000 / n_polygons]})
+
+
+if __name__ == "__main__":
+  # usage: python calculate_centers_HUC4.py 0101 0102 ...
+  calculate_centers_HUC4s(sys.argv[1:])
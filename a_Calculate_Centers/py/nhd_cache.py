@@ -0,0 +1,377 @@
+"""Content-addressed local cache of NHDPlusHR HUC4 archives and of the filtered,
+validated NHDWaterbody layer as GeoParquet.
+
+Layout of the cache directory:
+    sources/<HUC4>.json          url, ETag and sha256 of the last download
+    archives/<sha256>.zip        raw NHDPlusHR archives, keyed by their checksum
+    waterbodies/<key>.parquet    filtered waterbodies, keyed by the archive
+                                 checksum and the filter parameters
+
+Files are written to a temporary name and renamed, so HUC4s can be cached from
+several processes at once. The total size is bounded by evicting the least
+recently used files.
+"""
+
+import hashlib
+import json
+import os
+import urllib.error
+import urllib.request
+import zipfile
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyogrio.raw
+import shapely
+from pyproj import CRS
+
+
+nhdplushr_url = "https://prd-tnm.s3.amazonaws.com/StagedProducts/Hydrography/NHDPlusHR/Beta/GDB/NHDPLUS_H_{}_HU4_GDB.zip"
+cache_dir = "a_Calculate_Centers/cache/"
+# 20 GB, about the size of 40 NHDPlusHR archives and their waterbodies
+cache_max_bytes = 20 * 1024 ** 3
+# increment when the cached waterbody layer changes, so old entries are not used
+layer_version = 1
+# seconds to wait on the National Map, as options(timeout = 60000) in R
+download_timeout = 60000
+
+
+def _write_atomic(path, write):
+  """Write a file to a temporary name and rename it into place
+
+  Args:
+      path: file path to write
+      write: function taking the temporary file path
+  """
+  os.makedirs(os.path.dirname(path), exist_ok = True)
+  tmp = path + ".tmp" + str(os.getpid())
+  try:
+    write(tmp)
+    os.replace(tmp, path)
+  finally:
+    if os.path.exists(tmp):
+      os.remove(tmp)
+
+
+def _touch(path):
+  """Mark a cached file as used, for LRU eviction"""
+  os.utime(path, None)
+
+
+def source_etag(HUC4):
+  """Get the ETag of the NHDPlusHR archive of a HUC4 without downloading it
+
+  Args:
+      HUC4: text string; 4-digit huc from NHDPlus
+
+  Returns:
+      ETag string, or None if there is no NHDPlusHR for the HUC4
+  """
+  request = urllib.request.Request(nhdplushr_url.format(HUC4), method = "HEAD")
+  try:
+    with urllib.request.urlopen(request, timeout = 60) as response:
+      return response.headers.get("ETag")
+  except urllib.error.HTTPError as e:
+    # S3 answers 403 for keys that don't exist
+    if e.code in (403, 404):
+      return None
+    raise
+
+
+def download_archive(HUC4, cache_dir = cache_dir):
+  """Download the NHDPlusHR archive of a HUC4 into the cache, computing its
+  checksum while it streams
+
+  Args:
+      HUC4: text string; 4-digit huc from NHDPlus
+      cache_dir: directory of the cache
+
+  Returns:
+      tuple of (sha256, ETag), or (None, None) if there is no NHDPlusHR for the
+      HUC4
+  """
+  try:
+    response = urllib.request.urlopen(nhdplushr_url.format(HUC4), timeout = download_timeout)
+  except urllib.error.HTTPError as e:
+    if e.code in (403, 404):
+      return None, None
+    raise
+  archive_dir = os.path.join(cache_dir, "archives")
+  os.makedirs(archive_dir, exist_ok = True)
+  tmp = os.path.join(archive_dir, HUC4 + ".zip.tmp" + str(os.getpid()))
+  sha = hashlib.sha256()
+  try:
+    with response, open(tmp, "wb") as file:
+      for chunk in iter(lambda: response.read(1024 * 1024), b""):
+        sha.update(chunk)
+        file.write(chunk)
+    os.replace(tmp, os.path.join(archive_dir, sha.hexdigest() + ".zip"))
+  finally:
+    if os.path.exists(tmp):
+      os.remove(tmp)
+  return sha.hexdigest(), response.headers.get("ETag")
+
+
+def resolve_source(HUC4, cache_dir = cache_dir, revalidate = True):
+  """Get the checksum of the current NHDPlusHR archive of a HUC4, downloading
+  it only if the source has changed since it was cached
+
+  Args:
+      HUC4: text string; 4-digit huc from NHDPlus
+      cache_dir: directory of the cache
+      revalidate: check the source ETag against the cached one; if False (or the
+      National Map can't be reached) the cached source is trusted
+
+  Returns:
+      sha256 of the archive, or None if there is no NHDPlusHR for the HUC4
+  """
+  record_file = os.path.join(cache_dir, "sources", HUC4 + ".json")
+  record = None
+  if os.path.exists(record_file):
+    with open(record_file, "r") as file:
+      record = json.load(file)
+  if record is not None:
+    if not revalidate:
+      return record["sha256"]
+    try:
+      if source_etag(HUC4) == record["etag"]:
+        return record["sha256"]
+    except urllib.error.URLError:
+      return record["sha256"]
+
+  sha, etag = download_archive(HUC4, cache_dir)
+  record = {"url": nhdplushr_url.format(HUC4), "etag": etag, "sha256": sha}
+  def write(tmp):
+    with open(tmp, "w") as file:
+      json.dump(record, file, indent = 2)
+  _write_atomic(record_file, write)
+  return sha
+
+
+def archive_path(sha, cache_dir = cache_dir):
+  """File path of a cached archive"""
+  return os.path.join(cache_dir, "archives", sha + ".zip")
+
+
+def waterbody_key(sha, ftypes, min_area_sqkm):
+  """Key of a cached waterbody layer: the archive checksum and filter parameters
+
+  Args:
+      sha: sha256 of the NHDPlusHR archive
+      ftypes: FTYPE values kept
+      min_area_sqkm: minimum AreaSqKM kept
+
+  Returns:
+      sha256 hex digest of the key
+  """
+  key = {"archive": sha,
+    "ftypes": sorted(int(f) for f in ftypes),
+    "min_area_sqkm": float(min_area_sqkm),
+    "layer_version": layer_version}
+  return hashlib.sha256(json.dumps(key, sort_keys = True).encode()).hexdigest()
+
+
+def read_waterbody_layer(zip_path, ftypes, min_area_sqkm):
+  """Read the NHDWaterbody layer of a NHDPlusHR archive, filtered to the ftypes
+  and area of interest. The filter is pushed down to GDAL, so other waterbodies
+  are never parsed.
+
+  Args:
+      zip_path: file path of a NHDPlusHR .zip archive
+      ftypes: FTYPE values to keep
+      min_area_sqkm: minimum AreaSqKM to keep
+
+  Returns:
+      tuple of (DataFrame of attributes, array of 2D WKB geometries, CRS string),
+      or None if the archive has no geodatabase
+  """
+  with zipfile.ZipFile(zip_path) as z:
+    gdb = sorted(set(n.split("/")[0] for n in z.namelist() if ".gdb" in n.split("/")[0]))
+  if not gdb:
+    return None
+  path = "/vsizip/" + os.path.abspath(zip_path) + "/" + gdb[0]
+  where = ("FTYPE IN (" + ", ".join(str(int(f)) for f in ftypes) + ") AND AreaSqKM >= "
+    + str(min_area_sqkm))
+  meta, _, wkb, field_data = pyogrio.raw.read(path, layer = "NHDWaterbody",
+    force_2d = True, where = where)
+  attrs = pd.DataFrame({name: values for name, values in zip(meta["fields"], field_data)})
+  return attrs, wkb, meta["crs"]
+
+
+def clean_geometries(geoms):
+  """Make geometries valid and dissolve each one into a single (multi)polygon,
+  like st_make_valid() %>% st_union(by_feature = TRUE)
+
+  Args:
+      geoms: array of shapely (multi)polygons
+
+  Returns:
+      array of valid shapely (multi)polygons
+  """
+  geoms = shapely.make_valid(geoms)
+  # make_valid can return collections with stray lines or points, keep only the
+  # polygonal parts of those
+  collection = np.flatnonzero(shapely.get_type_id(geoms) == 7)
+  if len(collection) > 0:
+    parts, index = shapely.get_parts(geoms[collection], return_index = True)
+    polygonal = np.isin(shapely.get_type_id(parts), [3, 6])
+    for i, geom_i in enumerate(collection):
+      geoms[geom_i] = shapely.union_all(parts[polygonal & (index == i)])
+  return geoms
+
+
+def validate_wkb(wkb):
+  """Validate the geometries of a layer, leaving geometries shapely can't parse
+  (multisurface curves) as their original WKB so they can be enumerated later
+
+  Args:
+      wkb: array of WKB geometries
+
+  Returns:
+      array of WKB geometries
+  """
+  geoms = shapely.from_wkb(wkb, on_invalid = "ignore")
+  parsed = ~shapely.is_missing(geoms)
+  out = np.array(wkb, dtype = object)
+  if parsed.any():
+    out[parsed] = shapely.to_wkb(clean_geometries(geoms[parsed]))
+  return out
+
+
+def write_geoparquet(attrs, wkb, crs, out_file):
+  """Write a layer to GeoParquet with the geometry in a "Shape" WKB column, as
+  the column is named in the NHDPlusHR
+
+  Args:
+      attrs: DataFrame of attributes
+      wkb: array of WKB geometries
+      crs: CRS of the geometries
+      out_file: file path of the .parquet file
+  """
+  table = pa.Table.from_pandas(attrs, preserve_index = False)
+  table = table.append_column("Shape", pa.array(list(wkb), type = pa.binary()))
+  geo = {"version": "1.0.0",
+    "primary_column": "Shape",
+    "columns": {"Shape": {"encoding": "WKB",
+      "geometry_types": [],
+      "crs": CRS.from_user_input(crs).to_json_dict()}}}
+  table = table.replace_schema_metadata(dict(table.schema.metadata or {},
+    geo = json.dumps(geo)))
+  _write_atomic(out_file, lambda tmp: pq.write_table(table, tmp))
+
+
+def read_geoparquet(file):
+  """Read a layer written by write_geoparquet
+
+  Args:
+      file: file path of the .parquet file
+
+  Returns:
+      tuple of (DataFrame of attributes, array of WKB geometries, CRS string)
+  """
+  table = pq.read_table(file)
+  geo = json.loads(table.schema.metadata[b"geo"])
+  column = geo["primary_column"]
+  crs = CRS.from_json_dict(geo["columns"][column]["crs"]).to_string()
+  wkb = np.array(table[column].to_pylist(), dtype = object)
+  attrs = table.drop([column]).to_pandas()
+  return attrs, wkb, crs
+
+
+def evict_cache(cache_dir = cache_dir, max_bytes = cache_max_bytes, keep = ()):
+  """Remove the least recently used archives and waterbody layers until the
+  cache is within max_bytes
+
+  Args:
+      cache_dir: directory of the cache
+      max_bytes: maximum total size of the cached files
+      keep: file paths not to remove (e.g. the entry just written)
+
+  Returns:
+      list of the file paths removed
+  """
+  entries = []
+  for sub in ["archives", "waterbodies"]:
+    sub_dir = os.path.join(cache_dir, sub)
+    if not os.path.exists(sub_dir):
+      continue
+    for entry in os.scandir(sub_dir):
+      if entry.is_file() and ".tmp" not in entry.name:
+        stat = entry.stat()
+        entries.append((stat.st_mtime, stat.st_size, entry.path))
+  total = sum(size for _, size, _ in entries)
+  keep = set(os.path.abspath(k) for k in keep)
+  removed = []
+  for _, size, path in sorted(entries):
+    if total <= max_bytes:
+      break
+    if os.path.abspath(path) in keep:
+      continue
+    try:
+      os.remove(path)
+    except FileNotFoundError:
+      # already evicted by another process
+      pass
+    total -= size
+    removed.append(path)
+  return removed
+
+
+def cached_waterbodies(HUC4, ftypes = (390, 436, 361), min_area_sqkm = 0.01,
+  cache_dir = cache_dir, max_bytes = cache_max_bytes, revalidate = True):
+  """Get the filtered, validated NHDWaterbody layer of a HUC4 from the cache,
+  downloading and parsing the NHDPlusHR only if it isn't cached for this
+  archive and these filter parameters
+
+  Args:
+      HUC4: text string; 4-digit huc from NHDPlus
+      ftypes: FTYPE values to keep
+      min_area_sqkm: minimum AreaSqKM to keep
+      cache_dir: directory of the cache
+      max_bytes: maximum total size of the cache
+      revalidate: check that the NHDPlusHR source hasn't changed
+
+  Returns:
+      file path of the GeoParquet layer, or None if there is no NHDPlusHR for
+      the HUC4
+  """
+  sha = resolve_source(HUC4, cache_dir, revalidate)
+  if sha is None:
+    return None
+  layer_file = os.path.join(cache_dir, "waterbodies",
+    waterbody_key(sha, ftypes, min_area_sqkm) + ".parquet")
+  if os.path.exists(layer_file):
+    _touch(layer_file)
+    return layer_file
+
+  zip_path = archive_path(sha, cache_dir)
+  if not os.path.exists(zip_path):
+    # the archive was evicted, download it again
+    try:
+      os.remove(os.path.join(cache_dir, "sources", HUC4 + ".json"))
+    except FileNotFoundError:
+      # already removed by another process
+      pass
+    return cached_waterbodies(HUC4, ftypes, min_area_sqkm, cache_dir, max_bytes, False)
+  _touch(zip_path)
+  layer = read_waterbody_layer(zip_path, ftypes, min_area_sqkm)
+  if layer is None:
+    return None
+  attrs, wkb, crs = layer
+  write_geoparquet(attrs, validate_wkb(wkb), crs, layer_file)
+  evict_cache(cache_dir, max_bytes, keep = [layer_file])
+  return layer_file
+
+
+def layer_crs(layer_file):
+  """Get the CRS of a cached waterbody layer, for reading the layer from R
+
+  Args:
+      layer_file: file path of a GeoParquet layer from cached_waterbodies
+
+  Returns:
+      CRS string (e.g. "EPSG:4269")
+  """
+  geo = json.loads(pq.read_schema(layer_file).metadata[b"geo"])
+  return CRS.from_json_dict(geo["columns"][geo["primary_column"]]["crs"]).to_string()
@@ -0,0 +1,160 @@
+import os
+from pandas import concat, read_csv, read_feather, read_parquet
+
+
+# Landsat C2 scene ids look like LC08_044034_20140318. After collections are
+# merged, GEE prefixes the image system:index with "1_", "2_", ... and after
+# reduceRegions().flatten() the site id is appended, so the exported
+# system:index of a site row looks like 1_2_LC08_044034_20140318_12345
+scene_index_pattern = r"^(?:\d+_)*(L[CETMO]0\d_\d{6}_\d{8})(?:_(.+))?$"
+
+
+def split_system_index(system_index):
+  """Split exported system:index values into the scene id and site id
+
+  Args:
+      system_index: pandas Series of system:index values from a site or
+      metadata export
+
+  Returns:
+      DataFrame with the columns "scene_id" and "site_id" (site_id is missing for
+      metadata rows)
+  """
+  parts = system_index.astype(str).str.extract(scene_index_pattern)
+  parts.columns = ["scene_id", "site_id"]
+  return parts
+
+
+def exported_files(kind, tiles, config = None):
+  """Locations of the exports of one kind, from the manifests of the tiles of a
+  run (see export_table). Drive exports can't be read from their location, so 
+  this is for the "local" and "gcs" sinks.
+
+  Args:
+      kind: "point", "polygon", "polycenter" or "metadata", as in the export
+      descriptions
+      tiles: list of WRS2 path-rows as 6-digit strings
+      config: validated config, see pull_config.py; read with read_config() if
+      not provided
+
+  Returns:
+      list of the locations of the exports of the current settings (the 
+      config_hash of the config), in the order they were exported. When an 
+      export was run again (a new _v<date> suffix), only the latest is listed.
+      Tiles without a manifest are skipped.
+  """
+  if config is None:
+    config = read_config()
+  if config["export_sink"] == "drive":
+    raise ValueError("Exports to Drive can't be read from the manifest, download them first")
+  if isinstance(tiles, str):
+    tiles = [tiles]
+  files = []
+  for tile in tiles:
+    try:
+      rows = read_csv(manifest_location({"tile": tile}, config), dtype = str)
+    except FileNotFoundError:
+      continue
+    rows = rows[(rows["config_hash"] == config["config_hash"])
+      & rows["description"].str.startswith(config["proj"] + "_" + kind + "_")]
+    # a tile that is run again exports again under a new date, keep the latest
+    stem = rows["description"].str.replace(r"_v\d{4}-\d{2}-\d{2}$", "", regex = True)
+    rows = rows[~stem.duplicated(keep = "last")]
+    # Cloud Storage exports are recorded by their prefix, without the extension
+    if config["export_sink"] == "gcs":
+      rows = rows.assign(location = rows["location"] + "." + rows["format"].str.lower())
+    files = files + list(rows["location"])
+  return files
+
+
+def collate_scene_metadata(metadata_files, out_file = "b_pull_Landsat_SRST_poi/out/scene_metadata.feather"):
+  """Collate per-tile metadata exports into one global scene table with one row
+  per scene, keyed by the scene's system:index without merge prefixes
+
+  Args:
+      metadata_files: list of metadata .csv/.parquet files from the exports
+      out_file: file path of the collated .feather file
+
+  Returns:
+      file path of the collated scene table. Silently saves the .feather file
+  """
+  tables = []
+  for file in metadata_files:
+    if file.endswith(".parquet"):
+      one_table = read_parquet(file)
+    else:
+      one_table = read_csv(file, dtype = str)
+    one_table["scene_id"] = split_system_index(one_table["system:index"])["scene_id"]
+    tables.append(one_table)
+  scenes = concat(tables, ignore_index = True)
+  # the same scene can be exported more than once (e.g. re-runs, or both the
+  # per-sensor and harmonized stacks), keep one row per scene
+  scenes = (scenes
+    .drop_duplicates(subset = "scene_id")
+    .sort_values("scene_id")
+    .reset_index(drop = True))
+  os.makedirs(os.path.dirname(out_file), exist_ok = True)
+  scenes.to_feather(out_file)
+  return out_file
+
+
+def join_scene_attributes(site_data, scene_table):
+  """Join scene-level attributes to site statistics
+
+  Args:
+      site_data: DataFrame of site exports with a system:index column
+      scene_table: DataFrame of the collated scene table, or the file path of
+      the .feather file written by collate_scene_metadata
+
+  Returns:
+      site_data with scene_id, site_id and the scene attributes added
+  """
+  if isinstance(scene_table, str):
+    scene_table = read_feather(scene_table)
+  keys = split_system_index(site_data["system:index"])
+  site_data = site_data.assign(scene_id = keys["scene_id"], site_id = keys["site_id"])
+  scene_table = scene_table.drop(columns = ["system:index"], errors = "ignore")
+  return site_data.merge(scene_table, on = "scene_id", how = "left")
+
+
+def merge_polygon_partials(polygon_files, out_file = "b_pull_Landsat_SRST_poi/out/polygon_summaries.feather"):
+  """Merge the partial statistics of the polygon extent into one row per lake,
+  overpass (WRS2 path and date) and DSWE setting. Parts of a lake that were 
+  reduced in adjacent scenes of the same path are combined without loss with
+  merge_shards: counts and sums of powers are added and minimums are taken, then
+  the mean, standard deviation, proportions (and in "mergeable" mode the 
+  kurtosis and approximate median) are calculated from the merged totals.
+
+  Args:
+      polygon_files: list of polygon .csv/.parquet files from the exports
+      out_file: file path of the merged .feather file
+
+  Returns:
+      file path of the merged polygon summaries. Silently saves the .feather file
+  """
+  tables = []
+  for file in polygon_files:
+    if file.endswith(".parquet"):
+      one_table = read_parquet(file)
+    else:
+      one_table = read_csv(file, dtype = {"system:index": str})
+    keys = split_system_index(one_table["system:index"])
+    one_table["site_id"] = keys["site_id"]
+    one_table["path"] = keys["scene_id"].str[5:8]
+    one_table["date"] = keys["scene_id"].str[-8:]
+    one_table["scene_id"] = keys["scene_id"]
+    one_table["DSWE"] = "DSWE3" if "_DSWE3_" in os.path.basename(file) else "DSWE1"
+    tables.append(one_table.drop(columns = ["system:index"]))
+  parts = concat(tables, ignore_index = True)
+
+  keys = ["site_id", "path", "date", "DSWE"]
+  # rows of each radius of a buffer_sweep are kept apart
+  if "buffer_m" in parts.columns:
+    keys = keys + ["buffer_m"]
+  merged = merge_shards(parts, keys).rename(columns = {"n_shards": "n_parts",
+    "mean_clouds": "prop_clouds", "mean_hillShadow": "prop_hillShadow"})
+  merged["scene_ids"] = (parts.groupby(keys, sort = True, dropna = False)["scene_id"]
+    .agg(lambda x: ", ".join(sorted(set(x)))).to_numpy())
+  os.makedirs(os.path.dirname(out_file), exist_ok = True)
+  merged.to_feather(out_file)
+  return out_file
@@ -0,0 +1,188 @@
+import ee
+import json
+import os
+from collections import Counter
+from pandas import DataFrame
+
+
+def get_task_expression(task):
+  """Grab the ee object that an ee.batch.Task will send to Earth Engine. The task
+  is not started, so this can be run for any tile/chunk without using quota.
+
+  Args:
+      task: ee.batch.Task created by ee.batch.Export.*, not yet started
+
+  Returns:
+      the ee.ComputedObject (or already-serialized expression) of the export
+  """
+  config = task.config
+  for key in ["expression", "element", "collection", "image"]:
+    if key in config:
+      return config[key]
+  raise ValueError("Could not find an expression in the task config for "
+    + str(config.get("description", "unnamed task")))
+
+
+def _node_children(node):
+  """List the value references and inline child nodes of a serialized ValueNode
+
+  Args:
+      node: dictionary of a single ValueNode from ee.serializer.encode
+
+  Returns:
+      tuple of (list of referenced value ids, list of inline child nodes)
+  """
+  refs = []
+  children = []
+  if "valueReference" in node:
+    refs.append(node["valueReference"])
+  elif "arrayValue" in node:
+    children.extend(node["arrayValue"].get("values", []))
+  elif "dictionaryValue" in node:
+    children.extend(node["dictionaryValue"].get("values", {}).values())
+  elif "functionDefinitionValue" in node:
+    refs.append(node["functionDefinitionValue"]["body"])
+  elif "functionInvocationValue" in node:
+    invocation = node["functionInvocationValue"]
+    if "functionReference" in invocation:
+      refs.append(invocation["functionReference"])
+    children.extend(invocation.get("arguments", {}).values())
+  return refs, children
+
+
+def _local_profile(node):
+  """Count the function invocations held inline in a ValueNode, and the value
+  ids it references
+
+  Args:
+      node: dictionary of a single ValueNode from ee.serializer.encode
+
+  Returns:
+      tuple of (Counter of functionName, Counter of referenced value ids)
+  """
+  functions = Counter()
+  refs = Counter()
+  stack = [node]
+  while stack:
+    one_node = stack.pop()
+    if "functionInvocationValue" in one_node:
+      invocation = one_node["functionInvocationValue"]
+      functions[invocation.get("functionName", "<function reference>")] += 1
+    node_refs, children = _node_children(one_node)
+    refs.update(node_refs)
+    stack.extend(children)
+  return functions, refs
+
+
+def profile_ee_request(expression):
+  """Serialize an ee object exactly as it would be sent with an export request
+  and summarize the size of the expression graph
+
+  Args:
+      expression: ee.ComputedObject (or the dictionary returned by
+      ee.serializer.encode) to profile
+
+  Returns:
+      dictionary with the total request size in bytes ("bytes"), the number of
+      unique nodes sent ("unique_nodes"), the number of nodes the server expands
+      the graph to ("expanded_nodes"), per-function counts ("functions", a
+      DataFrame) and the subgraphs that are referenced more than once
+      ("repeated", a DataFrame)
+  """
+  if isinstance(expression, ee.ComputedObject):
+    encoded = ee.serializer.encode(expression, for_cloud_api = True)
+  else:
+    encoded = expression
+  values = encoded["values"]
+  local = {v_id: _local_profile(node) for v_id, node in values.items()}
+
+  # unique counts are what is sent over the wire, the compact encoding already
+  # de-duplicates identical subgraphs into the values table
+  unique_funs = Counter()
+  n_refs = Counter()
+  for functions, refs in local.values():
+    unique_funs.update(functions)
+    n_refs.update(refs)
+
+  # expanded counts are what the graph is worth once each reference is inlined,
+  # calculated bottom-up over the DAG so shared subgraphs are only walked once
+  expanded = {}
+  def expand(v_id):
+    if v_id not in expanded:
+      functions, refs = local[v_id]
+      total = Counter(functions)
+      for ref, n in refs.items():
+        for fun, count in expand(ref).items():
+          total[fun] += count * n
+      expanded[v_id] = total
+    return expanded[v_id]
+  expanded_funs = expand(encoded["result"])
+
+  functions = DataFrame(
+    [[fun, unique_funs[fun], expanded_funs[fun]] for fun in expanded_funs],
+    columns = ["function", "unique_count", "expanded_count"])
+  functions = functions.sort_values("expanded_count", ascending = False)
+
+  repeated = []
+  for v_id, n in n_refs.items():
+    if n > 1:
+      node = values[v_id]
+      top_fun = node.get("functionInvocationValue", {}).get("functionName",
+        list(node.keys())[0])
+      repeated.append([v_id, top_fun, n, sum(expand(v_id).values()),
+        len(json.dumps(node, separators = (",", ":")))])
+  repeated = DataFrame(repeated,
+    columns = ["value_id", "function", "n_references", "subgraph_nodes", "node_bytes"])
+  repeated = repeated.sort_values("n_references", ascending = False)
+
+  return {"bytes": len(json.dumps(encoded, separators = (",", ":"))),
+    "unique_nodes": sum(unique_funs.values()),
+    "expanded_nodes": sum(expanded_funs.values()),
+    "n_values": len(values),
+    "functions": functions,
+    "repeated": repeated}
+
+
+def write_graph_profile(profile, description, out_dir = "b_pull_Landsat_SRST_poi/out/graph_profiles/"):
+  """Save the per-function and repeated-subgraph tables of a graph profile and
+  append the totals to a summary file
+
+  Args:
+      profile: dictionary returned by profile_ee_request
+      description: name of the export task, used for file naming
+      out_dir: directory to save the profile files to
+
+  Returns:
+      None. Silently writes files to out_dir
+  """
+  os.makedirs(out_dir, exist_ok = True)
+  profile["functions"].to_csv(os.path.join(out_dir, description + "_functions.csv"), index = False)
+  profile["repeated"].to_csv(os.path.join(out_dir, description + "_repeated.csv"), index = False)
+  summary_file = os.path.join(out_dir, "graph_profile_summary.csv")
+  summary = DataFrame([[description, profile["bytes"], profile["unique_nodes"],
+    profile["expanded_nodes"], profile["n_values"]]],
+    columns = ["description", "bytes", "unique_nodes", "expanded_nodes", "n_values"])
+  summary.to_csv(summary_file, mode = "a", index = False,
+    header = not os.path.exists(summary_file))
+
+
+def check_graph_budget(profile, description, max_bytes, max_nodes):
+  """Fail if a profiled request is larger than the configured budgets
+
+  Args:
+      profile: dictionary returned by profile_ee_request
+      description: name of the export task, used in the error message
+      max_bytes: maximum size of the serialized request in bytes
+      max_nodes: maximum number of expanded nodes in the expression graph
+
+  Returns:
+      None. Raises a ValueError if either budget is exceeded
+  """
+  over = []
+  if profile["bytes"] > int(max_bytes):
+    over.append("request size " + str(profile["bytes"]) + " bytes > " + str(max_bytes))
+  if profile["expanded_nodes"] > int(max_nodes):
+    over.append("expanded nodes " + str(profile["expanded_nodes"]) + " > " + str(max_nodes))
+  if over:
+    raise ValueError("Expression graph budget exceeded for " + description + ": "
+      + "; ".join(over) + ". See b_pull_Landsat_SRST_poi/out/graph_profiles/ for details.")
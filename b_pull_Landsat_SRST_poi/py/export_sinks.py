@@ -0,0 +1,205 @@
+import ee
+import os
+from datetime import date
+from pandas import DataFrame, concat, read_csv
+
+
+def partition_prefix(partition):
+  """Create a predictable, hive-style prefix from a partition dictionary so that
+  exports can be found (and read as a dataset) by sensor and tile
+
+  Args:
+      partition: dictionary of partition keys and values, e.g.
+      {"sensor": "LS457", "tile": "035032"}; order is preserved
+
+  Returns:
+      string of the form "sensor=LS457/tile=035032/"
+  """
+  return "".join([str(k) + "=" + str(v) + "/" for k, v in partition.items()])
+
+
+def export_to_drive(collection, description, partition, selectors, file_format):
+  """Create a Google Drive table export. Drive does not have nested folders, so
+  the partition is only recorded in the manifest and the file name.
+
+  Args:
+      collection: ee.FeatureCollection to export
+      description: name of the export task and file
+      partition: dictionary of partition keys and values
+      selectors: list of columns to export, or None for all columns
+      file_format: export file format ("csv", "GeoJSON", "TFRecord", ...)
+
+  Returns:
+      tuple of (ee.batch.Task, location of the output)
+  """
+  task = ee.batch.Export.table.toDrive(collection = collection,
+    description = description,
+    folder = proj_folder,
+    fileFormat = file_format,
+    selectors = selectors)
+  return task, proj_folder + "/" + description
+
+
+def export_to_gcs(collection, description, partition, selectors, file_format):
+  """Create a Cloud Storage table export under a partitioned prefix in
+  export_bucket
+
+  Args:
+      collection: ee.FeatureCollection to export
+      description: name of the export task and file
+      partition: dictionary of partition keys and values
+      selectors: list of columns to export, or None for all columns
+      file_format: export file format ("csv", "GeoJSON", "TFRecord", ...)
+
+  Returns:
+      tuple of (ee.batch.Task, gs:// location of the output)
+  """
+  prefix = proj_folder + "/" + partition_prefix(partition) + description
+  task = ee.batch.Export.table.toCloudStorage(collection = collection,
+    description = description,
+    bucket = export_bucket,
+    fileNamePrefix = prefix,
+    fileFormat = file_format,
+    selectors = selectors)
+  return task, "gs://" + export_bucket + "/" + prefix
+
+
+def write_local_table(df, description, partition, selectors, file_format, out_root):
+  """Write a computed table to a partitioned path on a local (or fsspec-mounted
+  object store) file system
+
+  Args:
+      df: DataFrame of the table, with a "system:index" column
+      description: name of the output file
+      partition: dictionary of partition keys and values
+      selectors: list of columns to write, or None for all columns
+      file_format: "parquet" or "csv"
+      out_root: directory under which the partitions are written
+
+  Returns:
+      path of the output file, out_root/<partition_prefix>/<description>.<format>
+  """
+  if "geo" in df.columns:
+    df = df.drop(columns = "geo")
+  if selectors is not None:
+    df = df.reindex(columns = selectors)
+  out_dir = os.path.join(out_root, partition_prefix(partition))
+  os.makedirs(out_dir, exist_ok = True)
+  if file_format == "parquet":
+    out_file = os.path.join(out_dir, description + ".parquet")
+    df.to_parquet(out_file, index = False)
+  else:
+    out_file = os.path.join(out_dir, description + ".csv")
+    df.to_csv(out_file, index = False)
+  return out_file
+
+
+def export_to_local(collection, description, partition, selectors, file_format):
+  """Compute a table directly and write it with write_local_table under
+  export_path. This blocks until the table is computed, so it is intended for
+  testing and small runs - use "drive" or "gcs" for full tiles.
+
+  Args:
+      collection: ee.FeatureCollection to export
+      description: name of the output file
+      partition: dictionary of partition keys and values
+      selectors: list of columns to export, or None for all columns
+      file_format: "parquet" or "csv"
+
+  Returns:
+      tuple of (None, path of the output file)
+  """
+  # keep the feature id, which is otherwise dropped when converting to a table
+  collection = collection.map(lambda feature: feature.set("system_index", feature.id()))
+  df = ee.data.computeFeatures({"expression": collection,
+    "fileFormat": "PANDAS_DATAFRAME"})
+  df = df.rename(columns = {"system_index": "system:index"})
+  return None, write_local_table(df, description, partition, selectors, file_format,
+    os.path.join(export_path, proj_folder))
+
+
+export_sinks = {"drive": export_to_drive,
+  "gcs": export_to_gcs,
+  "local": export_to_local}
+
+
+def manifest_location(partition, config):
+  """Location of the sink-side manifest for one tile. Manifests are written per
+  tile so that branches running in parallel do not write to the same file.
+
+  Args:
+      partition: dictionary of partition keys and values, must contain "tile"
+      config: validated config, see pull_config.py
+
+  Returns:
+      path to the manifest .csv file
+  """
+  file_name = "manifest_" + str(partition["tile"]) + ".csv"
+  if config["export_sink"] == "gcs":
+    return "gs://" + config["export_bucket"] + "/" + config["proj_folder"] + "/_manifest/" + file_name
+  if config["export_sink"] == "local":
+    return os.path.join(config["export_path"], config["proj_folder"], "_manifest", file_name)
+  # Drive has no addressable paths, so the manifest is kept locally
+  return os.path.join("b_pull_Landsat_SRST_poi/out/export_manifest/", file_name)
+
+
+def export_table(collection, description, partition, selectors = None):
+  """Export a table to the configured export_sink and record it in the sink's
+  manifest
+
+  Args:
+      collection: ee.FeatureCollection to export
+      description: name of the export task and file
+      partition: dictionary of partition keys and values (e.g. sensor, tile)
+      selectors: list of columns to export, or None for all columns
+
+  Returns:
+      None. Starts the export task (or writes the file for the "local" sink) and
+      appends a row to the manifest.
+  """
+  if export_sink not in export_sinks:
+    raise ValueError("export_sink must be one of " + ", ".join(export_sinks.keys())
+      + ", not " + str(export_sink))
+  task, location = export_sinks[export_sink](collection, description, partition,
+    selectors, export_format)
+  if task is not None:
+    start_task(task, description)
+    # profiled-only tasks were never submitted, so don't record them
+    if graph_check == "only":
+      return
+  # the manifest is appended one row at a time, so anything recorded here has
+  # been submitted (or written) even if a later export in the tile fails
+  row = dict(partition)
+  row.update({"description": description,
+    "sink": export_sink,
+    "format": export_format,
+    "location": location,
+    "task_id": (task.id or "") if task is not None else "",
+    "config_hash": config["config_hash"],
+    "export_date": str(date.today())})
+  append_manifest(row, manifest_location(partition, config))
+
+
+def append_manifest(row, manifest):
+  """Append one export to a tile's manifest, creating it if needed
+
+  Args:
+      row: dictionary of the manifest columns of the export
+      manifest: path of the manifest .csv, see manifest_location
+
+  Returns:
+      path of the manifest
+  """
+  if not manifest.startswith("gs://"):
+    os.makedirs(os.path.dirname(manifest), exist_ok = True)
+    header = not os.path.exists(manifest)
+    DataFrame([row]).to_csv(manifest, mode = "a", index = False, header = header)
+  else:
+    # object stores can't be appended to, so read-modify-write the tile manifest
+    # (requires gcsfs)
+    try:
+      existing = read_csv(manifest)
+      concat([existing, DataFrame([row])]).to_csv(manifest, index = False)
+    except FileNotFoundError:
+      DataFrame([row]).to_csv(manifest, index = False)
+  return manifest
@@ -38,91 +38,75 @@ def apply_scale_factors(image):
   return image.addBands(opticalBands, None, True).addBands(thermalBands, None,True)
 
 
-def dp_buff(feature):
-  """ Buffer ee.FeatureCollection sites from csv_to_eeFeat by user-specified radius
+def filter_scene_clouds(collection, config):
+  """ Filter an ee.ImageCollection by scene-level cloud cover, if configured
 
   Args:
-      feature: ee.Feature of an ee.FeatureCollection
+      collection: ee.ImageCollection of Landsat scenes
+      config: validated config, see pull_config.py
 
   Returns:
-      ee.FeatureCollection of polygons resulting from buffered points
+      ee.ImageCollection of scenes with CLOUD_COVER less than cloud_thresh if
+      cloud_filter is True, otherwise the unaltered collection
   """
-  return feature.buffer(ee.Number.parse(str(buffer)))
-
+  if config["cloud_filter"]:
+    return collection.filter(ee.Filter.lt("CLOUD_COVER", ee.Number.parse(str(config["cloud_thresh"]))))
+  return collection
 
-def add_rad_mask(image):
-  """Mask out all pixels that are radiometrically saturated using the QA_RADSAT
-  QA band.
 
-  Args:
-      image: ee.Image of an ee.ImageCollection
-
-  Returns:
-      ee.Image with additional band called "radsat", where pixels with a value 
-      of 0 are saturated for at least one SR band and a value of 1 is not saturated
-  """
-  #grab the radsat band
-  satQA = image.select("radsat_qa")
-  # all must be non-saturated per pixel
-  satMask = satQA.eq(0).rename("radsat")
-  return image.addBands(satMask)
-
-
-def cf_mask(image):
-  """Masks any pixels obstructed by clouds and snow/ice
+def dp_buff(feature):
+  """ Buffer ee.FeatureCollection sites from csv_to_eeFeat by user-specified 
+  radius, the largest of site_buffers (see reduce_sites for the smaller ones)
 
   Args:
-      image: ee.Image of an ee.ImageCollection
+      feature: ee.Feature of an ee.FeatureCollection
 
   Returns:
-      ee.Image with additional band called "cfmask", where pixels are given values
-      based on the QA_PIXEL band informaiton. Generally speaking, 0 is clear, values 
-      greater than 0 are obstructed by clouds and/or snow/ice
+      ee.FeatureCollection of polygons resulting from buffered points
   """
-  #grab just the pixel_qa info
-  qa = image.select("pixel_qa")
-  cloudqa = (qa.bitwiseAnd(1 << 1).rename("cfmask") #dialated clouds value 1
-    .where(qa.bitwiseAnd(1 << 3), ee.Image(2)) # clouds value 2
-    .where(qa.bitwiseAnd(1 << 4), ee.Image(3)) # cloud shadows value 3
-    .where(qa.bitwiseAnd(1 << 5), ee.Image(4))) # snow value 4
-  return image.addBands(cloudqa)
+  return feature.buffer(ee.Number.parse(str(site_buffers[-1])))
 
 
-def sr_cloud_mask(image):
-  """Masks any pixles in Landsat 4-7 that are contaminated by the inputs of 
-  the atmospheric processing steps
+def decode_qa(image, qa_bands):
+  """Decode the QA bands of an image in one step into a packed "qa_flags" band
+  (see qa_decode.py for the bits), the "clear" mask (1 where the pixel is not
+  saturated, has no clouds, cloud shadow or snow and no SR processing 
+  artefacts) and the "clouds" class (1 where QA_PIXEL flags clouds, cloud 
+  shadow or snow). The aerosol flag of Landsat 8 and 9 is packed as well, see
+  scene_qa_layers.
 
   Args:
       image: ee.Image of an ee.ImageCollection
-
+      qa_bands: QA bands of the image, qa_bands_457, qa_bands_89 or 
+      qa_bands_harmonized
+      
   Returns:
-      ee.Image with additional band called "sr_cloud", where pixels are given values
-      based on the SR_CLOUD_QA band informaiton. Generally speaking, 0 is clear, values
-      greater than 0 are obstructed by clouds and/or snow/ice specifically from atmospheric
-      processing steps
+      ee.Image of the bands "qa_flags", "clear" and "clouds"
   """
-  srCloudQA = image.select("cloud_qa")
-  srMask = (srCloudQA.bitwiseAnd(1 << 1).rename("sr_cloud") # cloud
-    .where(srCloudQA.bitwiseAnd(1 << 2), ee.Image(2)) # cloud shadow
-    .where(srCloudQA.bitwiseAnd(1 << 3), ee.Image(3)) # adjacent to cloud
-    .where(srCloudQA.bitwiseAnd(1 << 4), ee.Image(4))) # snow/ice
-  return image.addBands(srMask)
-
-
-def sr_aerosol(image):
-  """Flags any pixels in Landsat 8 and 9 that have "medium" or "high" aerosol QA flags from the
-  SR_QA_AEROSOL band.
+  p = image.select("pixel_qa")
+  # QA_PIXEL bit 1 to bit 0 and bits 3-5 to bits 1-3
+  flags = p.rightShift(1).bitwiseAnd(1).bitwiseOr(p.rightShift(2).bitwiseAnd(14))
+  flags = flags.bitwiseOr(image.select("radsat_qa").neq(0).leftShift(4))
+  # the SR cloud and aerosol bands are empty for some sensors of the harmonized
+  # stack, where they don't flag anything
+  if "cloud_qa" in qa_bands:
+    flags = flags.bitwiseOr(image.select("cloud_qa").bitwiseAnd(30).neq(0).leftShift(5).unmask(0))
+  if "aerosol_qa" in qa_bands:
+    flags = flags.bitwiseOr(image.select("aerosol_qa").rightShift(7).bitwiseAnd(1).leftShift(6).unmask(0))
+  return qa_flag_bands(flags.toUint8().rename("qa_flags"))
+
+
+def qa_flag_bands(flags):
+  """Add the "clear" and "clouds" bands to a packed "qa_flags" band
 
   Args:
-      image: ee.Image of an ee.ImageCollection
-
+      flags: ee.Image of the qa_flags band from decode_qa
+      
   Returns:
-      ee.Image with additional band called "medHighAero", where pixels are given a value of 1
-      if the aerosol QA flag is medium or high and 0 otherwise
+      ee.Image of the bands "qa_flags", "clear" and "clouds"
   """
-  aerosolQA = image.select("aerosol_qa")
-  medHighAero = aerosolQA.bitwiseAnd(1 << 7).rename("medHighAero")# pull out mask out where aeorosol is med and high
-  return image.addBands(medHighAero)
+  return (flags.addBands(flags.bitwiseAnd(qa_clear_bits).eq(0).rename("clear"))
+    .addBands(flags.bitwiseAnd(qa_cloud_bits).neq(0).rename("clouds")))
 
 
 def Mndwi(image):
@@ -197,6 +181,22 @@ def Awesh(image):
 
 
 ## The DSWE Function itself    
+# These thresholds are taken from the LS Collection 2 DSWE Data Format Control 
+# Book. Inputs are meant to be scaled reflectance values. They are shared with 
+# the local replay of cached scene windows (see scene_windows.py)
+dswe_thresholds = {"mndwi": 0.124, # Wetness Index Threshold
+  "awesh": 0,
+  "pswt1_mndwi": -0.44, # Partial Surface Water 1 thresholds
+  "pswt1_swir1": 0.09, # 900 for no scaling (LS Collection 1)
+  "pswt1_nir": 0.15, # 1500 for no scaling (LS Collection 1)
+  "pswt1_ndvi": 0.7,
+  "pswt2_mndwi": -0.5, # Partial Surface Water 2 thresholds
+  "pswt2_blue": 0.1, # 1000 for no scaling (LS Collection 1)
+  "pswt2_swir1": 0.3, # 3000 for no scaling (LS Collection 1)
+  "pswt2_swir2": 0.1, # 1000 for no scaling (LS Collection 1)
+  "pswt2_nir": 0.25} # 2500 for no scaling (LS Collection 1)
+
+
 def DSWE(image):
   """calculate the dynamic surface water extent per pixel
   
@@ -215,20 +215,20 @@ def DSWE(image):
   ndvi = Ndvi(image)
   blue = image.select(["Blue"])
   swir2 = image.select(["Swir2"])
-  # These thresholds are taken from the LS Collection 2 DSWE Data Format Control Book
-  # Inputs are meant to be scaled reflectance values 
-  t1 = mndwi.gt(0.124) # MNDWI greater than Wetness Index Threshold
+  # thresholds from dswe_thresholds
+  th = dswe_thresholds
+  t1 = mndwi.gt(th["mndwi"]) # MNDWI greater than Wetness Index Threshold
   t2 = mbsrv.gt(mbsrn) # MBSRV greater than MBSRN
-  t3 = awesh.gt(0) #AWESH greater than 0
-  t4 = (mndwi.gt(-0.44)  #Partial Surface Water 1 thresholds
-   .And(swir1.lt(0.09)) #900 for no scaling (LS Collection 1)
-   .And(nir.lt(0.15)) #1500 for no scaling (LS Collection 1)
-   .And(ndvi.lt(0.7)))
-  t5 = (mndwi.gt(-0.5) #Partial Surface Water 2 thresholds
-   .And(blue.lt(0.1)) #1000 for no scaling (LS Collection 1)
-   .And(swir1.lt(0.3)) #3000 for no scaling (LS Collection 1)
-   .And(swir2.lt(0.1)) #1000 for no scaling (LS Collection 1)
-   .And(nir.lt(0.25))) #2500 for no scaling (LS Collection 1)
+  t3 = awesh.gt(th["awesh"]) #AWESH greater than 0
+  t4 = (mndwi.gt(th["pswt1_mndwi"])  #Partial Surface Water 1 thresholds
+   .And(swir1.lt(th["pswt1_swir1"]))
+   .And(nir.lt(th["pswt1_nir"]))
+   .And(ndvi.lt(th["pswt1_ndvi"])))
+  t5 = (mndwi.gt(th["pswt2_mndwi"]) #Partial Surface Water 2 thresholds
+   .And(blue.lt(th["pswt2_blue"]))
+   .And(swir1.lt(th["pswt2_swir1"]))
+   .And(swir2.lt(th["pswt2_swir2"]))
+   .And(nir.lt(th["pswt2_nir"])))
   t = (t1
     .add(t2.multiply(10))
     .add(t3.multiply(100))
@@ -313,6 +313,131 @@ def calc_hill_shadows(image, geo):
   return hillShadow
 
 
+def scene_qa_layers(image, geo, qa_bands, use_cache = True):
+  """ Per-scene masks and water class: the decoded QA (see decode_qa), DSWE, 
+  hill shadow and hill shade, and the aerosol flag when the image has an 
+  aerosol QA band. When a QA cache has been materialized for the tile 
+  (qa_cache, see qa_cache.py), the packed QA, DSWE and terrain layers are read 
+  from it instead of being recomputed by every location chunk.
+
+  Args:
+      image: ee.Image of an ee.ImageCollection
+      geo: ee.Geometry to calculate hill shade and shadow over
+      qa_bands: QA bands of the image, qa_bands_457, qa_bands_89 or 
+      qa_bands_harmonized
+      use_cache: if False, always compute the layers (e.g. for polygons, which
+      are outside of the cached site footprints)
+
+  Returns:
+      ee.Image of the uint8 bands "qa_flags", "clear", "clouds", "dswe", 
+      "hillShadow" and "hillShade", and "medHighAero" if qa_bands includes 
+      aerosol_qa
+  """
+  if use_cache and qa_cache is not None:
+    # the cache has one image per year, named y<year>
+    year = ee.Number(ee.Date(image.get("system:time_start")).get("year")).format("%d")
+    key = ee.String(image.get("LANDSAT_SCENE_ID"))
+    cached = ee.Image(qa_cache.filter(ee.Filter.eq("system:index", ee.String("y").cat(year))).first())
+    cached = cached.select(ee.List(qa_cache_bands).map(lambda b: key.cat("_").cat(b)), qa_cache_bands)
+    layers = qa_flag_bands(cached.select("qa_flags")).addBands(cached.select(["dswe", "hillShadow", "hillShade"]))
+  else:
+    d = DSWE(image).select("dswe")
+    hs = calc_hill_shadows(image, geo).select("hillShadow")
+    h = calc_hill_shades(image, geo).select("hillShade")
+    layers = decode_qa(image, qa_bands).addBands(d).addBands(hs).addBands(h).toUint8()
+  if "aerosol_qa" in qa_bands:
+    # medium or high aerosol from the packed flags (bit 6), masked where the 
+    # image has no aerosol QA (Landsat 4-7 in the harmonized stack) so that 
+    # those pixels aren't counted
+    layers = layers.addBands(layers.select("qa_flags").rightShift(6).bitwiseAnd(1)
+      .rename("medHighAero").updateMask(image.select("aerosol_qa").mask()))
+  return layers
+
+
+def sites_with_valid_pixels(mask, sites):
+  """ Cheap count-only pass to drop sites that have fewer than min_valid_pixels
+  valid pixels in an image, so that the full (median, kurtosis, ...) reducer 
+  only runs on sites where the statistics are meaningful
+
+  Args:
+      mask: ee.Image, self-masked band of the pixels that will be summarized
+      sites: ee.FeatureCollection of the buffered sites
+      
+  Returns:
+      ee.FeatureCollection of the sites with at least min_valid_pixels valid 
+      pixels, or all sites if min_valid_pixels is 0
+  """
+  if min_valid_pixels <= 0:
+    return sites
+  counts = mask.reduceRegions(sites, ee.Reducer.count().unweighted().setOutputs(["n_valid"]), 30)
+  return counts.filter(ee.Filter.gte("n_valid", min_valid_pixels))
+
+
+def reduce_sites(image, img_mask, reducer):
+  """ Summarize an image over the buffered sites in feat that have enough valid
+  pixels. When buffer_sweep adds radii to site_buffer, the sites are buffered by
+  the largest radius (see dp_buff) and each pixel is still read once: the 
+  reducer is repeated for each smaller radius on copies of the image masked to
+  the pixels within that distance of the site, and every site is split into 
+  one feature per radius with a "buffer_m" property. Features of the smaller 
+  radii are dropped if they have fewer than min_valid_pixels (or no) valid 
+  pixels.
+
+  The rings use the distance to the nearest site, so when two sites are closer
+  than the sum of two of the radii, the smaller radius of one site may include
+  pixels that are closer to the other site.
+
+  Args:
+      image: ee.Image to summarize, in the band order of the reducer's inputs
+      img_mask: ee.Image, self-masked band of the pixels that are summarized
+      reducer: ee.Reducer of the pull
+      
+  Returns:
+      ee.FeatureCollection of the summaries, with buffer_m if site_buffers has
+      more than one radius
+  """
+  sites = sites_with_valid_pixels(img_mask, feat)
+  if len(site_buffers) == 1:
+    return image.reduceRegions(sites, reducer, 30)
+  largest = site_buffers[-1]
+  points = feat.map(lambda f: ee.Feature(f.geometry().centroid(1)))
+  distance = ee.FeatureCollection(points).distance(largest + 30, 1)
+  stacked = image
+  combined = reducer
+  prefixes = ["b" + str(int(r)) + "_" for r in site_buffers[:-1]]
+  for r, prefix in zip(site_buffers[:-1], prefixes):
+    ring = distance.lte(r)
+    stacked = (stacked.addBands(image.updateMask(ring).regexpRename("^", prefix))
+      .addBands(img_mask.updateMask(ring).rename(prefix + "n_valid")))
+    combined = (combined.combine(reducer, outputPrefix = prefix, sharedInputs = False)
+      .combine(ee.Reducer.count().unweighted().setOutputs([prefix + "n_valid"]), sharedInputs = False))
+  outputs = reducer.getOutputs()
+  ring_names = outputs.add("n_valid")
+  swept = ring_names
+  for prefix in prefixes:
+    swept = swept.cat(ring_names.map(lambda p: ee.String(prefix).cat(p)))
+
+  def split(f):
+    # site properties (id, wrs, ...) are kept on every radius
+    keep = f.propertyNames().removeAll(swept)
+    rows = [f.select(keep.cat(outputs)).set("buffer_m", largest)]
+    for r, prefix in zip(site_buffers[:-1], prefixes):
+      rows.append(f.select(keep.cat(ring_names.map(lambda p: ee.String(prefix).cat(p))), 
+        keep.cat(ring_names)).set("buffer_m", r))
+    return ee.FeatureCollection(rows)
+
+  # flatten prefixes the index of each row with the site's, so the rows are 
+  # given the site id as their index again (the radii are told apart by 
+  # buffer_m), as the exports are keyed by <scene>_<site> (see 
+  # split_system_index)
+  return (stacked.reduceRegions(sites, combined, 30)
+    .map(split)
+    .flatten()
+    .map(lambda f: f.set("system:index", f.get("id")))
+    .filter(ee.Filter.Or(ee.Filter.eq("buffer_m", largest),
+      ee.Filter.gte("n_valid", max(min_valid_pixels, 1)))))
+
+
 ## Remove geometries
 def remove_geo(image):
   """ Funciton to remove the geometry from an ee.Image
@@ -326,169 +451,219 @@ def remove_geo(image):
   return image.setGeometry(None)
 
 
-## Set up the reflectance pull
-def ref_pull_457_DSWE1(image):
-  """ This function applies all functions to the Landsat 4-7 ee.ImageCollection, extracting
-  summary statistics for each geometry area where the DSWE value is 1 (high confidence water)
+## Mergeable statistics
+# bands with sufficient statistics in the "mergeable" statistics mode (see 
+# merge_stats.py); Landsat 4-7 site pulls have no aerosol band
+mergeable_bands = ["Aerosol", "Blue", "Green", "Red", "Nir", "Swir1", "Swir2", "SurfaceTemp"]
+mergeable_bands_457 = ["Blue", "Green", "Red", "Nir", "Swir1", "Swir2", "SurfaceTemp"]
+
+
+def sufficient_stats(image, bands, order = 4, sketch = True):
+  """ Bands and reducer of the sufficient statistics of a list of bands: the 
+  pixel count, the sums of the powers 1 to order of (value - shift) and a 
+  fixed-bin histogram of each band. The powers are taken in double precision,
+  and the shifts, bins and ranges are those of merge_stats.py, so the outputs
+  can be recombined with merge_shards.
 
   Args:
-      image: ee.Image of an ee.ImageCollection
+      image: ee.Image with the bands
+      bands: list of band names
+      order: highest power summed
+      sketch: if True, add the histogram of each band
+      
+  Returns:
+      tuple of the (unmasked) ee.Image of the statistics bands and the 
+      ee.Reducer for them, which outputs the columns of sufficient_stats_columns
+  """
+  x = image.select(bands).toDouble()
+  shifted = x.subtract(ee.Image.constant([moment_shifts.get(b, 0) for b in bands]))
+  stats = x.rename(["count_" + b for b in bands])
+  power_names = []
+  for k, prefix in enumerate(power_prefixes[:order]):
+    stats = stats.addBands(shifted.pow(k + 1).rename([prefix + b for b in bands]))
+    power_names = power_names + [prefix + b for b in bands]
+  reducer = (ee.Reducer.count().unweighted().forEachBand(stats.select(["count_" + b for b in bands]))
+    .combine(ee.Reducer.sum().unweighted().forEachBand(stats.select(power_names)), sharedInputs = False))
+  if sketch:
+    for b in bands:
+      lo, hi = sketch_ranges[b]
+      # clamp so that values outside of the range are counted in the end bins
+      stats = stats.addBands(x.select(b).clamp(lo, hi - (hi - lo) / sketch_bins / 2).rename("hist_" + b))
+      reducer = reducer.combine(ee.Reducer.fixedHistogram(lo, hi, sketch_bins).unweighted()
+        .forEachBand(stats.select(["hist_" + b])), sharedInputs = False)
+  return stats, reducer
+
+
+def encode_sketches(feature, bands):
+  """ Replace the fixedHistogram outputs of a feature (arrays of [bin start, 
+  count] rows) with comma-separated bin counts, so that they export as one 
+  compact text column each (see parse_sketches)
 
+  Args:
+      feature: ee.Feature output by a reducer from sufficient_stats
+      bands: list of band names with histograms
+      
   Returns:
-      summaries for band data within any given geometry area where the DSWE value is 1
+      ee.Feature with the hist_ properties encoded, or null where a site had no
+      valid pixels
   """
-  # process image with the radsat mask
-  r = add_rad_mask(image).select("radsat")
-  # process image with cfmask
-  f = cf_mask(image).select("cfmask")
-  # process image with SR cloud mask
-  s = sr_cloud_mask(image).select("sr_cloud")
-  # where the f mask is > 2 (clouds and cloud shadow), call that 1 (otherwise 0) and rename as clouds.
-  clouds = f.gte(1).rename("clouds")
-  #apply dswe function
-  d = DSWE(image).select("dswe")
-  pCount = d.gt(0).rename("dswe_gt0").updateMask(f.eq(0)).updateMask(r.eq(1)).updateMask(s.eq(0)).selfMask()
-  dswe1 = d.eq(1).rename("dswe1").updateMask(f.eq(0)).updateMask(r.eq(1)).updateMask(s.eq(0)).selfMask()
-  # band where dswe is 3 and apply all masks
-  dswe3 = d.eq(3).rename("dswe3").updateMask(f.eq(0)).updateMask(r.eq(1)).updateMask(s.eq(0)).selfMask()
-  #calculate hillshade
-  h = calc_hill_shades(image, feat.geometry()).select("hillShade")
-  #calculate hillshadow
-  hs = calc_hill_shadows(image, feat.geometry()).select("hillShadow")
-  img_mask = (d.eq(1) # only high confidence water
-            .updateMask(r.eq(1)) #1 == no saturated pixels
-            .updateMask(f.eq(0)) #no snow or clouds
-            .updateMask(s.eq(0)) # no SR processing artefacts
-            .updateMask(hs.eq(1)) # only illuminated pixels
-            .selfMask())
-  pixOut = (image.select(["Blue", "Green", "Red", "Nir", "Swir1", "Swir2", 
-                        "SurfaceTemp", "temp_qa", "ST_ATRAN", "ST_DRAD", "ST_EMIS",
-                        "ST_EMSD", "ST_TRAD", "ST_URAD"],
-                        ["med_Blue", "med_Green", "med_Red", "med_Nir", "med_Swir1", "med_Swir2", 
-                        "med_SurfaceTemp", "med_temp_qa", "med_atran", "med_drad", "med_emis",
-                        "med_emsd", "med_trad", "med_urad"])
-            .addBands(image.select(["SurfaceTemp", "ST_CDIST"],
-                                    ["min_SurfaceTemp", "min_cloud_dist"]))
-            .addBands(image.select(["Blue", "Green", "Red", 
-                                    "Nir", "Swir1", "Swir2", "SurfaceTemp"],
-                                  ["sd_Blue", "sd_Green", "sd_Red", 
-                                  "sd_Nir", "sd_Swir1", "sd_Swir2", "sd_SurfaceTemp"]))
-            .addBands(image.select(["Blue", "Green", "Red", "Nir", 
-                                    "Swir1", "Swir2", 
-                                    "SurfaceTemp"],
-                                  ["mean_Blue", "mean_Green", "mean_Red", "mean_Nir", 
-                                  "mean_Swir1", "mean_Swir2", 
-                                  "mean_SurfaceTemp"]))
-            .addBands(image.select(["SurfaceTemp"]))
-            .updateMask(img_mask.eq(1))
-            # add these bands back in to create summary statistics without the influence of the DSWE masks:
-            .addBands(pCount) 
-            .addBands(dswe1)
-            .addBands(dswe3)
-            .addBands(clouds) 
-            .addBands(hs)
-            .addBands(h)
-            ) 
-  combinedReducer = (ee.Reducer.median().unweighted().forEachBand(pixOut.select(["med_Blue", "med_Green", "med_Red", 
-            "med_Nir", "med_Swir1", "med_Swir2", "med_SurfaceTemp", 
-            "med_temp_qa","med_atran", "med_drad", "med_emis",
-            "med_emsd", "med_trad", "med_urad"]))
-    .combine(ee.Reducer.min().unweighted().forEachBand(pixOut.select(["min_SurfaceTemp", "min_cloud_dist"])), sharedInputs = False)
-    .combine(ee.Reducer.stdDev().unweighted().forEachBand(pixOut.select(["sd_Blue", "sd_Green", "sd_Red", "sd_Nir", "sd_Swir1", "sd_Swir2", "sd_SurfaceTemp"])), sharedInputs = False)
-    .combine(ee.Reducer.mean().unweighted().forEachBand(pixOut.select(["mean_Blue", "mean_Green", "mean_Red", 
-              "mean_Nir", "mean_Swir1", "mean_Swir2", "mean_SurfaceTemp"])), sharedInputs = False)
-    .combine(ee.Reducer.kurtosis().unweighted().forEachBand(pixOut.select(["SurfaceTemp"])), outputPrefix = "kurt_", sharedInputs = False)
-    .combine(ee.Reducer.count().unweighted().forEachBand(pixOut.select(["dswe_gt0", "dswe1", "dswe3"])), outputPrefix = "pCount_", sharedInputs = False)
-    .combine(ee.Reducer.mean().unweighted().forEachBand(pixOut.select(["clouds", "hillShadow"])), outputPrefix = "prop_", sharedInputs = False)
-    .combine(ee.Reducer.mean().unweighted().forEachBand(pixOut.select(["hillShade"])), outputPrefix = "mean_", sharedInputs = False)
-    )
-  # apply combinedReducer to the image collection, mapping over each feature
-  lsout = (pixOut.reduceRegions(feat, combinedReducer, 30))
-  out = lsout.map(remove_geo)
-  return out
+  for b in bands:
+    hist = feature.get("hist_" + b)
+    counts = (ee.Array(hist).slice(1, 1, 2).project([0]).toList()
+      .map(lambda n: ee.Number(n).format("%d")))
+    feature = feature.set("hist_" + b, ee.Algorithms.If(hist, ee.List(counts).join(","), None))
+  return feature
 
-def ref_pull_457_DSWE3(image):
-  """ This function applies all functions to the Landsat 4-7 ee.ImageCollection, extracting
-  summary statistics for each geometry area where the DSWE value is 3 (high confidence
-  vegetated pixel)
+
+## Set up the reflectance pull
+def pull_qa(image, dswe_value, geo, qa_bands, use_cache = True):
+  """ Build the pixel mask and the QA bands of a pull from the per-scene layers
+  of an image (see scene_qa_layers)
 
   Args:
       image: ee.Image of an ee.ImageCollection
+      dswe_value: DSWE class to summarize, 1 (high confidence water) or 3 
+      (high confidence vegetated pixels)
+      geo: ee.Geometry to calculate hill shade and shadow over
+      qa_bands: QA bands of the image, qa_bands_457, qa_bands_89 or 
+      qa_bands_harmonized
+      use_cache: if True, read the per-scene layers from the tile's QA cache 
+      when there is one
 
   Returns:
-      summaries for band data within any given geometry area where the DSWE value is 3
+      tuple of (self-masked ee.Image of the pixels to summarize, ee.Image of the
+      "dswe_gt0", "dswe1", "dswe3", "clouds", "hillShadow" and "hillShade" 
+      bands, with "medHighAero" after "dswe3" if qa_bands includes aerosol_qa)
   """
-  # process image with the radsat mask
-  r = add_rad_mask(image).select("radsat")
-  # process image with cfmask
-  f = cf_mask(image).select("cfmask")
-  # process image with st SR cloud mask
-  s = sr_cloud_mask(image).select("sr_cloud")
-  # where the f mask is >= 1 (clouds and cloud shadow), call that 1 (otherwise 0) and rename as clouds.
-  clouds = f.gte(1).rename("clouds")
+  # per-scene layers, computed once or read from the tile's QA cache. clear is
+  # 1 where there are no saturated pixels, clouds, snow or (Landsat 4-7) SR 
+  # processing artefacts
+  layers = scene_qa_layers(image, geo, qa_bands, use_cache)
+  clear = layers.select("clear")
+  clouds = layers.select("clouds")
   #apply dswe function
-  d = DSWE(image).select("dswe")
-  pCount = d.gt(0).rename("dswe_gt0").updateMask(f.eq(0)).updateMask(r.eq(1)).updateMask(s.eq(0)).selfMask()
-  dswe1 = d.eq(1).rename("dswe1").updateMask(f.eq(0)).updateMask(r.eq(1)).updateMask(s.eq(0)).selfMask()
+  d = layers.select("dswe")
+  pCount = d.gt(0).rename("dswe_gt0").updateMask(clear).selfMask()
+  dswe1 = d.eq(1).rename("dswe1").updateMask(clear).selfMask()
   # band where dswe is 3 and apply all masks
-  dswe3 = d.eq(3).rename("dswe3").updateMask(f.eq(0)).updateMask(r.eq(1)).updateMask(s.eq(0)).selfMask()
+  dswe3 = d.eq(3).rename("dswe3").updateMask(clear).selfMask()
   #calculate hillshade
-  h = calc_hill_shades(image, feat.geometry()).select("hillShade")
+  h = layers.select("hillShade")
   #calculate hillshadow
-  hs = calc_hill_shadows(image, feat.geometry()).select("hillShadow")
-  img_maks = (d.eq(3) # only vegetated water
-          .updateMask(r.eq(1)) #1 == no saturated pixels
-          .updateMask(f.eq(0)) #no snow or clouds
-          .updateMask(s.eq(0)) # no SR processing artefacts
+  hs = layers.select("hillShadow")
+  img_mask = (d.eq(dswe_value) # only the requested DSWE class
+          .updateMask(clear) # no saturated pixels, clouds, snow or SR processing artefacts
           .updateMask(hs.eq(1)) # only illuminated pixels
           .selfMask())
-  pixOut = (image.select(["Blue", "Green", "Red", "Nir", "Swir1", "Swir2", 
-                      "SurfaceTemp", "temp_qa", "ST_ATRAN", "ST_DRAD", "ST_EMIS",
-                      "ST_EMSD", "ST_TRAD", "ST_URAD"],
-                      ["med_Blue", "med_Green", "med_Red", "med_Nir", "med_Swir1", "med_Swir2", 
-                      "med_SurfaceTemp", "med_temp_qa", "med_atran", "med_drad", "med_emis",
-                      "med_emsd", "med_trad", "med_urad"])
+  qa = pCount.addBands(dswe1).addBands(dswe3)
+  if "aerosol_qa" in qa_bands:
+    # aerosol flag, fully masked for Landsat 4-7 in the harmonized stack
+    qa = qa.addBands(layers.select("medHighAero"))
+  qa = qa.addBands(clouds).addBands(hs).addBands(h)
+  return img_mask, qa
+
+
+def site_stats(image, img_mask, qa, aerosol):
+  """ Bands and reducer of the summary statistics of the site (and polygon 
+  center) pulls. The reducer's inputs are in the band order of the image.
+
+  Args:
+      image: ee.Image with the renamed (or harmonized) bands
+      img_mask: ee.Image, self-masked band of the pixels to summarize
+      qa: ee.Image of the QA bands from pull_qa
+      aerosol: if True, summarize the Aerosol band and count medHighAero
+      
+  Returns:
+      tuple of the ee.Image of the statistics bands and the ee.Reducer for 
+      them, which outputs the columns of site_columns (see sensor_catalog.py)
+  """
+  sr = (["Aerosol"] if aerosol else []) + ["Blue", "Green", "Red", "Nir", "Swir1", "Swir2", "SurfaceTemp"]
+  med = sr + ["temp_qa", "ST_ATRAN", "ST_DRAD", "ST_EMIS", "ST_EMSD", "ST_TRAD", "ST_URAD"]
+  med_names = (["med_" + b for b in sr] 
+    + ["med_temp_qa", "med_atran", "med_drad", "med_emis", "med_emsd", "med_trad", "med_urad"])
+  counts = ["dswe_gt0", "dswe1", "dswe3"] + (["medHighAero"] if aerosol else [])
+  pixOut = (image.select(med, med_names)
           .addBands(image.select(["SurfaceTemp", "ST_CDIST"],
                                   ["min_SurfaceTemp", "min_cloud_dist"]))
-          .addBands(image.select(["Blue", "Green", "Red", 
-                                  "Nir", "Swir1", "Swir2", "SurfaceTemp"],
-                                ["sd_Blue", "sd_Green", "sd_Red", 
-                                "sd_Nir", "sd_Swir1", "sd_Swir2", "sd_SurfaceTemp"]))
-          .addBands(image.select(["Blue", "Green", "Red", "Nir", 
-                                    "Swir1", "Swir2", 
-                                    "SurfaceTemp"],
-                                  ["mean_Blue", "mean_Green", "mean_Red", "mean_Nir", 
-                                  "mean_Swir1", "mean_Swir2", 
-                                  "mean_SurfaceTemp"]))
+          .addBands(image.select(sr, ["sd_" + b for b in sr]))
+          .addBands(image.select(sr, ["mean_" + b for b in sr]))
           .addBands(image.select(["SurfaceTemp"]))
           .updateMask(img_mask.eq(1))
           # add these bands back in to create summary statistics without the influence of the DSWE masks:
-          .addBands(pCount) 
-          .addBands(dswe1)
-          .addBands(dswe3)
-          .addBands(clouds) 
-          .addBands(hs)
-          .addBands(h)
+          .addBands(qa)
           ) 
-  combinedReducer = (ee.Reducer.median().unweighted().forEachBand(pixOut.select(["med_Blue", "med_Green", "med_Red", 
-            "med_Nir", "med_Swir1", "med_Swir2", "med_SurfaceTemp", 
-            "med_temp_qa","med_atran", "med_drad", "med_emis",
-            "med_emsd", "med_trad", "med_urad"]))
+  combinedReducer = (ee.Reducer.median().unweighted().forEachBand(pixOut.select(med_names))
     .combine(ee.Reducer.min().unweighted().forEachBand(pixOut.select(["min_SurfaceTemp", "min_cloud_dist"])), sharedInputs = False)
-    .combine(ee.Reducer.stdDev().unweighted().forEachBand(pixOut.select(["sd_Blue", "sd_Green", "sd_Red", "sd_Nir", "sd_Swir1", "sd_Swir2", "sd_SurfaceTemp"])), sharedInputs = False)
-    .combine(ee.Reducer.mean().unweighted().forEachBand(pixOut.select(["mean_Blue", "mean_Green", "mean_Red", 
-              "mean_Nir", "mean_Swir1", "mean_Swir2", "mean_SurfaceTemp"])), sharedInputs = False)
+    .combine(ee.Reducer.stdDev().unweighted().forEachBand(pixOut.select(["sd_" + b for b in sr])), sharedInputs = False)
+    .combine(ee.Reducer.mean().unweighted().forEachBand(pixOut.select(["mean_" + b for b in sr])), sharedInputs = False)
     .combine(ee.Reducer.kurtosis().unweighted().forEachBand(pixOut.select(["SurfaceTemp"])), outputPrefix = "kurt_", sharedInputs = False)
-    .combine(ee.Reducer.count().unweighted().forEachBand(pixOut.select(["dswe_gt0", "dswe1", "dswe3"])), outputPrefix = "pCount_", sharedInputs = False)
+    .combine(ee.Reducer.count().unweighted().forEachBand(pixOut.select(counts)), outputPrefix = "pCount_", sharedInputs = False)
     .combine(ee.Reducer.mean().unweighted().forEachBand(pixOut.select(["clouds", "hillShadow"])), outputPrefix = "prop_", sharedInputs = False)
     .combine(ee.Reducer.mean().unweighted().forEachBand(pixOut.select(["hillShade"])), outputPrefix = "mean_", sharedInputs = False)
     )
-  # apply combinedReducer to the image collection, mapping over each feature
-  lsout = (pixOut.reduceRegions(feat, combinedReducer, 30))
+  return pixOut, combinedReducer
+
+
+def ref_pull_sites(image, dswe_value, qa_bands, stats_bands):
+  """ Extract summary statistics for each site in feat from an image, where the
+  DSWE value is dswe_value. Shared by the pulls of every stack.
+
+  Args:
+      image: ee.Image of an ee.ImageCollection
+      dswe_value: DSWE class to summarize, 1 (high confidence water) or 3 
+      (high confidence vegetated pixels)
+      qa_bands: QA bands of the image, qa_bands_457, qa_bands_89 or 
+      qa_bands_harmonized; the Aerosol band is summarized if they include
+      aerosol_qa
+      stats_bands: bands with sufficient statistics in "mergeable" mode
+
+  Returns:
+      summaries for band data within any given geometry area where the DSWE value 
+      is dswe_value
+  """
+  img_mask, qa = pull_qa(image, dswe_value, feat.geometry(), qa_bands)
+  pixOut, combinedReducer = site_stats(image, img_mask, qa, "aerosol_qa" in qa_bands)
+  # in "mergeable" mode, add the sufficient statistics (see merge_stats.py)
+  if statistics_mode == "mergeable":
+    stats, stats_reducer = sufficient_stats(image, stats_bands)
+    pixOut = pixOut.addBands(stats.updateMask(img_mask.eq(1)))
+    combinedReducer = combinedReducer.combine(stats_reducer, sharedInputs = False)
+  # apply combinedReducer to the image collection, mapping over each feature 
+  # with enough valid pixels (and over each radius of a buffer sweep)
+  lsout = reduce_sites(pixOut, img_mask, combinedReducer)
   out = lsout.map(remove_geo)
+  if statistics_mode == "mergeable":
+    out = out.map(lambda f: encode_sketches(f, stats_bands))
   return out
 
 
+def ref_pull_457_DSWE1(image):
+  """ This function applies all functions to the Landsat 4-7 ee.ImageCollection, extracting
+  summary statistics for each geometry area where the DSWE value is 1 (high confidence water)
+
+  Args:
+      image: ee.Image of an ee.ImageCollection
+
+  Returns:
+      summaries for band data within any given geometry area where the DSWE value is 1
+  """
+  return ref_pull_sites(image, 1, qa_bands_457, mergeable_bands_457)
+
+
+def ref_pull_457_DSWE3(image):
+  """ This function applies all functions to the Landsat 4-7 ee.ImageCollection, extracting
+  summary statistics for each geometry area where the DSWE value is 3 (high confidence
+  vegetated pixel)
+
+  Args:
+      image: ee.Image of an ee.ImageCollection
+
+  Returns:
+      summaries for band data within any given geometry area where the DSWE value is 3
+  """
+  return ref_pull_sites(image, 3, qa_bands_457, mergeable_bands_457)
+
+
 def ref_pull_89_DSWE1(image):
   """ This function applies all functions to the Landsat 8 and 9 ee.ImageCollection, extracting
   summary statistics for each geometry area where the DSWE value is 1 (high confidence water)
@@ -499,75 +674,8 @@ def ref_pull_89_DSWE1(image):
   Returns:
       summaries for band data within any given geometry area where the DSWE value is 1
   """
-  # process image with the radsat mask
-  r = add_rad_mask(image).select("radsat")
-  # process image with cfmask
-  f = cf_mask(image).select("cfmask")
-  # process image with aerosol mask
-  a = sr_aerosol(image).select("medHighAero")
-  # where the f mask is >= 1 (clouds and cloud shadow), call that 1 (otherwise 0) and rename as clouds.
-  clouds = f.gte(1).rename("clouds")
-  #apply dswe function
-  d = DSWE(image).select("dswe")
-  pCount = d.gt(0).rename("dswe_gt0").updateMask(f.eq(0)).updateMask(r.eq(1)).selfMask()
-  dswe1 = d.eq(1).rename("dswe1").updateMask(f.eq(0)).updateMask(r.eq(1)).selfMask()
-  # band where dswe is 3 and apply all masks
-  dswe3 = d.eq(3).rename("dswe3").updateMask(f.eq(0)).updateMask(r.eq(1)).selfMask()
-  #calculate hillshade
-  h = calc_hill_shades(image, feat.geometry()).select("hillShade")
-  #calculate hillshadow
-  hs = calc_hill_shadows(image, feat.geometry()).select("hillShadow")
-  img_mask = (d.eq(1) # only confident water
-          .updateMask(r.eq(1)) # 1 == no saturated pixels
-          .updateMask(f.eq(0)) # no snow or clouds
-          .updateMask(hs.eq(1)) # only illuminated pixels
-          .selfMask())
-  pixOut = (image.select(["Aerosol", "Blue", "Green", "Red", "Nir", "Swir1", "Swir2", 
-                      "SurfaceTemp", "temp_qa", "ST_ATRAN", "ST_DRAD", "ST_EMIS",
-                      "ST_EMSD", "ST_TRAD", "ST_URAD"],
-                      ["med_Aerosol", "med_Blue", "med_Green", "med_Red", "med_Nir", "med_Swir1", "med_Swir2", 
-                      "med_SurfaceTemp", "med_temp_qa", "med_atran", "med_drad", "med_emis",
-                      "med_emsd", "med_trad", "med_urad"])
-          .addBands(image.select(["SurfaceTemp", "ST_CDIST"],
-                                  ["min_SurfaceTemp", "min_cloud_dist"]))
-          .addBands(image.select(["Aerosol", "Blue", "Green", "Red", 
-                                  "Nir", "Swir1", "Swir2", "SurfaceTemp"],
-                                ["sd_Aerosol", "sd_Blue", "sd_Green", "sd_Red", 
-                                "sd_Nir", "sd_Swir1", "sd_Swir2", "sd_SurfaceTemp"]))
-          .addBands(image.select(["Aerosol", "Blue", "Green", "Red", "Nir", 
-                                  "Swir1", "Swir2", 
-                                  "SurfaceTemp"],
-                                ["mean_Aerosol", "mean_Blue", "mean_Green", "mean_Red", "mean_Nir", 
-                                "mean_Swir1", "mean_Swir2", 
-                                "mean_SurfaceTemp"]))
-          .addBands(image.select(["SurfaceTemp"]))
-          .updateMask(img_mask.eq(1))
-          # add these bands back in to create summary statistics without the influence of the DSWE masks:
-          .addBands(pCount) 
-          .addBands(dswe1)
-          .addBands(dswe3)
-          .addBands(a)
-          .addBands(clouds) 
-          .addBands(hs)
-          .addBands(h)
-          ) 
-  combinedReducer = (ee.Reducer.median().unweighted().forEachBand(pixOut.select(["med_Aerosol", "med_Blue", "med_Green", "med_Red", 
-            "med_Nir", "med_Swir1", "med_Swir2", "med_SurfaceTemp", 
-            "med_temp_qa","med_atran", "med_drad", "med_emis",
-            "med_emsd", "med_trad", "med_urad"]))
-    .combine(ee.Reducer.min().unweighted().forEachBand(pixOut.select(["min_SurfaceTemp", "min_cloud_dist"])), sharedInputs = False)
-    .combine(ee.Reducer.stdDev().unweighted().forEachBand(pixOut.select(["sd_Aerosol", "sd_Blue", "sd_Green", "sd_Red", "sd_Nir", "sd_Swir1", "sd_Swir2", "sd_SurfaceTemp"])), sharedInputs = False)
-    .combine(ee.Reducer.mean().unweighted().forEachBand(pixOut.select(["mean_Aerosol", "mean_Blue", "mean_Green", "mean_Red", 
-              "mean_Nir", "mean_Swir1", "mean_Swir2", "mean_SurfaceTemp"])), sharedInputs = False)
-    .combine(ee.Reducer.kurtosis().unweighted().forEachBand(pixOut.select(["SurfaceTemp"])), outputPrefix = "kurt_", sharedInputs = False)
-    .combine(ee.Reducer.count().unweighted().forEachBand(pixOut.select(["dswe_gt0", "dswe1", "dswe3", "medHighAero"])), outputPrefix = "pCount_", sharedInputs = False)
-    .combine(ee.Reducer.mean().unweighted().forEachBand(pixOut.select(["clouds", "hillShadow"])), outputPrefix = "prop_", sharedInputs = False)
-    .combine(ee.Reducer.mean().unweighted().forEachBand(pixOut.select(["hillShade"])), outputPrefix = "mean_", sharedInputs = False)
-    )
-  # apply combinedReducer to the image collection, mapping over each feature
-  lsout = (pixOut.reduceRegions(feat, combinedReducer, 30))
-  out = lsout.map(remove_geo)
-  return out
+  return ref_pull_sites(image, 1, qa_bands_89, mergeable_bands)
+
 
 def ref_pull_89_DSWE3(image):
   """ This function applies all functions to the Landsat 8 and 9 ee.ImageCollection, extracting
@@ -580,77 +688,202 @@ def ref_pull_89_DSWE3(image):
   Returns:
       summaries for band data within any given geometry area where the DSWE value is 3
   """
-  # process image with the radsat mask
-  r = add_rad_mask(image).select("radsat")
-  # process image with cfmask
-  f = cf_mask(image).select("cfmask")
-  # process image with aerosol mask
-  a = sr_aerosol(image).select("medHighAero")
-  # where the f mask is >= 1 (clouds and cloud shadow), call that 1 (otherwise 0) and rename as clouds.
-  clouds = f.gte(1).rename("clouds")
-  #apply dswe function
-  d = DSWE(image).select("dswe")
-  pCount = d.gt(0).rename("dswe_gt0").updateMask(f.eq(0)).updateMask(r.eq(1)).selfMask()
-  dswe1 = d.eq(1).rename("dswe1").updateMask(f.eq(0)).updateMask(r.eq(1)).selfMask()
-  # band where dswe is 3 and apply all masks
-  dswe3 = d.eq(3).rename("dswe3").updateMask(f.eq(0)).updateMask(r.eq(1)).selfMask()
-  #calculate hillshade
-  h = calc_hill_shades(image, feat.geometry()).select("hillShade")
-  #calculate hillshadow
-  hs = calc_hill_shadows(image, feat.geometry()).select("hillShadow")
-  img_mask = (d.eq(3) # only vegetated water
-          .updateMask(r.eq(1)) #1 == no saturated pixels
-          .updateMask(f.eq(0)) #no snow or clouds
-          .updateMask(hs.eq(1)) # only illuminated pixels
-          .selfMask())
-  pixOut = (image.select(["Aerosol", "Blue", "Green", "Red", "Nir", "Swir1", "Swir2", 
-                      "SurfaceTemp", "temp_qa", "ST_ATRAN", "ST_DRAD", "ST_EMIS",
-                      "ST_EMSD", "ST_TRAD", "ST_URAD"],
-                      ["med_Aerosol", "med_Blue", "med_Green", "med_Red", "med_Nir", "med_Swir1", "med_Swir2", 
-                      "med_SurfaceTemp", "med_temp_qa", "med_atran", "med_drad", "med_emis",
-                      "med_emsd", "med_trad", "med_urad"])
+  return ref_pull_sites(image, 3, qa_bands_89, mergeable_bands)
+
+
+## Harmonized Landsat 4-9 pull
+# band names shared by all sensors when harmonize_sensors is True. Aerosol and 
+# aerosol_qa are empty (fully masked) for Landsat 4-7, cloud_qa is empty for 
+# Landsat 8 and 9.
+bns_harmonized = (["Aerosol", "Blue", "Green", "Red", "Nir", "Swir1", "Swir2",
+  "pixel_qa", "cloud_qa", "aerosol_qa", "radsat_qa", "SurfaceTemp", 
+  "temp_qa", "ST_CDIST", "ST_ATRAN", "ST_DRAD", "ST_EMIS",
+  "ST_EMSD", "ST_TRAD", "ST_URAD"])
+
+
+def harmonize_457(image):
+  """ Add empty Aerosol and aerosol_qa bands to a renamed Landsat 4-7 image so 
+  that it matches the harmonized band schema
+
+  Args:
+      image: ee.Image of the renamed Landsat 4-7 ee.ImageCollection
+
+  Returns:
+      ee.Image with bands in the order of bns_harmonized
+  """
+  aerosol = ee.Image.constant(0).toFloat().updateMask(0).rename("Aerosol")
+  aerosol_qa = ee.Image.constant(0).toUint8().updateMask(0).rename("aerosol_qa")
+  return image.addBands(aerosol).addBands(aerosol_qa).select(bns_harmonized)
+
+
+def harmonize_89(image):
+  """ Add an empty cloud_qa band to a renamed Landsat 8/9 image so that it 
+  matches the harmonized band schema
+
+  Args:
+      image: ee.Image of the renamed Landsat 8/9 ee.ImageCollection
+
+  Returns:
+      ee.Image with bands in the order of bns_harmonized
+  """
+  cloud_qa = ee.Image.constant(0).toUint8().updateMask(0).rename("cloud_qa")
+  return image.addBands(cloud_qa).select(bns_harmonized)
+
+
+def ref_pull_harmonized_DSWE1(image):
+  """ Apply ref_pull_sites to the harmonized Landsat 4-9 ee.ImageCollection, 
+  extracting summary statistics for each geometry area where the DSWE value is 1 
+  (high confidence water). The aerosol flag is counted for Landsat 8 and 9 only.
+
+  Args:
+      image: ee.Image of an ee.ImageCollection
+
+  Returns:
+      summaries for band data within any given geometry area where the DSWE value is 1
+  """
+  return ref_pull_sites(image, 1, qa_bands_harmonized, mergeable_bands)
+
+
+def ref_pull_harmonized_DSWE3(image):
+  """ Apply ref_pull_sites to the harmonized Landsat 4-9 ee.ImageCollection, 
+  extracting summary statistics for each geometry area where the DSWE value is 3 
+  (high confidence vegetated pixels). The aerosol flag is counted for Landsat 8 
+  and 9 only.
+
+  Args:
+      image: ee.Image of an ee.ImageCollection
+
+  Returns:
+      summaries for band data within any given geometry area where the DSWE value is 3
+  """
+  return ref_pull_sites(image, 3, qa_bands_harmonized, mergeable_bands)
+
+
+## Lake polygon and polygon center pulls
+# bands summarized as mergeable partial statistics for the polygon extent
+polygon_bands = ["Aerosol", "Blue", "Green", "Red", "Nir", "Swir1", "Swir2", "SurfaceTemp"]
+
+
+def polygons_to_eeFeat(df, wrs):
+  """Function to create an eeFeatureCollection of the lake polygon parts of a tile,
+  from the polygons prepared by prep_polygons
+
+  Args:
+      df: polygon parts with id and part_geojson (a GeoJSON dictionary in 
+      decimal degrees)
+      wrs: current tile
+
+  Returns:
+      ee.FeatureCollection of the polygon parts
+  """
+  features = []
+  for i in (df.index):
+    loc_properties = {"system:index": str(df.id[i]), 
+    "id": str(df.id[i]),
+    "wrs": str(wrs)}
+    # planar (not geodesic) edges, as the polygons are drawn in decimal degrees
+    g = ee.Geometry(df.part_geojson[i], "EPSG:4326", False)
+    features.append(ee.Feature(g, loc_properties))
+  return ee.FeatureCollection(features)
+
+
+def polycenters_to_eeFeat(df, wrs):
+  """Function to create an eeFeatureCollection of the polygon centers of a tile,
+  from the polygons prepared by prep_polygons. Each center is buffered by the 
+  site_buffer or the radius of the largest circle that fits in the lake, 
+  whichever is smaller, so that the buffer never reaches the shore.
+
+  Args:
+      df: polygon parts with id, has_center, poi_Longitude, poi_Latitude and 
+      poi_radius_m
+      wrs: current tile
+
+  Returns:
+      ee.FeatureCollection of the buffered polygon centers
+  """
+  df = df[df.has_center].drop_duplicates("id")
+  features = []
+  for i in (df.index):
+    loc_properties = {"system:index": str(df.id[i]), 
+    "id": str(df.id[i]),
+    "wrs": str(wrs)}
+    g = ee.Geometry.Point([df.poi_Longitude[i], df.poi_Latitude[i]], "EPSG:4326")
+    features.append(ee.Feature(g.buffer(min(buffer, df.poi_radius_m[i])), loc_properties))
+  return ee.FeatureCollection(features)
+
+
+def ref_pull_polygon(image, dswe_value):
+  """ Extract partial statistics for the lake polygons in feat from an image of 
+  a harmonized ee.ImageCollection (see harmonize_457 and harmonize_89). Only 
+  statistics that can be combined without loss are calculated: pixel counts, 
+  sums, sums of squares and minimums (and the higher powers and histograms of
+  sufficient_stats in "mergeable" mode), so that lakes split between scenes can
+  be merged at collation (see merge_polygon_partials). Polygons are reduced once
+  per scene, and sites_with_valid_pixels is not applied so no part of a lake is 
+  dropped.
+
+  Args:
+      image: ee.Image of a harmonized ee.ImageCollection
+      dswe_value: DSWE class to summarize, 1 (high confidence water) or 3 
+      (high confidence vegetated pixels)
+
+  Returns:
+      partial statistics for band data within each polygon where the DSWE value 
+      is dswe_value
+  """
+  # the whole scene, as the union of many lake polygons is slow to compute
+  img_mask, qa = pull_qa(image, dswe_value, image.geometry(), qa_bands_harmonized, use_cache = False)
+  mergeable = statistics_mode == "mergeable"
+  stats, stats_reducer = sufficient_stats(image, polygon_bands, 4 if mergeable else 2, mergeable)
+  pixOut = (stats
           .addBands(image.select(["SurfaceTemp", "ST_CDIST"],
                                   ["min_SurfaceTemp", "min_cloud_dist"]))
-          .addBands(image.select(["Aerosol", "Blue", "Green", "Red", 
-                                  "Nir", "Swir1", "Swir2", "SurfaceTemp"],
-                                ["sd_Aerosol", "sd_Blue", "sd_Green", "sd_Red", 
-                                "sd_Nir", "sd_Swir1", "sd_Swir2", "sd_SurfaceTemp"]))
-          .addBands(image.select(["Aerosol", "Blue", "Green", "Red", "Nir", 
-                                  "Swir1", "Swir2", 
-                                  "SurfaceTemp"],
-                                ["mean_Aerosol", "mean_Blue", "mean_Green", "mean_Red", "mean_Nir", 
-                                "mean_Swir1", "mean_Swir2", 
-                                "mean_SurfaceTemp"]))
-          .addBands(image.select(["SurfaceTemp"]))
           .updateMask(img_mask.eq(1))
           # add these bands back in to create summary statistics without the influence of the DSWE masks:
-          .addBands(pCount) 
-          .addBands(dswe1)
-          .addBands(dswe3)
-          .addBands(a)
-          .addBands(clouds) 
-          .addBands(hs)
-          .addBands(h)
-          ) 
-  combinedReducer = (ee.Reducer.median().unweighted().forEachBand(pixOut.select(["med_Aerosol", "med_Blue", "med_Green", "med_Red", 
-            "med_Nir", "med_Swir1", "med_Swir2", "med_SurfaceTemp", 
-            "med_temp_qa","med_atran", "med_drad", "med_emis",
-            "med_emsd", "med_trad", "med_urad"]))
+          .addBands(qa)
+          )
+  combinedReducer = (stats_reducer
     .combine(ee.Reducer.min().unweighted().forEachBand(pixOut.select(["min_SurfaceTemp", "min_cloud_dist"])), sharedInputs = False)
-    .combine(ee.Reducer.stdDev().unweighted().forEachBand(pixOut.select(["sd_Aerosol", "sd_Blue", "sd_Green", "sd_Red", "sd_Nir", "sd_Swir1", "sd_Swir2", "sd_SurfaceTemp"])), sharedInputs = False)
-    .combine(ee.Reducer.mean().unweighted().forEachBand(pixOut.select(["mean_Aerosol", "mean_Blue", "mean_Green", "mean_Red", 
-              "mean_Nir", "mean_Swir1", "mean_Swir2", "mean_SurfaceTemp"])), sharedInputs = False)
-    .combine(ee.Reducer.kurtosis().unweighted().forEachBand(pixOut.select(["SurfaceTemp"])), outputPrefix = "kurt_", sharedInputs = False)
     .combine(ee.Reducer.count().unweighted().forEachBand(pixOut.select(["dswe_gt0", "dswe1", "dswe3", "medHighAero"])), outputPrefix = "pCount_", sharedInputs = False)
-    .combine(ee.Reducer.mean().unweighted().forEachBand(pixOut.select(["clouds", "hillShadow"])), outputPrefix = "prop_", sharedInputs = False)
-    .combine(ee.Reducer.mean().unweighted().forEachBand(pixOut.select(["hillShade"])), outputPrefix = "mean_", sharedInputs = False)
+    # proportions are kept as sums and counts, so they can be merged
+    .combine(ee.Reducer.sum().unweighted().forEachBand(pixOut.select(["clouds", "hillShadow", "hillShade"])), outputPrefix = "sum_", sharedInputs = False)
+    .combine(ee.Reducer.count().unweighted().forEachBand(pixOut.select(["clouds", "hillShadow", "hillShade"])), outputPrefix = "count_", sharedInputs = False)
     )
-  # apply combinedReducer to the image collection, mapping over each feature
-  lsout = (pixOut.reduceRegions(feat, combinedReducer, 30))
+  lsout = pixOut.reduceRegions(feat, combinedReducer, 30)
   out = lsout.map(remove_geo)
+  if mergeable:
+    out = out.map(lambda f: encode_sketches(f, polygon_bands))
   return out
 
 
+def ref_pull_polygon_DSWE1(image):
+  """ Apply ref_pull_polygon to a harmonized ee.ImageCollection, extracting 
+  partial statistics for each lake polygon where the DSWE value is 1 (high 
+  confidence water)
+
+  Args:
+      image: ee.Image of an ee.ImageCollection
+
+  Returns:
+      partial statistics for band data within each polygon where the DSWE value is 1
+  """
+  return ref_pull_polygon(image, 1)
+
+
+def ref_pull_polygon_DSWE3(image):
+  """ Apply ref_pull_polygon to a harmonized ee.ImageCollection, extracting 
+  partial statistics for each lake polygon where the DSWE value is 3 (high 
+  confidence vegetated pixels)
+
+  Args:
+      image: ee.Image of an ee.ImageCollection
+
+  Returns:
+      partial statistics for band data within each polygon where the DSWE value is 3
+  """
+  return ref_pull_polygon(image, 3)
+
+
 def maximum_no_of_tasks(MaxNActive, waitingPeriod):
   """ Function to limit the number of tasks sent to Earth Engine at one time to avoid time out errors
   
@@ -679,3 +912,30 @@ def maximum_no_of_tasks(MaxNActive, waitingPeriod):
         NActive += 1
   return()
 
+def start_task(task, description):
+  """ Function to start an export task, optionally profiling the size of the 
+  request's expression graph before it is sent to Earth Engine
+  
+  Args:
+      task: ee.batch.Task created by ee.batch.Export.*, not yet started
+      description: name of the export task
+      
+  Returns:
+      None. If graph_check is "True" or "only", the expression graph profile is 
+      saved in the out/graph_profiles folder and an error is raised if the 
+      configured budgets are exceeded. If graph_check is "only", the task is not
+      started.
+  """
+  if graph_check in ["True", "only"]:
+    profile = profile_ee_request(get_task_expression(task))
+    write_graph_profile(profile, description)
+    check_graph_budget(profile, description, graph_max_bytes, graph_max_nodes)
+  if graph_check == "only":
+    print("Profiled but did not start " + description)
+    return()
+  #Check how many existing tasks are running and take a break of 120 secs if it's >10 
+  maximum_no_of_tasks(10, 120)
+  #Send next task.
+  task.start()
+  return()
+
@@ -0,0 +1,287 @@
+import time
+import numpy as np
+from pandas import DataFrame, Series, concat
+
+
+# In "mergeable" statistics mode the site and polygon exports carry sufficient
+# statistics for each band: the pixel count (count_), sums of the first four
+# powers (sum_, sumsq_, sum3_, sum4_) and a fixed-bin histogram (hist_) as a
+# compact quantile sketch. Rows of the same site from different location chunks,
+# tiles, scenes or time windows can then be recombined: the moments exactly,
+# the median to within one histogram bin.
+
+# column prefixes of the sums of the powers 1-4 of a band
+power_prefixes = ["sum_", "sumsq_", "sum3_", "sum4_"]
+
+# the powers are of the band value minus this shift, so that sums of the
+# fourth power of SurfaceTemp (in Kelvin) keep their precision through export
+moment_shifts = {"SurfaceTemp": 273.15}
+
+# number of bins and value range of the histogram of each band. The bins are
+# fixed, so histograms from different exports can be added bin by bin. Values
+# outside of the range are counted in the first or last bin.
+sketch_bins = 100
+sketch_ranges = {"Aerosol": [-0.05, 0.45],
+  "Blue": [-0.05, 0.45],
+  "Green": [-0.05, 0.45],
+  "Red": [-0.05, 0.45],
+  "Nir": [-0.05, 0.45],
+  "Swir1": [-0.05, 0.45],
+  "Swir2": [-0.05, 0.45],
+  "SurfaceTemp": [260, 320]}
+
+
+def sufficient_stats_columns(bands, order = 4, sketch = True):
+  """Column names of the sufficient statistics of a list of bands, in the
+  order of the exports
+
+  Args:
+      bands: list of band names
+      order: highest power summed (2 for mean and sd, 4 to add skewness and
+      kurtosis)
+      sketch: if True, include the histogram column of each band
+
+  Returns:
+      list of column names
+  """
+  columns = ["count_" + b for b in bands]
+  for prefix in power_prefixes[:order]:
+    columns = columns + [prefix + b for b in bands]
+  if sketch:
+    columns = columns + ["hist_" + b for b in bands]
+  return columns
+
+
+def parse_sketches(column, bins = sketch_bins):
+  """Parse exported histograms (comma-separated bin counts) into an array.
+  Missing histograms are read as empty.
+
+  Args:
+      column: pandas Series of histogram strings
+      bins: number of bins of the histograms
+
+  Returns:
+      (rows x bins) int64 array of bin counts
+  """
+  empty = ",".join(["0"] * bins)
+  text = ",".join(column.fillna(empty).astype(str).str.strip("[]").where(lambda s: s != "", empty))
+  return np.array(text.split(","), dtype = np.float64).astype(np.int64).reshape(-1, bins)
+
+
+def format_sketches(counts):
+  """Format an array of histograms back into comma-separated strings, so merged
+  rows can be saved and merged again
+
+  Args:
+      counts: (rows x bins) array of bin counts
+
+  Returns:
+      list of histogram strings
+  """
+  return [",".join(row) for row in counts.astype(np.int64).astype(str)]
+
+
+def sketch_quantile(counts, band, q = 0.5):
+  """Approximate quantiles from fixed-bin histograms, interpolating linearly
+  within the bin that holds the quantile. The error is at most one bin width
+  for values inside the sketch range of the band.
+
+  Args:
+      counts: (rows x bins) array of bin counts
+      band: band name, to look up the sketch range
+      q: quantile, 0.5 for the median
+
+  Returns:
+      array of quantiles, NaN for empty histograms
+  """
+  lo, hi = sketch_ranges[band]
+  width = (hi - lo) / counts.shape[1]
+  cum = counts.cumsum(axis = 1)
+  total = cum[:, -1]
+  target = q * total
+  idx = np.argmax(cum >= target[:, None], axis = 1)
+  rows = np.arange(len(counts))
+  below = np.where(idx > 0, cum[rows, np.maximum(idx - 1, 0)], 0)
+  in_bin = counts[rows, idx]
+  within = np.where(in_bin > 0, (target - below) / np.maximum(in_bin, 1), 0.5)
+  return np.where(total > 0, lo + (idx + within) * width, np.nan)
+
+
+def moments_to_stats(n, s1, s2, s3 = None, s4 = None, shift = 0):
+  """Calculate the mean, standard deviation, skewness and kurtosis from a pixel
+  count and the sums of powers of (value - shift). The standard deviation is
+  the population standard deviation, as ee.Reducer.stdDev(), and the kurtosis
+  is the population excess kurtosis.
+
+  Args:
+      n: array of pixel counts
+      s1, s2, s3, s4: arrays of the sums of the first four powers; s3 and s4
+      may be None
+      shift: value subtracted from the pixel values before the powers were taken
+
+  Returns:
+      dictionary of arrays "mean", "sd", and "skew" and "kurt" if s3 and s4
+      are given. Statistics of empty rows are NaN
+  """
+  n = np.asarray(n, dtype = np.float64)
+  valid = np.where(n > 0, n, np.nan)
+  mean = s1 / valid
+  m2 = np.clip(s2 / valid - mean ** 2, 0, None)
+  stats = {"mean": mean + shift, "sd": np.sqrt(m2)}
+  if s3 is not None and s4 is not None:
+    m3 = s3 / valid - 3 * mean * s2 / valid + 2 * mean ** 3
+    m4 = s4 / valid - 4 * mean * s3 / valid + 6 * mean ** 2 * s2 / valid - 3 * mean ** 4
+    spread = np.where(m2 > 0, m2, np.nan)
+    stats["skew"] = m3 / spread ** 1.5
+    stats["kurt"] = m4 / spread ** 2 - 3
+  return stats
+
+
+def _group_sums(values, order, starts):
+  """Sum the rows of an array within groups, given the row order that sorts
+  the groups and the start of each group in that order"""
+  return np.add.reduceat(values[order], starts, axis = 0)
+
+
+def merge_shards(shards, keys, bands = None):
+  """Recombine rows of sufficient statistics that belong to the same group, for
+  example the same site and scene from two location chunks, the same lake from
+  two tiles, or the same site over several months. All additive columns (count_,
+  the power sums, pCount_ and hist_) are summed and min_ columns are minimized
+  with vectorized group reductions, then the mean_, sd_, skew_, kurt_ and med_
+  of each band are calculated from the merged totals. The merged sufficient
+  statistics are kept, so the output can be merged again.
+
+  Args:
+      shards: DataFrame of exported or merged rows
+      keys: list of columns that identify a group
+      bands: bands to calculate statistics for; defaults to every band with
+      count_ and sum_ columns
+
+  Returns:
+      DataFrame with one row per group: the keys, "n_shards", the merged
+      sufficient statistics and the statistics calculated from them
+  """
+  if bands is None:
+    bands = [c[6:] for c in shards.columns if c.startswith("count_") and "sum_" + c[6:] in shards.columns]
+  additive = [c for c in shards.columns
+    if c.startswith(tuple(["count_", "pCount_"] + power_prefixes))]
+  minimums = [c for c in shards.columns if c.startswith("min_")]
+  sketches = [c for c in shards.columns if c.startswith("hist_")]
+
+  groups = shards.groupby(keys, sort = True, dropna = False).ngroup().to_numpy()
+  order = np.argsort(groups, kind = "stable")
+  starts = np.flatnonzero(np.r_[True, np.diff(groups[order]) != 0])
+  merged = shards[keys].iloc[order[starts]].reset_index(drop = True)
+  merged["n_shards"] = np.diff(np.r_[starts, len(order)])
+
+  if additive:
+    sums = _group_sums(shards[additive].fillna(0).to_numpy(np.float64), order, starts)
+    merged = merged.join(DataFrame(sums, columns = additive))
+  if minimums:
+    mins = np.fmin.reduceat(shards[minimums].to_numpy(np.float64)[order], starts, axis = 0)
+    merged = merged.join(DataFrame(mins, columns = minimums))
+  counts = {}
+  for column in sketches:
+    counts[column] = _group_sums(parse_sketches(shards[column]), order, starts)
+    merged[column] = format_sketches(counts[column])
+
+  for band in bands:
+    powers = [merged[p + band].to_numpy() if p + band in merged else None for p in power_prefixes]
+    if powers[1] is None:
+      # proportions and means of QA bands only have counts and sums
+      merged["mean_" + band] = powers[0] / merged["count_" + band].where(merged["count_" + band] > 0)
+      continue
+    stats = moments_to_stats(merged["count_" + band].to_numpy(), *powers,
+      shift = moment_shifts.get(band, 0))
+    for name, values in stats.items():
+      merged[name + "_" + band] = values
+    if "hist_" + band in counts:
+      merged["med_" + band] = sketch_quantile(counts["hist_" + band], band)
+  return merged
+
+
+def pixel_sufficient_stats(values, site_index, n_sites, band, order = 4, sketch = True):
+  """Calculate the sufficient statistics of one band for each site from pixel
+  values, as the "mergeable" reducers do in Earth Engine
+
+  Args:
+      values: array of pixel values
+      site_index: array of the site (row) of each pixel, 0 to n_sites - 1
+      n_sites: number of sites (rows) to return
+      band: band name
+      order: highest power summed
+      sketch: if True, include the histogram of the band
+
+  Returns:
+      DataFrame of the sufficient statistics columns of the band, one row per
+      site
+  """
+  x = np.asarray(values, dtype = np.float64) - moment_shifts.get(band, 0)
+  out = DataFrame({"count_" + band: np.bincount(site_index, minlength = n_sites)})
+  for k, prefix in enumerate(power_prefixes[:order]):
+    out[prefix + band] = np.bincount(site_index, weights = x ** (k + 1), minlength = n_sites)
+  if sketch:
+    lo, hi = sketch_ranges[band]
+    bins = np.clip(((values - lo) / (hi - lo) * sketch_bins).astype(np.int64), 0, sketch_bins - 1)
+    counts = np.bincount(site_index * sketch_bins + bins, minlength = n_sites * sketch_bins)
+    out["hist_" + band] = format_sketches(counts.reshape(n_sites, sketch_bins))
+  return out
+
+
+def benchmark_merge_shards(n_sites = 500, n_shards = 4, pixels_per_site = 400, seed = 1):
+  """Time merge_shards and measure its error against statistics calculated in
+  a single pass over simulated pixels. The pixels of each site are split at
+  random into shards, sufficient statistics are calculated per shard, and the
+  shards are merged and compared to the statistics of all of the pixels of the
+  site.
+
+  Args:
+      n_sites: number of simulated sites
+      n_shards: number of shards the pixels of each site are split into
+      pixels_per_site: mean number of pixels per site
+      seed: random seed
+
+  Returns:
+      dictionary with the largest absolute error of each statistic, the
+      largest median error in bin widths, and the merge time in seconds
+  """
+  rng = np.random.default_rng(seed)
+  n_pixels = rng.poisson(pixels_per_site, n_sites)
+  site = np.repeat(np.arange(n_sites), n_pixels)
+  shard = rng.integers(0, n_shards, len(site))
+  pixels = {"Blue": rng.gamma(4, 0.01, len(site)),
+    "SurfaceTemp": 285 + rng.normal(0, 3, len(site)) + rng.normal(0, 5, n_sites)[site]}
+
+  tables = []
+  for k in range(n_shards):
+    in_shard = shard == k
+    one_shard = DataFrame({"site_id": np.arange(n_sites), "shard": k})
+    for band, values in pixels.items():
+      one_shard = one_shard.join(pixel_sufficient_stats(values[in_shard], site[in_shard], n_sites, band))
+    tables.append(one_shard)
+  shards = concat(tables, ignore_index = True)
+
+  start = time.time()
+  merged = merge_shards(shards, ["site_id"])
+  elapsed = time.time() - start
+
+  errors = {"merge_seconds": elapsed}
+  for band, values in pixels.items():
+    x = Series(values).groupby(site)
+    centered = values - x.transform("mean").to_numpy()
+    m2 = Series(centered ** 2).groupby(site).mean()
+    single = {"count": x.size().to_numpy(),
+      "mean": x.mean().to_numpy(),
+      "sd": np.sqrt(m2).to_numpy(),
+      "skew": (Series(centered ** 3).groupby(site).mean() / m2 ** 1.5).to_numpy(),
+      "kurt": (Series(centered ** 4).groupby(site).mean() / m2 ** 2 - 3).to_numpy()}
+    for name, expected in single.items():
+      column = "count_" + band if name == "count" else name + "_" + band
+      errors[column] = float(np.max(np.abs(merged[column].to_numpy() - expected)))
+    lo, hi = sketch_ranges[band]
+    width = (hi - lo) / sketch_bins
+    inside = (x.median() > lo) & (x.median() < hi)
+    med_error = np.abs(merged["med_" + band].to_numpy() - x.median().to_numpy())[inside.to_numpy()]
+    errors["med_" + band + "_bins"] = float(np.max(med_error) / width)
+  return errors
@@ -1,11 +1,10 @@
 import ee
-from pandas import read_csv
 import time
 
-# get configs from yml file
-yml = read_csv("b_pull_Landsat_SRST_poi/mid/yml.csv")
+# get the validated config
+config = read_config()
 # assign proj
-eeproj = yml["ee_proj"][0]
+eeproj = config["ee_proj"]
 #initialize GEE with proj
 ee.Initialize(project = eeproj)
 
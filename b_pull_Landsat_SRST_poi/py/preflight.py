@@ -0,0 +1,194 @@
+import ee
+import math
+import os
+import re
+from pandas import DataFrame, concat, read_csv, to_datetime
+
+
+# sensor groups of the plan, see stack_catalog in sensor_catalog.py
+sensor_groups = ["LS457", "LS89"]
+
+
+def add_pathrow(image):
+  """ Add a "PR" property with the 6-digit WRS2 path-row (e.g. "035032") to an
+  image, matching the WRS2_PR of the locations file
+
+  Args:
+      image: ee.Image of an ee.ImageCollection
+
+  Returns:
+      ee.Image with the PR property set
+  """
+  return image.set("PR", ee.Number(image.get("WRS_PATH")).format("%03d")
+    .cat(ee.Number(image.get("WRS_ROW")).format("%03d")))
+
+
+def count_scenes_per_tile(tiles, config):
+  """ Count the scenes that will be acquired per tile and sensor group in one
+  request to Earth Engine. Only scene metadata is touched, so this is fast.
+
+  Args:
+      tiles: list of WRS2 path-rows as 6-digit strings
+      config: validated config, see pull_config.py
+
+  Returns:
+      dictionary of sensor group to a dictionary of path-row to scene count
+  """
+  paths = sorted(set(int(str(t)[0:3]) for t in tiles))
+  rows = sorted(set(int(str(t)[3:6]) for t in tiles))
+  counts = {}
+  for group in sensor_groups:
+    stack = ee.ImageCollection([])
+    for sensor in stack_sensors(group, config):
+      one = (filter_scene_clouds(ee.ImageCollection(sensor_catalog[sensor]["collection"]), config)
+        .filterDate(config["start_date"].strftime("%Y-%m-%d"), config["end_date"].strftime("%Y-%m-%d"))
+        .filter(ee.Filter.inList("WRS_PATH", paths))
+        .filter(ee.Filter.inList("WRS_ROW", rows)))
+      stack = stack.merge(one)
+    counts[group] = stack.map(add_pathrow).aggregate_histogram("PR")
+  # a single getInfo for all sensor groups
+  counts = ee.Dictionary(counts).getInfo()
+  # paths and rows are filtered separately, so drop tiles that aren't requested
+  tiles = set(str(t) for t in tiles)
+  return {group: {pr: n for pr, n in hist.items() if pr in tiles} for group, hist in counts.items()}
+
+
+def tile_locations(tiles, config,
+  locations_dir = "b_pull_Landsat_SRST_poi/out/locations/",
+  polygons_dir = "b_pull_Landsat_SRST_poi/out/polygons/"):
+  """ Count the sites and polygon parts of each tile and the export tasks they
+  are acquired in, as in runGEEperTile.py
+
+  Args:
+      tiles: list of WRS2 path-rows as 6-digit strings
+      config: validated config, see pull_config.py
+      locations_dir: directory of the locations partitioned by path-row, see
+      prep_locations.py
+      polygons_dir: directory of the polygon parts partitioned by path-row, see
+      prep_polygons
+
+  Returns:
+      DataFrame with tile, n_sites, n_chunks, n_polygons, n_polygon_chunks,
+      n_tasks and n_reductions (the location reductions per scene)
+  """
+  extent = config["extent"]
+  sites = read_tiles(locations_dir).set_index("WRS2_PR")["n_locations"]
+  polygons = {}
+  if extent & {"polygon", "polycenter"} and os.path.exists(os.path.join(polygons_dir, "_tiles.csv")):
+    polygons = read_tiles(polygons_dir).set_index("WRS2_PR")["n_locations"]
+  n_dswe = len(config["DSWE_setting"])
+  # harmonized runs export all sensor groups together, and sensor groups without
+  # configured sensors are not exported
+  n_stacks = 1 if config["harmonize_sensors"] else len([g for g in sensor_groups if stack_sensors(g, config)])
+  # polygon parts are exported once per polygon extent (polygon and polycenter)
+  n_polygon_extents = len(extent & {"polygon", "polycenter"})
+  counts = DataFrame({"tile": tiles})
+  counts["n_sites"] = [int(sites.get(t, 0)) if "site" in extent else 0 for t in tiles]
+  # sites are exported in groups of 10000, polygons in groups of 1000
+  counts["n_chunks"] = [math.ceil(n / 10000) for n in counts["n_sites"]]
+  counts["n_polygons"] = [int(polygons.get(t, 0)) for t in tiles]
+  counts["n_polygon_chunks"] = [math.ceil(n / 1000) for n in counts["n_polygons"]]
+  counts["n_tasks"] = ((counts["n_chunks"] + counts["n_polygon_chunks"] * n_polygon_extents)
+    * n_dswe * n_stacks + n_stacks)
+  counts["n_reductions"] = counts["n_sites"] + counts["n_polygons"] * n_polygon_extents
+  return counts
+
+
+def preflight_plan(tiles, config = None,
+  locations_dir = "b_pull_Landsat_SRST_poi/out/locations/",
+  polygons_dir = "b_pull_Landsat_SRST_poi/out/polygons/",
+  out_file = "b_pull_Landsat_SRST_poi/out/preflight_plan.csv"):
+  """ Estimate the size of a run before submitting any tasks: the number of
+  scenes, location-scene reductions (sites and polygon parts) and export tasks
+  per tile
+
+  Args:
+      tiles: list of WRS2 path-rows as 6-digit strings, or a single path-row
+      config: validated config, see pull_config.py; read with read_config() if
+      not provided
+      locations_dir: directory of the locations partitioned by path-row, see
+      prep_locations.py
+      polygons_dir: directory of the polygon parts partitioned by path-row, see
+      prep_polygons
+      out_file: file path of the cost plan .csv
+
+  Returns:
+      file path of the cost plan. Silently saves the .csv, with one row per
+      tile, and prints the totals
+  """
+  if config is None:
+    config = read_config()
+  ee.Initialize(project = config["ee_proj"])
+  # reticulate converts an R vector of length one to a str, not a list
+  if isinstance(tiles, str):
+    tiles = [tiles]
+  tiles = [str(t) for t in tiles]
+  scenes = count_scenes_per_tile(tiles, config)
+  plan = tile_locations(tiles, config, locations_dir, polygons_dir)
+  for group in sensor_groups:
+    plan["scenes_" + group] = [int(scenes[group].get(t, 0)) for t in tiles]
+    plan["reductions_" + group] = plan["n_reductions"] * plan["scenes_" + group]
+  plan = plan.drop(columns = "n_reductions")
+  plan = plan.sort_values("tile").reset_index(drop = True)
+  os.makedirs(os.path.dirname(out_file), exist_ok = True)
+  plan.to_csv(out_file, index = False)
+
+  print("Preflight for " + str(len(tiles)) + " tiles: "
+    + str(sum(plan["scenes_" + g].sum() for g in sensor_groups)) + " scenes, "
+    + str(sum(plan["reductions_" + g].sum() for g in sensor_groups)) + " location-scene reductions, "
+    + str(plan["n_tasks"].sum()) + " export tasks")
+  return out_file
+
+
+def _export_tile(description, proj):
+  """Tile of a pull or QA cache export, from its description, or None"""
+  if description.startswith("qa_cache_"):
+    return description.split("_")[2]
+  if not description.startswith(proj + "_"):
+    return None
+  # <proj>_<extent>_<stack>_C2_SRST_DSWE<n>_<tile>_<subset>_v<date> and
+  # <proj>_metadata_<stack>_C2_<tile>_v<date>
+  match = re.search(r"_(\d{6})_(?:\d+_)?v\d{4}-\d{2}-\d{2}$", description)
+  return match.group(1) if match else None
+
+
+def record_tile_durations(config = None, out_file = "b_pull_Landsat_SRST_poi/out/tile_durations.csv"):
+  """Sum the run time of each tile's completed export tasks (the slot-seconds
+  the tile held under the concurrency cap) from the Earth Engine task list, and
+  add them to the durations of earlier runs
+
+  Args:
+      config: validated config, see pull_config.py; read with read_config() if
+      not provided
+      out_file: file path of the durations .csv, read by order_tiles (see
+      durations_file in tile_schedule.py)
+
+  Returns:
+      file path of the durations .csv, with tile, seconds and n_tasks. Tiles
+      in the task list replace their earlier durations.
+  """
+  if config is None:
+    config = read_config()
+  ee.Initialize(project = config["ee_proj"])
+  seconds = {}
+  n_tasks = {}
+  for op in ee.data.listOperations():
+    meta = op.get("metadata", {})
+    if meta.get("state") != "SUCCEEDED" or "startTime" not in meta or "endTime" not in meta:
+      continue
+    tile = _export_tile(meta.get("description", ""), config["proj"])
+    if tile is None:
+      continue
+    run = (to_datetime(meta["endTime"]) - to_datetime(meta["startTime"])).total_seconds()
+    seconds[tile] = seconds.get(tile, 0) + run
+    n_tasks[tile] = n_tasks.get(tile, 0) + 1
+
+  durations = DataFrame({"tile": list(seconds), "seconds": list(seconds.values()),
+    "n_tasks": [n_tasks[t] for t in seconds]})
+  if os.path.exists(out_file):
+    earlier = read_csv(out_file, dtype = {"tile": str})
+    durations = concat([earlier[~earlier["tile"].isin(durations["tile"])], durations])
+  os.makedirs(os.path.dirname(out_file), exist_ok = True)
+  durations.sort_values("tile").to_csv(out_file, index = False)
+  print("Recorded the durations of " + str(len(seconds)) + " tiles")
+  return out_file
@@ -0,0 +1,326 @@
+import os
+import shutil
+from functools import lru_cache
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyogrio.raw
+import shapely
+from pandas import DataFrame, read_csv
+from pyproj import Transformer
+
+
+# the locations dataset is partitioned by path-row. Path-rows are read as strings
+# so that leading zeros are kept (e.g. "035032")
+locations_partitioning = ds.partitioning(pa.schema([("WRS2_PR", pa.string())]), flavor = "hive")
+
+# polygons are simplified to half a Landsat pixel, so no boundary moves by more
+# than 15 m
+polygon_simplify_m = 15
+polygon_schema = pa.schema([("id", pa.string()),
+  ("WRS2_PR", pa.string()),
+  ("part_geojson", pa.string()),
+  ("has_center", pa.bool_()),
+  ("poi_Longitude", pa.float64()),
+  ("poi_Latitude", pa.float64()),
+  ("poi_radius_m", pa.float64())])
+
+
+@lru_cache(maxsize = 2)
+def load_wrs_tiles(wrs_file = "b_pull_Landsat_SRST_poi/in/WRS2_descending.shp"):
+  """ Load the WRS2 tiles and build a spatial index of them
+
+  Args:
+      wrs_file: file path of the WRS2 descending shapefile
+
+  Returns:
+      tuple of (DataFrame of the WRS2 attributes, STRtree of the tile polygons,
+      CRS of the tiles)
+  """
+  meta, _, wkb, field_data = pyogrio.raw.read(wrs_file)
+  wrs = DataFrame({name: values for name, values in zip(meta["fields"], field_data)})
+  return wrs, shapely.STRtree(shapely.from_wkb(wkb)), meta["crs"]
+
+
+def _locations_dataset(location_file):
+  """ Open a locations file (.feather/.arrow, .parquet or .csv) as a dataset so
+  that it can be read in record batches """
+  extension = os.path.splitext(location_file)[1].lower()
+  formats = {".feather": "ipc", ".arrow": "ipc", ".parquet": "parquet", ".csv": "csv"}
+  return ds.dataset(location_file, format = formats.get(extension, "ipc"))
+
+
+def assign_pathrows(batch, tree, wrs_pr, transformer):
+  """ Add the WRS2 path-row of each location in a record batch. Locations in
+  more than one path-row are repeated, once per path-row, and locations in none
+  are dropped.
+
+  Args:
+      batch: pyarrow.RecordBatch with Latitude and Longitude columns
+      tree: STRtree of the WRS2 tile polygons
+      wrs_pr: array of the path-row of each tile in the tree
+      transformer: pyproj Transformer from the location CRS to the WRS2 CRS
+
+  Returns:
+      pyarrow.Table of the locations with a WRS2_PR column
+  """
+  x, y = transformer.transform(batch.column("Longitude").to_numpy(zero_copy_only = False),
+    batch.column("Latitude").to_numpy(zero_copy_only = False))
+  # intersects (rather than within) so locations on a tile boundary are in both
+  # tiles, as with WRS[locs, ] in {sf}
+  loc_i, tile_i = tree.query(shapely.points(x, y), predicate = "intersects")
+  table = pa.Table.from_batches([batch]).take(pa.array(loc_i))
+  return table.append_column("WRS2_PR", pa.array(wrs_pr[tile_i], type = pa.string()))
+
+
+def prep_locations(location_file, config = None,
+  out_dir = "b_pull_Landsat_SRST_poi/out/locations/",
+  wrs_file = "b_pull_Landsat_SRST_poi/in/WRS2_descending.shp",
+  batch_size = 500000):
+  """ Reformat the locations for the Landsat pull and add the WRS2 path-row(s)
+  of each location, in one streaming pass. Locations are read in record batches,
+  the latitude, longitude and unique id columns (per the config) are renamed to
+  Latitude, Longitude and id, and the locations are written to a dataset
+  partitioned by path-row, so memory use is bounded by batch_size rather than
+  the number of locations.
+
+  Args:
+      location_file: file path of the locations (.feather, .parquet or .csv)
+      config: validated config, see pull_config.py; read with read_config() if
+      not provided
+      out_dir: directory of the partitioned locations, replaced if it exists
+      wrs_file: file path of the WRS2 descending shapefile
+      batch_size: number of locations per record batch
+
+  Returns:
+      out_dir. Silently writes one WRS2_PR=<path-row> folder per tile, and
+      _tiles.csv with the WRS2 attributes and number of locations per tile
+  """
+  if config is None:
+    config = read_config()
+  wrs, tree, wrs_crs = load_wrs_tiles(wrs_file)
+  wrs_pr = wrs["PR"].astype(str).str.zfill(6).to_numpy()
+  transformer = Transformer.from_crs(config["location_crs"], wrs_crs, always_xy = True)
+  renames = {config["latitude"]: "Latitude", config["longitude"]: "Longitude",
+    config["unique_id"]: "id"}
+  counts = {}
+
+  def batches():
+    for batch in _locations_dataset(location_file).to_batches(batch_size = batch_size):
+      batch = batch.rename_columns([renames.get(n, n) for n in batch.schema.names])
+      table = assign_pathrows(batch, tree, wrs_pr, transformer)
+      for pr, n in zip(*np.unique(table.column("WRS2_PR").to_numpy(zero_copy_only = False),
+        return_counts = True)):
+        counts[pr] = counts.get(pr, 0) + int(n)
+      for out_batch in table.to_batches():
+        yield out_batch
+
+  if os.path.exists(out_dir):
+    shutil.rmtree(out_dir)
+  schema = _locations_dataset(location_file).schema
+  schema = pa.schema([schema.field(n).with_name(renames.get(n, n)) for n in schema.names]
+    + [pa.field("WRS2_PR", pa.string())])
+  ds.write_dataset(batches(), out_dir, schema = schema, format = "parquet",
+    partitioning = locations_partitioning, basename_template = "part-{i}.parquet",
+    max_rows_per_group = batch_size)
+
+  # WRS2 attributes of the tiles that have locations (the tiles to run)
+  tiles = wrs.assign(WRS2_PR = wrs_pr)
+  tiles = tiles[tiles["WRS2_PR"].isin(list(counts))].drop_duplicates("WRS2_PR")
+  tiles["n_locations"] = tiles["WRS2_PR"].map(counts)
+  tiles.sort_values("WRS2_PR").to_csv(os.path.join(out_dir, "_tiles.csv"), index = False)
+  print("Prepped " + str(sum(counts.values())) + " location-tile rows in "
+    + str(len(counts)) + " tiles")
+  return out_dir
+
+
+def read_tiles(locations_dir = "b_pull_Landsat_SRST_poi/out/locations/"):
+  """ Get the tiles that have locations, from a dataset written by prep_locations
+
+  Args:
+      locations_dir: directory of the partitioned locations
+
+  Returns:
+      DataFrame of the WRS2 attributes and n_locations per tile, with WRS2_PR as
+      6-digit strings
+  """
+  return read_csv(os.path.join(locations_dir, "_tiles.csv"), dtype = {"WRS2_PR": str})
+
+
+def read_tile_locations(tile, locations_dir = "b_pull_Landsat_SRST_poi/out/locations/"):
+  """ Read the locations of one tile from a dataset written by prep_locations.
+  Only the tile's partition is read.
+
+  Args:
+      tile: WRS2 path-row as a 6-digit string
+      locations_dir: directory of the partitioned locations
+
+  Returns:
+      DataFrame of the tile's locations
+  """
+  dataset = ds.dataset(locations_dir, format = "parquet", partitioning = locations_partitioning,
+    exclude_invalid_files = True)
+  return dataset.to_table(filter = pc.field("WRS2_PR") == str(tile)).to_pandas()
+
+
+def _utm_zones(geoms):
+  """ EPSG code of the UTM zone of the mean of each geometry's vertices (in
+  decimal degrees), as in calculate_centers_HUC4 """
+  coords, index = shapely.get_coordinates(geoms, return_index = True)
+  n_coords = np.bincount(index, minlength = len(geoms))
+  mean_x = np.bincount(index, coords[:, 0], len(geoms)) / n_coords
+  mean_y = np.bincount(index, coords[:, 1], len(geoms)) / n_coords
+  return np.where(mean_y >= 0, 32600, 32700) + np.ceil((mean_x + 180) / 6).astype(int)
+
+
+def simplify_polygons(geoms, tolerance = polygon_simplify_m):
+  """ Simplify polygons to the Landsat pixel scale and find the center and
+  radius of the largest circle that fits in each of them, in meters in the UTM
+  zone of each polygon
+
+  Args:
+      geoms: array of shapely polygons in decimal degrees (EPSG:4326)
+      tolerance: simplification tolerance in meters
+
+  Returns:
+      tuple of (array of simplified polygons in EPSG:4326, array of center
+      points in EPSG:4326, array of the circle radii in meters)
+  """
+  simple = np.empty(len(geoms), dtype = object)
+  centers = np.empty(len(geoms), dtype = object)
+  radius = np.full(len(geoms), np.nan)
+  epsg = _utm_zones(geoms)
+  for zone in np.unique(epsg):
+    i = np.flatnonzero(epsg == zone)
+    to_utm = Transformer.from_crs("EPSG:4326", "EPSG:" + str(zone), always_xy = True)
+    from_utm = Transformer.from_crs("EPSG:" + str(zone), "EPSG:4326", always_xy = True)
+    utm = shapely.make_valid(shapely.transform(geoms[i],
+      lambda c: np.column_stack(to_utm.transform(c[:, 0], c[:, 1]))))
+    circles = shapely.maximum_inscribed_circle(utm, tolerance = 1)
+    radius[i] = shapely.length(circles)
+    back = lambda c: np.column_stack(from_utm.transform(c[:, 0], c[:, 1]))
+    centers[i] = shapely.transform(shapely.get_point(circles, 0), back)
+    simple[i] = shapely.transform(shapely.simplify(utm, tolerance, preserve_topology = True), back)
+  return simple, centers, radius
+
+
+def split_by_path(geom, tile_geoms, tile_pr):
+  """ Split a polygon between the tiles of each WRS2 path it falls in, so that
+  each part of the lake is reduced in exactly one scene of an overpass. Adjacent
+  rows of a path are acquired seconds apart and overlap, so without the split
+  the overlap would be counted twice when the parts are merged. Within a path the
+  polygon is split between the tiles' Voronoi cells (by tile centroid).
+
+  Args:
+      geom: shapely polygon in EPSG:4326
+      tile_geoms: array of the polygons of the tiles the polygon intersects
+      tile_pr: array of the path-rows of those tiles
+
+  Returns:
+      list of (position in tile_pr, part of geom) tuples, for non-empty parts
+  """
+  paths = np.array([pr[0:3] for pr in tile_pr])
+  parts = []
+  for path in np.unique(paths):
+    i = np.flatnonzero(paths == path)
+    if len(i) == 1:
+      parts.append((i[0], geom))
+      continue
+    cells = shapely.get_parts(shapely.voronoi_polygons(
+      shapely.multipoints(shapely.centroid(tile_geoms[i])),
+      extend_to = geom.envelope, ordered = True))
+    for k, cell in zip(i, cells):
+      part = shapely.intersection(geom, cell)
+      if not part.is_empty and shapely.get_type_id(part) in (3, 6):
+        parts.append((k, part))
+  return parts
+
+
+def prep_polygons(config = None,
+  out_dir = "b_pull_Landsat_SRST_poi/out/polygons/",
+  wrs_file = "b_pull_Landsat_SRST_poi/in/WRS2_descending.shp",
+  batch_size = 50000):
+  """ Prepare the lake polygons for the "polygon" and "polycenter" extents, in
+  one streaming pass over the polygon file. Polygons are simplified to the pixel
+  scale, split between the tiles of each path they fall in (see split_by_path)
+  and written to a dataset partitioned by path-row, with the center and radius
+  of the largest circle that fits in each lake.
+
+  Args:
+      config: validated config, see pull_config.py; read with read_config() if
+      not provided
+      out_dir: directory of the partitioned polygons, replaced if it exists
+      wrs_file: file path of the WRS2 descending shapefile
+      batch_size: number of polygons per record batch
+
+  Returns:
+      out_dir. Silently writes one WRS2_PR=<path-row> folder per tile, with the
+      columns id, part_geojson, has_center, poi_Longitude, poi_Latitude and
+      poi_radius_m, and _tiles.csv with the number of polygon parts per tile
+  """
+  if config is None:
+    config = read_config()
+  wrs, tree, wrs_crs = load_wrs_tiles(wrs_file)
+  wrs_pr = wrs["PR"].astype(str).str.zfill(6).to_numpy()
+  poly_file = os.path.join(config["poly_dir"], config["poly_file"])
+  counts = {}
+
+  def batches(meta, reader):
+    poly_crs = config["poly_crs"] or meta["crs"]
+    to_wgs84 = Transformer.from_crs(poly_crs, "EPSG:4326", always_xy = True)
+    to_wrs = Transformer.from_crs("EPSG:4326", wrs_crs, always_xy = True)
+    for batch in reader:
+      ids = batch.column(config["unique_id"]).to_pylist()
+      geoms = shapely.from_wkb(batch.column(meta["geometry_name"] or "wkb").to_numpy(zero_copy_only = False))
+      geoms = shapely.transform(shapely.make_valid(geoms),
+        lambda c: np.column_stack(to_wgs84.transform(c[:, 0], c[:, 1])))
+      simple, centers, radius = simplify_polygons(geoms)
+      poly_i, tile_i = tree.query(shapely.transform(simple,
+        lambda c: np.column_stack(to_wrs.transform(c[:, 0], c[:, 1]))), predicate = "intersects")
+      # the tiles that the center of each polygon falls in, for the polycenter extent
+      center_tiles = set(zip(*tree.query(shapely.transform(centers,
+        lambda c: np.column_stack(to_wrs.transform(c[:, 0], c[:, 1]))), predicate = "intersects")))
+      rows = []
+      for i in np.unique(poly_i):
+        tiles_i = tile_i[poly_i == i]
+        for k, part in split_by_path(simple[i], tree.geometries[tiles_i], wrs_pr[tiles_i]):
+          rows.append({"id": str(ids[i]),
+            "WRS2_PR": wrs_pr[tiles_i[k]],
+            "part_geojson": shapely.to_geojson(part),
+            "has_center": (i, tiles_i[k]) in center_tiles,
+            "poi_Longitude": shapely.get_x(centers[i]),
+            "poi_Latitude": shapely.get_y(centers[i]),
+            "poi_radius_m": radius[i]})
+          counts[wrs_pr[tiles_i[k]]] = counts.get(wrs_pr[tiles_i[k]], 0) + 1
+      if rows:
+        yield pa.RecordBatch.from_pylist(rows, schema = polygon_schema)
+
+  if os.path.exists(out_dir):
+    shutil.rmtree(out_dir)
+  with pyogrio.raw.open_arrow(poly_file, columns = [config["unique_id"]],
+    batch_size = batch_size, force_2d = True) as (meta, reader):
+    ds.write_dataset(batches(meta, reader), out_dir, schema = polygon_schema, format = "parquet",
+      partitioning = locations_partitioning, basename_template = "part-{i}.parquet")
+  tiles = wrs.assign(WRS2_PR = wrs_pr)
+  tiles = tiles[tiles["WRS2_PR"].isin(list(counts))].drop_duplicates("WRS2_PR")
+  tiles["n_locations"] = tiles["WRS2_PR"].map(counts)
+  tiles.sort_values("WRS2_PR").to_csv(os.path.join(out_dir, "_tiles.csv"), index = False)
+  print("Prepped " + str(sum(counts.values())) + " polygon parts in "
+    + str(len(counts)) + " tiles")
+  return out_dir
+
+
+def uses_polygons(config = None):
+  """ Whether the config extent includes "polygon" or "polycenter"
+
+  Args:
+      config: validated config, see pull_config.py; read with read_config() if
+      not provided
+
+  Returns:
+      bool
+  """
+  if config is None:
+    config = read_config()
+  return bool(config["extent"] & {"polygon", "polycenter"})
@@ -0,0 +1,269 @@
+import hashlib
+import json
+import os
+from datetime import date, datetime
+from functools import lru_cache
+import yaml
+
+
+# allowed values of the settings that select what is acquired
+extent_options = {"site", "polygon", "polycenter"}
+extent_aliases = {"poly": "polygon"}
+dswe_options = {"1", "3"}
+graph_check_options = {"True", "False", "only"}
+preflight_options = {"True", "False", "only"}
+tile_order_options = {"tile", "cost"}
+export_sink_options = {"drive", "gcs", "local"}
+metadata_mode_options = {"full", "slim"}
+statistics_mode_options = {"final", "mergeable"}
+
+# settings that must be filled in, and defaults for those that are optional
+required_settings = ["unique_id", "latitude", "longitude", "location_crs",
+  "proj", "proj_folder", "ee_proj"]
+default_settings = {"start_date": "1983-01-01",
+  "end_date": "today",
+  "polygon": "False",
+  "poly_crs": "",
+  "poly_dir": "",
+  "poly_file": "",
+  "extent": "site",
+  "site_buffer": 120,
+  "buffer_sweep": "",
+  "min_valid_pixels": 0,
+  "cloud_filter": "True",
+  "cloud_thresh": 95,
+  "water_detection": "DSWE",
+  "DSWE_setting": "1",
+  "preflight": "False",
+  "tile_order": "tile",
+  "graph_check": "False",
+  "graph_max_bytes": 10000000,
+  "graph_max_nodes": 1000000,
+  "export_sink": "drive",
+  "export_format": "csv",
+  "export_bucket": "",
+  "export_path": "",
+  "harmonize_sensors": "False",
+  "sensors": "LT04, LT05, LE07, LC08, LC09",
+  "statistics_mode": "final",
+  "qa_cache": "False",
+  "qa_cache_folder": "",
+  "metadata_mode": "full",
+  "metadata_attributes": ""}
+
+
+def _as_bool(value, name, errors):
+  """Coerce a True/False yaml value (which may be a string) to a bool"""
+  if str(value) in ["True", "true", "TRUE"]:
+    return True
+  if str(value) in ["False", "false", "FALSE"]:
+    return False
+  errors.append(name + " must be True or False, not " + repr(value))
+  return None
+
+
+def _as_number(value, name, errors, minimum = None, maximum = None):
+  """Coerce a yaml value to a float within an optional range"""
+  try:
+    number = float(value)
+  except (TypeError, ValueError):
+    errors.append(name + " must be a number, not " + repr(value))
+    return None
+  if (minimum is not None and number < minimum) or (maximum is not None and number > maximum):
+    errors.append(name + " must be between " + str(minimum) + " and " + str(maximum)
+      + ", not " + repr(value))
+  return number
+
+
+def _config_date(value, name, errors):
+  """Coerce a "YYYY-MM-DD" (or "today") yaml value to a date"""
+  if isinstance(value, date):
+    return value
+  if str(value) == "today":
+    return date.today()
+  try:
+    return datetime.strptime(str(value), "%Y-%m-%d").date()
+  except ValueError:
+    errors.append(name + " must be a date as YYYY-MM-DD or 'today', not " + repr(value))
+    return None
+
+
+def _as_option_set(value, name, options, errors, aliases = {}):
+  """Split a "+"-separated yaml value into a set, checking each member"""
+  members = [aliases.get(m.strip(), m.strip()) for m in str(value).split("+")]
+  bad = [m for m in members if m not in options]
+  if bad:
+    errors.append(name + " must be one or more of " + ", ".join(sorted(options))
+      + " joined by '+', not " + repr(value))
+  return frozenset(m for m in members if m in options)
+
+
+def flatten_yaml(yml):
+  """Flatten the config yaml (sections of single key-value lists) into one
+  dictionary of settings
+
+  Args:
+      yml: dictionary of the loaded config yaml
+
+  Returns:
+      dictionary of setting name to value
+  """
+  settings = {}
+  for section in yml.values():
+    for item in section:
+      settings.update(item)
+  return settings
+
+
+def parse_config(yml_file):
+  """Read and validate the pull config yaml. All problems are collected and
+  raised together so a bad config fails before any tile is run.
+
+  Args:
+      yml_file: file path of the config yaml (e.g. config_poi.yml)
+
+  Returns:
+      dictionary of typed settings: dates as datetime.date, numbers as float,
+      True/False settings as bool, extent and DSWE_setting as frozensets,
+      buffer_sweep, sensors and metadata_attributes as lists, plus a 
+      "config_hash" of the settings
+  """
+  with open(yml_file, "r") as file:
+    settings = dict(default_settings)
+    settings.update({k: v for k, v in flatten_yaml(yaml.safe_load(file)).items()
+      if v is not None and v != ""})
+  errors = []
+  config = dict(settings)
+
+  for name in required_settings:
+    if name not in settings:
+      errors.append(name + " must be set")
+
+  config["start_date"] = _config_date(settings["start_date"], "start_date", errors)
+  config["end_date"] = _config_date(settings["end_date"], "end_date", errors)
+  if config["start_date"] and config["end_date"] and config["start_date"] > config["end_date"]:
+    errors.append("start_date must be before end_date")
+
+  config["extent"] = _as_option_set(settings["extent"], "extent", extent_options,
+    errors, extent_aliases)
+  config["DSWE_setting"] = _as_option_set(settings["DSWE_setting"], "DSWE_setting",
+    dswe_options, errors)
+  config["polygon"] = _as_bool(settings["polygon"], "polygon", errors)
+  if config["extent"] & {"polygon", "polycenter"}:
+    if not config["polygon"] or not settings["poly_file"]:
+      errors.append("polygon must be True and poly_dir and poly_file must be set when extent includes polygon or polycenter")
+    elif not os.path.exists(os.path.join(settings["poly_dir"], settings["poly_file"])):
+      errors.append("poly_file " + repr(os.path.join(settings["poly_dir"], settings["poly_file"])) + " does not exist")
+  config["site_buffer"] = _as_number(settings["site_buffer"], "site_buffer", errors, 0)
+  config["buffer_sweep"] = [_as_number(r, "buffer_sweep", errors, 1)
+    for r in str(settings["buffer_sweep"]).split(",") if r.strip()]
+  config["min_valid_pixels"] = _as_number(settings["min_valid_pixels"], "min_valid_pixels", errors, 0)
+  config["cloud_filter"] = _as_bool(settings["cloud_filter"], "cloud_filter", errors)
+  config["cloud_thresh"] = _as_number(settings["cloud_thresh"], "cloud_thresh", errors, 0, 100)
+  if settings["water_detection"] != "DSWE":
+    errors.append("water_detection must be DSWE, not " + repr(settings["water_detection"]))
+
+  config["preflight"] = str(settings["preflight"])
+  if config["preflight"] not in preflight_options:
+    errors.append("preflight must be True, False or only, not " + repr(settings["preflight"]))
+  if settings["tile_order"] not in tile_order_options:
+    errors.append("tile_order must be tile or cost, not " + repr(settings["tile_order"]))
+
+  config["graph_check"] = str(settings["graph_check"])
+  if config["graph_check"] not in graph_check_options:
+    errors.append("graph_check must be True, False or only, not " + repr(settings["graph_check"]))
+  config["graph_max_bytes"] = _as_number(settings["graph_max_bytes"], "graph_max_bytes", errors, 1)
+  config["graph_max_nodes"] = _as_number(settings["graph_max_nodes"], "graph_max_nodes", errors, 1)
+
+  if settings["export_sink"] not in export_sink_options:
+    errors.append("export_sink must be one of " + ", ".join(sorted(export_sink_options))
+      + ", not " + repr(settings["export_sink"]))
+  if settings["export_sink"] == "gcs" and not settings["export_bucket"]:
+    errors.append("export_bucket must be set when export_sink is gcs")
+  if settings["export_sink"] == "local" and not settings["export_path"]:
+    errors.append("export_path must be set when export_sink is local")
+
+  config["harmonize_sensors"] = _as_bool(settings["harmonize_sensors"], "harmonize_sensors", errors)
+  config["sensors"] = [s.strip() for s in str(settings["sensors"]).split(",") if s.strip()]
+  unknown = [s for s in config["sensors"] if s not in sensor_catalog]
+  if unknown or not config["sensors"]:
+    errors.append("sensors must be a comma-separated list of " + ", ".join(sensor_catalog)
+      + ", not " + repr(settings["sensors"]))
+  config["qa_cache"] = _as_bool(settings["qa_cache"], "qa_cache", errors)
+  if settings["statistics_mode"] not in statistics_mode_options:
+    errors.append("statistics_mode must be final or mergeable, not " + repr(settings["statistics_mode"]))
+  if settings["metadata_mode"] not in metadata_mode_options:
+    errors.append("metadata_mode must be full or slim, not " + repr(settings["metadata_mode"]))
+  config["metadata_attributes"] = [a.strip() for a in str(settings["metadata_attributes"]).split(",")
+    if a.strip()]
+  if settings["metadata_mode"] == "slim" and not config["metadata_attributes"]:
+    errors.append("metadata_attributes must be set when metadata_mode is slim")
+
+  if errors:
+    raise ValueError("Invalid config " + str(yml_file) + ":\n  - " + "\n  - ".join(errors))
+
+  config["config_hash"] = config_hash(config)
+  return config
+
+
+def _to_json_value(value):
+  """Make a config value JSON serializable in a stable form"""
+  if isinstance(value, (set, frozenset)):
+    return sorted(value)
+  if isinstance(value, date):
+    return value.isoformat()
+  return value
+
+
+def config_hash(config):
+  """Hash the settings of a config, for keying caches and manifests
+
+  Args:
+      config: dictionary returned by parse_config
+
+  Returns:
+      first 16 characters of the sha256 hex digest of the sorted settings
+  """
+  settings = {k: _to_json_value(v) for k, v in config.items() if k != "config_hash"}
+  return hashlib.sha256(json.dumps(settings, sort_keys = True).encode()).hexdigest()[:16]
+
+
+def write_config(config, out_file = "b_pull_Landsat_SRST_poi/mid/config.json"):
+  """Save a validated config for the per-tile scripts
+
+  Args:
+      config: dictionary returned by parse_config
+      out_file: file path of the .json file
+
+  Returns:
+      file path of the .json file
+  """
+  os.makedirs(os.path.dirname(out_file), exist_ok = True)
+  with open(out_file, "w") as file:
+    json.dump({k: _to_json_value(v) for k, v in config.items()}, file, indent = 2, sort_keys = True)
+  return out_file
+
+
+@lru_cache(maxsize = 4)
+def _read_config(config_file, modified):
+  """Read and re-type a config saved by write_config; cached per file version"""
+  with open(config_file, "r") as file:
+    config = json.load(file)
+  config["start_date"] = date.fromisoformat(config["start_date"])
+  config["end_date"] = date.fromisoformat(config["end_date"])
+  config["extent"] = frozenset(config["extent"])
+  config["DSWE_setting"] = frozenset(config["DSWE_setting"])
+  return config
+
+
+def read_config(config_file = "b_pull_Landsat_SRST_poi/mid/config.json"):
+  """Get the validated config saved by write_config. The file is only read
+  again if it has changed, so per-tile scripts don't re-parse it.
+
+  Args:
+      config_file: file path of the .json file
+
+  Returns:
+      dictionary of typed settings, as returned by parse_config
+  """
+  return dict(_read_config(config_file, os.path.getmtime(config_file)))
@@ -0,0 +1,285 @@
+import ee
+import hashlib
+import json
+import os
+import time
+from pandas import read_csv
+
+
+# The per-scene masks and DSWE of a tile do not depend on which locations are
+# summarized, but every location chunk (and DSWE setting) of a tile recomputes
+# them for every scene. In qa_cache mode, these layers are materialized once per
+# tile as an Earth Engine image collection asset (one image per year, with the
+# bands of each scene) over the footprints of the tile's sites, and every chunk
+# reads them from there. See scene_qa_layers in gee_functions.py.
+
+# layers of each scene in the cache, as returned by scene_qa_layers; clear and
+# clouds are re-derived from the packed qa_flags when the cache is read
+qa_cache_bands = ["qa_flags", "dswe", "hillShadow", "hillShade"]
+
+# only tiles with more locations than fit in one export chunk are cached; other
+# tiles compute their layers once anyway
+qa_cache_min_locations = 10000
+
+# increment when scene_qa_layers changes, so old caches aren't reused
+qa_cache_version = 2
+
+
+def qa_cache_key(tile, locations, config):
+  """Hash the inputs of a tile's cache: the settings that select the scenes and
+  the site footprints, and the locations of the tile
+
+  Args:
+      tile: WRS2 path-row as a 6-digit string
+      locations: DataFrame of the tile's locations, with id, Latitude and Longitude
+      config: validated config, see pull_config.py
+
+  Returns:
+      first 12 characters of the sha256 hex digest
+  """
+  settings = {"tile": str(tile),
+    "version": qa_cache_version,
+    "start_date": str(config["start_date"]),
+    "end_date": str(config["end_date"]),
+    "cloud_filter": str(config["cloud_filter"]),
+    "cloud_thresh": str(config["cloud_thresh"]),
+    "sensors": str(config["sensors"]),
+    "site_buffer": str(config["site_buffer"]),
+    "buffer_sweep": str(config["buffer_sweep"]),
+    "location_crs": str(config["location_crs"])}
+  digest = hashlib.sha256(json.dumps(settings, sort_keys = True).encode())
+  digest.update(locations[["id", "Latitude", "Longitude"]].to_csv(index = False).encode())
+  return digest.hexdigest()[:12]
+
+
+def qa_cache_asset(tile, locations, config):
+  """Asset id of the image collection that caches a tile's layers
+
+  Args:
+      tile: WRS2 path-row as a 6-digit string
+      locations: DataFrame of the tile's locations
+      config: validated config, see pull_config.py
+
+  Returns:
+      asset id, in the qa_cache_folder (by default the lakeSR_qa_cache folder of
+      the ee_proj project)
+  """
+  folder = config["qa_cache_folder"] or ("projects/" + config["ee_proj"] + "/assets/lakeSR_qa_cache")
+  return folder.rstrip("/") + "/qa_" + str(tile) + "_" + qa_cache_key(tile, locations, config)
+
+
+def _asset_info(asset_id):
+  """Metadata of an asset, or None if it doesn't exist"""
+  try:
+    return ee.data.getAsset(asset_id)
+  except ee.EEException:
+    return None
+
+
+def qa_cache_image(stack, year, region, footprint):
+  """Stack the layers of each scene of a year into one image, named
+  <LANDSAT_SCENE_ID>_<layer>, masked to the site footprints
+
+  Args:
+      stack: ee.ImageCollection of the tile's harmonized scenes (see 
+      harmonize_457 and harmonize_89)
+      year: year of the scenes
+      region: ee.Geometry of the tile, for the terrain layers
+      footprint: ee.Image, 1 within the buffered sites and masked elsewhere
+
+  Returns:
+      ee.Image of uint8 bands with a "year" property
+  """
+  scenes = stack.filter(ee.Filter.calendarRange(year, year, "year"))
+  names = (scenes.aggregate_array("LANDSAT_SCENE_ID")
+    .map(lambda k: ee.List(qa_cache_bands).map(lambda b: ee.String(k).cat("_").cat(b)))
+    .flatten())
+  layers = scenes.map(lambda image: scene_qa_layers(image, region, qa_bands_harmonized, use_cache = False)
+    .select(qa_cache_bands))
+  return layers.toBands().rename(names).updateMask(footprint).set("year", year)
+
+
+def materialize_qa_cache(tile, stack, locations, config, wait_seconds = 120):
+  """Export the cache of a tile, one image per year, and wait for the exports to
+  finish. Years that are already in the cache (e.g. from an interrupted run) are
+  not exported again. The exports are started with start_task, so they are 
+  profiled if graph_check is "True" and count towards the active task limit.
+
+  Args:
+      tile: WRS2 path-row as a 6-digit string
+      stack: ee.ImageCollection of all of the tile's harmonized scenes
+      locations: DataFrame of the tile's locations
+      config: validated config, see pull_config.py
+      wait_seconds: time to wait between checking the export tasks
+
+  Returns:
+      asset id of the cache. Raises a RuntimeError if an export fails.
+  """
+  asset_id = qa_cache_asset(tile, locations, config)
+  folder = os.path.dirname(asset_id)
+  if _asset_info(folder) is None:
+    ee.data.createAsset({"type": "FOLDER"}, folder)
+  if _asset_info(asset_id) is None:
+    ee.data.createAsset({"type": "IMAGE_COLLECTION"}, asset_id)
+  done = set(a["name"].split("/")[-1] for a in ee.data.listAssets({"parent": asset_id}).get("assets", []))
+
+  # the cache covers the bounds of the buffered sites, which can reach beyond
+  # the outline of a single scene at the edge of the tile
+  sites = csv_to_eeFeat(locations, config["location_crs"], tile).map(dp_buff)
+  region = sites.geometry().bounds()
+  footprint = ee.Image().byte().paint(sites, 1)
+  # one request for the years and pixel grid of the tile
+  info = ee.Dictionary({"years": stack.aggregate_array("system:time_start")
+      .map(lambda t: ee.Date(t).get("year")).distinct().sort(),
+    "projection": ee.Image(stack.first()).select("Blue").projection()}).getInfo()
+
+  tasks = []
+  for year in info["years"]:
+    name = "y" + str(year)
+    if name in done:
+      continue
+    description = "qa_cache_" + str(tile) + "_" + str(year)
+    task = ee.batch.Export.image.toAsset(
+      image = qa_cache_image(stack, year, region, footprint),
+      description = description,
+      assetId = asset_id + "/" + name,
+      region = region,
+      crs = info["projection"]["crs"],
+      crsTransform = info["projection"]["transform"],
+      maxPixels = 1e13,
+      pyramidingPolicy = {".default": "mode"})
+    start_task(task, description)
+    tasks.append(task)
+  print("Started " + str(len(tasks)) + " QA cache exports for tile " + str(tile))
+
+  while tasks:
+    time.sleep(wait_seconds)
+    states = [t.status()["state"] for t in tasks]
+    failed = [t.status().get("error_message", "") for t, s in zip(tasks, states) if s in ["FAILED", "CANCELLED"]]
+    if failed:
+      raise RuntimeError("QA cache export failed for tile " + str(tile) + ": " + "; ".join(failed))
+    tasks = [t for t, s in zip(tasks, states) if s != "COMPLETED"]
+  ee.data.setAssetProperties(asset_id, {"complete": 1, "n_years": len(info["years"])})
+  return asset_id
+
+
+def tile_qa_cache(tile, stack, locations, config):
+  """Get the QA cache of a tile, materializing it first if needed
+
+  Args:
+      tile: WRS2 path-row as a 6-digit string
+      stack: ee.ImageCollection of all of the tile's harmonized scenes
+      locations: DataFrame of the tile's locations
+      config: validated config, see pull_config.py
+
+  Returns:
+      ee.ImageCollection of the cache, or None if qa_cache is False, the tile
+      has too few locations to be cached or graph_check is "only" (no exports
+      are started, so there is no cache to wait for)
+  """
+  if not config["qa_cache"] or len(locations) <= qa_cache_min_locations:
+    return None
+  if config["graph_check"] == "only":
+    return None
+  asset_id = qa_cache_asset(tile, locations, config)
+  info = _asset_info(asset_id)
+  if info is None or info.get("properties", {}).get("complete") != 1:
+    materialize_qa_cache(tile, stack, locations, config)
+  return ee.ImageCollection(asset_id)
+
+
+def qa_cache_row_check(tile, stack, locations, cache, config, dswe_value = "1", n_scenes = 5):
+  """Check that a tile's first location chunk gets the same number of site rows
+  with and without its QA cache, e.g. after materializing a cache for a new 
+  tile. Needs an initialized ee session and the settings of runGEEperTile.py 
+  (site_buffers, statistics_mode, ...); feat and qa_cache are restored 
+  afterwards.
+
+  Args:
+      tile: WRS2 path-row as a 6-digit string
+      stack: ee.ImageCollection of the tile's harmonized scenes
+      locations: DataFrame of the tile's locations
+      cache: ee.ImageCollection of the tile's cache, see tile_qa_cache
+      config: validated config, see pull_config.py
+      dswe_value: DSWE setting of the pull, "1" or "3"
+      n_scenes: number of scenes of the stack to pull
+
+  Returns:
+      dictionary of the row counts "cached" and "uncached". Raises a 
+      RuntimeError if they differ.
+  """
+  global feat, qa_cache
+  saved = (globals().get("feat"), globals().get("qa_cache"))
+  feat = csv_to_eeFeat(locations[:10000], config["location_crs"], tile).map(dp_buff)
+  scenes = stack.limit(n_scenes)
+  pull = stack_catalog["LS45789"]["pulls"][dswe_value]
+  counts = {}
+  try:
+    # the pull reads feat and qa_cache when it is mapped over the scenes
+    for name, c in [("uncached", None), ("cached", cache)]:
+      qa_cache = c
+      counts[name] = scenes.map(pull).flatten().filter(ee.Filter.notNull(["med_Blue"])).size()
+  finally:
+    feat, qa_cache = saved
+  counts = ee.Dictionary(counts).getInfo()
+  if counts["cached"] != counts["uncached"]:
+    raise RuntimeError("QA cache of tile " + str(tile) + " gives " + str(counts["cached"])
+      + " site rows, " + str(counts["uncached"]) + " without the cache")
+  return counts
+
+
+def qa_cache_report(plan_file = "b_pull_Landsat_SRST_poi/out/preflight_plan.csv",
+  out_file = "b_pull_Landsat_SRST_poi/out/qa_cache_report.csv", config = None):
+  """Report the compute saved by the QA cache on each cached tile. The layers of
+  each scene are computed once per export without the cache (every location
+  chunk, DSWE setting and sensor stack) and once per tile with it. The EECU
+  seconds of the tile's cache and site exports are added from the Earth Engine
+  task list, so cached and uncached runs of a tile can be compared.
+
+  Args:
+      plan_file: cost plan written by preflight_plan
+      out_file: file path of the report .csv
+      config: validated config, see pull_config.py; read with read_config() if
+      not provided
+
+  Returns:
+      file path of the report. Silently saves the .csv, with one row per tile
+      with more than qa_cache_min_locations locations, densest first
+  """
+  if config is None:
+    config = read_config()
+  ee.Initialize(project = config["ee_proj"])
+  plan = read_csv(plan_file, dtype = {"tile": str})
+  plan = plan[plan["n_sites"] > qa_cache_min_locations].copy()
+  scenes = plan[[c for c in plan.columns if c.startswith("scenes_")]].sum(axis = 1)
+  n_dswe = len(config["DSWE_setting"])
+  plan["scene_layers_uncached"] = scenes * plan["n_chunks"] * n_dswe
+  plan["scene_layers_cached"] = scenes
+  plan["scene_layers_saved"] = plan["scene_layers_uncached"] - plan["scene_layers_cached"]
+
+  # EECU seconds of the completed exports, by tile
+  eecu_cache = {}
+  eecu_sites = {}
+  for op in ee.data.listOperations():
+    meta = op.get("metadata", {})
+    if meta.get("state") != "SUCCEEDED":
+      continue
+    description = meta.get("description", "")
+    eecu = float(meta.get("batchEecuUsageSeconds", 0))
+    for tile in plan["tile"]:
+      if description.startswith("qa_cache_" + tile + "_"):
+        eecu_cache[tile] = eecu_cache.get(tile, 0) + eecu
+      elif "_point_" in description and "_" + tile + "_" in description:
+        eecu_sites[tile] = eecu_sites.get(tile, 0) + eecu
+  plan["eecu_qa_cache"] = [eecu_cache.get(t, 0) for t in plan["tile"]]
+  plan["eecu_site_exports"] = [eecu_sites.get(t, 0) for t in plan["tile"]]
+
+  report = plan[["tile", "n_sites", "n_chunks", "scene_layers_uncached",
+    "scene_layers_cached", "scene_layers_saved", "eecu_qa_cache",
+    "eecu_site_exports"]].sort_values("n_sites", ascending = False)
+  os.makedirs(os.path.dirname(out_file), exist_ok = True)
+  report.to_csv(out_file, index = False)
+  print("QA cache on " + str(len(report)) + " tiles avoids "
+    + str(int(report["scene_layers_saved"].sum())) + " of "
+    + str(int(report["scene_layers_uncached"].sum())) + " scene layer computations")
+  return out_file
@@ -0,0 +1,150 @@
+import time
+import numpy as np
+
+
+# The Landsat QA bands are decoded once per scene into a single packed uint8
+# "qa_flags" band (decode_qa in gee_functions.py, decode_qa_numpy for local
+# runs). Bits of qa_flags:
+#   0 - dilated cloud (QA_PIXEL bit 1)
+#   1 - cloud (QA_PIXEL bit 3)
+#   2 - cloud shadow (QA_PIXEL bit 4)
+#   3 - snow (QA_PIXEL bit 5)
+#   4 - radiometric saturation in any band (QA_RADSAT != 0)
+#   5 - SR cloud, cloud shadow, adjacent cloud or snow (SR_CLOUD_QA bits 1-4,
+#       Landsat 4-7)
+#   6 - medium or high aerosol (SR_QA_AEROSOL bit 7, Landsat 8 and 9)
+# A pixel is "clear" when none of bits 0-5 are set, and "clouds" when any of
+# bits 0-3 are set.
+qa_clear_bits = 0b111111
+qa_cloud_bits = 0b1111
+
+# QA bands of each stack, as named in runGEEperTile.py
+qa_bands_457 = ["pixel_qa", "radsat_qa", "cloud_qa"]
+qa_bands_89 = ["pixel_qa", "radsat_qa", "aerosol_qa"]
+qa_bands_harmonized = ["pixel_qa", "radsat_qa", "cloud_qa", "aerosol_qa"]
+
+
+def decode_qa_numpy(pixel_qa, radsat_qa, cloud_qa = None, aerosol_qa = None):
+  """Decode Landsat QA arrays into the packed flags, the same as decode_qa does
+  in Earth Engine
+
+  Args:
+      pixel_qa: integer array of QA_PIXEL values
+      radsat_qa: integer array of QA_RADSAT values
+      cloud_qa: integer array of SR_CLOUD_QA values (Landsat 4-7), or None
+      aerosol_qa: integer array of SR_QA_AEROSOL values (Landsat 8 and 9), or
+      None
+
+  Returns:
+      tuple of (uint8 array of qa_flags, bool array of clear pixels, bool array
+      of cloudy pixels)
+  """
+  pixel_qa = np.asarray(pixel_qa)
+  flags = ((pixel_qa >> 1) & 1) | ((pixel_qa >> 2) & 0b1110)
+  flags = flags | ((np.asarray(radsat_qa) != 0) << 4)
+  if cloud_qa is not None:
+    flags = flags | (((np.asarray(cloud_qa) & 0b11110) != 0) << 5)
+  if aerosol_qa is not None:
+    flags = flags | (((np.asarray(aerosol_qa) >> 7) & 1) << 6)
+  flags = flags.astype(np.uint8)
+  return flags, (flags & qa_clear_bits) == 0, (flags & qa_cloud_bits) != 0
+
+
+def _decode_qa_per_mask(pixel_qa, radsat_qa, cloud_qa):
+  """Reference for the benchmark and tests: the cfmask, SR cloud and radsat classes as the
+  pulls built them from each QA band before decode_qa (see profile_qa_masks),
+  then the clear mask derived from them"""
+  f = np.where(pixel_qa & (1 << 1), 1, 0)
+  f = np.where(pixel_qa & (1 << 3), 2, f)
+  f = np.where(pixel_qa & (1 << 4), 3, f)
+  f = np.where(pixel_qa & (1 << 5), 4, f)
+  s = np.where(cloud_qa & (1 << 1), 1, 0)
+  s = np.where(cloud_qa & (1 << 2), 2, s)
+  s = np.where(cloud_qa & (1 << 3), 3, s)
+  s = np.where(cloud_qa & (1 << 4), 4, s)
+  r = radsat_qa == 0
+  clear = (f == 0) & r & (s == 0)
+  return clear, f >= 1
+
+
+def random_qa(n_pixels, seed = 1):
+  """Simulate Landsat 4-7 QA bands with realistic bit frequencies
+
+  Args:
+      n_pixels: number of pixels
+      seed: random seed
+
+  Returns:
+      tuple of uint16 arrays (pixel_qa, radsat_qa, cloud_qa)
+  """
+  rng = np.random.default_rng(seed)
+  bits = lambda p: (rng.random(n_pixels) < p).astype(np.uint16)
+  pixel_qa = ((bits(0.1) << 1) | (bits(0.15) << 3) | (bits(0.05) << 4)
+    | (bits(0.02) << 5) | (bits(0.6) << 7)).astype(np.uint16)
+  radsat_qa = (bits(0.01) * rng.integers(1, 256, n_pixels)).astype(np.uint16)
+  cloud_qa = ((bits(0.1) << 1) | (bits(0.05) << 2) | (bits(0.1) << 3)
+    | (bits(0.02) << 4) | (bits(0.3) << 5)).astype(np.uint16)
+  return pixel_qa, radsat_qa, cloud_qa
+
+
+def benchmark_qa_decode(n_pixels = 10000000, n_reps = 5):
+  """Benchmark the local (NumPy) throughput of the packed QA decoder against
+  decoding each mask separately. See profile_qa_masks for the number of Earth
+  Engine operations of each way of building the masks.
+
+  Args:
+      n_pixels: number of simulated pixels
+      n_reps: number of repetitions, the fastest is reported
+
+  Returns:
+      dictionary of the throughput of each decoder in millions of pixels per
+      second
+  """
+  pixel_qa, radsat_qa, cloud_qa = random_qa(n_pixels)
+  result = {}
+  for name, fun in [["per_mask", _decode_qa_per_mask], ["packed", decode_qa_numpy]]:
+    times = []
+    for i in range(n_reps):
+      start = time.perf_counter()
+      fun(pixel_qa, radsat_qa, cloud_qa)
+      times.append(time.perf_counter() - start)
+    result[name + "_mpix_per_s"] = n_pixels / min(times) / 1e6
+  return result
+
+
+def profile_qa_masks(image_id = "LANDSAT/LT05/C02/T1_L2/LT05_044034_20110716"):
+  """Count the Earth Engine operations of the masks of a Landsat 4-7 site pull,
+  built from each QA mask separately (as before decode_qa) and from the packed
+  QA flags of decode_qa. Needs an initialized ee session; ee is imported by
+  gee_functions.py, so the local decoder above needs only NumPy.
+
+  Args:
+      image_id: id of a Landsat 4-7 Collection 2 level 2 scene
+
+  Returns:
+      dictionary of the number of expanded expression graph nodes of each way
+      of building the masks
+  """
+  image = ee.Image(image_id).select(
+    ["QA_PIXEL", "QA_RADSAT", "SR_CLOUD_QA", "SR_B2"], ["pixel_qa", "radsat_qa", "cloud_qa", "Blue"])
+  # the cfmask, radsat and SR cloud classes as the pulls built them before 
+  # decode_qa; each mask is applied to pCount, dswe1, dswe3 and img_mask 
+  # separately
+  qa = image.select("pixel_qa")
+  f = (qa.bitwiseAnd(1 << 1)
+    .where(qa.bitwiseAnd(1 << 3), ee.Image(2))
+    .where(qa.bitwiseAnd(1 << 4), ee.Image(3))
+    .where(qa.bitwiseAnd(1 << 5), ee.Image(4)))
+  r = image.select("radsat_qa").eq(0)
+  sr = image.select("cloud_qa")
+  s = (sr.bitwiseAnd(1 << 1)
+    .where(sr.bitwiseAnd(1 << 2), ee.Image(2))
+    .where(sr.bitwiseAnd(1 << 3), ee.Image(3))
+    .where(sr.bitwiseAnd(1 << 4), ee.Image(4)))
+  d = image.select("Blue").gt(0)
+  per_mask = [d.updateMask(f.eq(0)).updateMask(r.eq(1)).updateMask(s.eq(0)) for i in range(4)]
+  per_mask = ee.Image.cat(per_mask + [f.gte(1)])
+  layers = decode_qa(image, qa_bands_457)
+  packed = ee.Image.cat([d.updateMask(layers.select("clear")) for i in range(4)] + [layers.select("clouds")])
+  return {"per_mask_ee_nodes": profile_ee_request(per_mask)["expanded_nodes"],
+    "packed_ee_nodes": profile_ee_request(packed)["expanded_nodes"]}
@@ -0,0 +1,34 @@
+"""Worker of replay_windows in scene_windows.py. The pipeline's modules are run
+with reticulate's source_python in one __main__ namespace, so their functions
+can't be pickled to the processes of a pool. This module is imported by name
+(not sourced) in the pool's processes, and runs the modules that the replay
+needs in its own namespace.
+"""
+
+
+# namespace of the modules run by load_modules
+namespace = {"__name__": "replay_worker_modules"}
+
+
+def load_modules(paths, settings):
+  """Run module files in the worker's namespace, as source_python does. This is
+  the pool's initializer.
+
+  Args:
+      paths: file paths of the modules, in the order they are sourced
+      settings: dictionary of globals to set before the modules are run (e.g.
+      dswe_thresholds, which is defined in gee_functions.py)
+
+  Returns:
+      None
+  """
+  namespace.update(settings)
+  for path in paths:
+    with open(path, "r") as file:
+      exec(compile(file.read(), path, "exec"), namespace)
+
+
+def replay_scene(*job):
+  """Replay the site pull on the cached windows of one scene, see _replay_scene
+  in scene_windows.py"""
+  return namespace["_replay_scene"](*job)
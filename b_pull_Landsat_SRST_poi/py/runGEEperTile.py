@@ -1,387 +1,257 @@
 #import modules
 import ee
+import json
 import time
 from datetime import date, datetime
 import os 
 import fiona
-from pandas import read_csv, read_feather
 import math
 
-# get locations and yml from data folder
-yml = read_csv("b_pull_Landsat_SRST_poi/mid/yml.csv")
+# get the validated config (written by the validated_config_poi target)
+config = read_config()
 
-eeproj = yml["ee_proj"][0]
+eeproj = config["ee_proj"]
 #initialize GEE
 ee.Initialize(project = eeproj)
 
-# get EE/Google settings from yml file
-proj = yml["proj"][0]
-proj_folder = yml["proj_folder"][0]
-
-# get/save start date
-yml_start = yml["start_date"][0]
-yml_end = yml["end_date"][0]
-
-# set yml_end as date
-if yml_end == "today":
-  yml_end = date.today().strftime("%Y-%m-%d")
+# get EE/Google settings from config
+proj = config["proj"]
+proj_folder = config["proj_folder"]
 
 # gee processing settings
-buffer = yml["site_buffer"][0]
-cloud_filt = yml["cloud_filter"][0]
-cloud_thresh = yml["cloud_thresh"][0]
-
-# get and format dswe value
-try: 
-  dswe = yml["DSWE_setting"][0].astype(str)
-except AttributeError: 
-  dswe = yml["DSWE_setting"][0]
-
-# get extent info
-extent = yml["extent"][0]
+buffer = config["site_buffer"]
+# buffer radii of the site pulls - with a buffer_sweep, every radius is 
+# summarized from one read of the pixels within the largest (see reduce_sites)
+site_buffers = sorted(set([buffer] + config["buffer_sweep"]))
+buffer_selectors = ["buffer_m"] if len(site_buffers) > 1 else []
+cloud_filt = config["cloud_filter"]
+cloud_thresh = config["cloud_thresh"]
+
+# minimum number of valid pixels for a site to be summarized in an image
+min_valid_pixels = config["min_valid_pixels"]
+
+# set of DSWE classes to acquire ("1" and/or "3")
+dswe = config["DSWE_setting"]
+
+# set of extents to acquire ("site", "polygon" and/or "polycenter")
+extent = config["extent"]
+
+# harmonized Landsat 4-9 setting - if True, all sensors are extracted in a 
+# single stack with one export per tile/location subset/DSWE setting
+harmonize = config["harmonize_sensors"]
+
+# statistics mode - in "mergeable" mode, site and polygon exports also carry 
+# sufficient statistics that can be recombined with merge_stats.py
+statistics_mode = config["statistics_mode"]
+
+# metadata settings - in "slim" mode, only the listed scene attributes are 
+# exported (see collate_scene_metadata to make the global scene table)
+if config["metadata_mode"] == "slim":
+  meta_selectors = ["system:index"] + config["metadata_attributes"]
+else:
+  meta_selectors = None
+
+# export settings, see export_sinks.py
+export_sink = config["export_sink"]
+export_format = config["export_format"]
+export_bucket = config["export_bucket"]
+export_path = config["export_path"]
+
+# expression graph profiling settings, see ee_graph_profile.py
+graph_check = config["graph_check"]
+graph_max_bytes = config["graph_max_bytes"]
+graph_max_nodes = config["graph_max_nodes"]
 
 # get current tile
 with open("b_pull_Landsat_SRST_poi/out/current_tile.txt", "r") as file:
   tiles = file.read()
 
-# read in locations file
-locations = read_feather("b_pull_Landsat_SRST_poi/out/locations_with_WRS2_pathrows_latlon.feather")
-# and subset for the current tile
-locations_subset = locations.query( "`WRS2_PR` == @tiles")
+# read in the locations of the current tile (only the tile's partition is read)
+locations_subset = read_tile_locations(tiles)
 
 ##############################################
 ##---- CREATING EE FEATURECOLLECTIONS   ----##
 ##############################################
 
-# store path and row for subsetting the stacks so there is not overlap between PR pulls
-w_p = int(str(tiles)[0:3])
-w_r = int(str(tiles)[3:6])
-
-#grab images and apply scaling factors
-l7 = (ee.ImageCollection("LANDSAT/LE07/C02/T1_L2")
-    .filter(ee.Filter.lt("CLOUD_COVER", ee.Number.parse(str(cloud_thresh))))
-    .filterDate(yml_start, yml_end)
-    .filter(ee.Filter.eq("WRS_PATH", w_p))
-    .filter(ee.Filter.eq("WRS_ROW", w_r))
-    .map(apply_scale_factors))
-l5 = (ee.ImageCollection("LANDSAT/LT05/C02/T1_L2")
-    .filter(ee.Filter.lt("CLOUD_COVER", ee.Number.parse(str(cloud_thresh))))
-    .filterDate(yml_start, yml_end)
-    .filter(ee.Filter.eq("WRS_PATH", w_p))
-    .filter(ee.Filter.eq("WRS_ROW", w_r))
-    .map(apply_scale_factors))
-l4 = (ee.ImageCollection("LANDSAT/LT04/C02/T1_L2")
-    .filter(ee.Filter.lt("CLOUD_COVER", ee.Number.parse(str(cloud_thresh))))
-    .filterDate(yml_start, yml_end)
-    .filter(ee.Filter.eq("WRS_PATH", w_p))
-    .filter(ee.Filter.eq("WRS_ROW", w_r))
-    .map(apply_scale_factors))
-    
-# merge collections by image processing groups
-ls457 = ee.ImageCollection(l4.merge(l5).merge(l7))
-    
-# existing band names
-bn457 = (["SR_B1", "SR_B2", "SR_B3", "SR_B4", "SR_B5", "SR_B7", 
-  "QA_PIXEL", "SR_CLOUD_QA", "QA_RADSAT", "ST_B6", 
-  "ST_QA", "ST_CDIST", "ST_ATRAN", "ST_DRAD", "ST_EMIS",
-  "ST_EMSD", "ST_TRAD", "ST_URAD"])
-  
-# new band names
-bns457 = (["Blue", "Green", "Red", "Nir", "Swir1", "Swir2", 
-  "pixel_qa", "cloud_qa", "radsat_qa", "SurfaceTemp", 
-  "temp_qa", "ST_CDIST", "ST_ATRAN", "ST_DRAD", "ST_EMIS",
-  "ST_EMSD", "ST_TRAD", "ST_URAD"])
-  
-# rename bands  
-ls457 = ls457.select(bn457, bns457)
-
-
-#grab images and apply scaling factors
-l8 = (ee.ImageCollection("LANDSAT/LC08/C02/T1_L2")
-    .filter(ee.Filter.lt("CLOUD_COVER", ee.Number.parse(str(cloud_thresh))))
-    .filterDate(yml_start, yml_end)
-    .filter(ee.Filter.eq("WRS_PATH", w_p))
-    .filter(ee.Filter.eq("WRS_ROW", w_r))
-    .map(apply_scale_factors))
-l9 = (ee.ImageCollection("LANDSAT/LC09/C02/T1_L2")
-    .filter(ee.Filter.lt("CLOUD_COVER", ee.Number.parse(str(cloud_thresh))))
-    .filterDate(yml_start, yml_end)
-    .filter(ee.Filter.eq("WRS_PATH", w_p))
-    .filter(ee.Filter.eq("WRS_ROW", w_r))
-    .map(apply_scale_factors))
-
-# merge collections by image processing groups
-ls89 = ee.ImageCollection(l8.merge(l9))
-    
-# existing band names
-bn89 = (["SR_B1", "SR_B2", "SR_B3", "SR_B4", "SR_B5", "SR_B6", "SR_B7", 
-  "QA_PIXEL", "SR_QA_AEROSOL", "QA_RADSAT", "ST_B10", 
-  "ST_QA", "ST_CDIST", "ST_ATRAN", "ST_DRAD", "ST_EMIS",
-  "ST_EMSD", "ST_TRAD", "ST_URAD"])
-  
-# new band names
-bns89 = (["Aerosol","Blue", "Green", "Red", "Nir", "Swir1", "Swir2",
-  "pixel_qa", "aerosol_qa", "radsat_qa", "SurfaceTemp", 
-  "temp_qa", "ST_CDIST", "ST_ATRAN", "ST_DRAD", "ST_EMIS",
-  "ST_EMSD", "ST_TRAD", "ST_URAD"])
- 
-# rename bands  
-ls89 = ls89.select(bn89, bns89)
+# filtered, scaled and renamed scenes of each stack, built from the sensor 
+# catalog (see sensor_catalog.py) - one harmonized stack, or one stack per 
+# sensor group. Stacks without configured sensors, or without scenes in this 
+# tile's preflight plan, are skipped.
+scene_counts = planned_scenes(tiles, config)
+stacks = {}
+for stack in (["LS45789"] if harmonize else ["LS457", "LS89"]):
+  collection = stack_collection(stack, tiles, config)
+  if collection is None or scene_counts.get(stack, 1) == 0:
+    print("Skipping " + stack_catalog[stack]["label"] + " at tile " + str(tiles)
+      + ", no configured sensors or scenes")
+    continue
+  stacks[stack] = collection
+
+# scene-level QA cache - for tiles with more than one location subset, the 
+# per-scene masks, DSWE and terrain layers are materialized once and read by 
+# every subset (None if qa_cache is False or the tile is not dense enough), see
+# qa_cache.py. The cache is built from the harmonized bands so both sensor groups
+# share one packed QA layout. Only site pulls read the cache, so it is not built
+# if the extent doesn't include "site"
+if "site" in extent:
+  qa_cache = tile_qa_cache(tiles, stack_collection("LS45789", tiles, config), 
+    locations_subset, config)
+else:
+  qa_cache = None
 
 # need to break up locations into smaller groups for export
 for loc_10k in range(math.ceil(len(locations_subset)/10000)):
   locs_10k = locations_subset[loc_10k * 10000:((loc_10k + 1) * 10000)]
 
   # convert locations to an eeFeatureCollection
-  locs_feature = csv_to_eeFeat(locs_10k, yml["location_crs"][0], tiles)
+  locs_feature = csv_to_eeFeat(locs_10k, config["location_crs"], tiles)
 
-  ##########################################
-  ##---- LANDSAT 457 SITE ACQUISITION ----##
-  ##########################################
+  ######################################
+  ##---- LANDSAT SITE ACQUISITION ----##
+  ######################################
   
-  ## run the pull for LS457
   if "site" in extent:
     
     ## get locs feature and buffer ##
     feat = locs_feature.map(dp_buff)
-
-    # map the refpull function across the "stack", flatten to an array
-    if "1" in dswe:
-      print("Starting Landsat 4, 5, 7 DSWE1 acquisition for site locations at tile "
-        + str(tiles)
-        + " and location subset "
-        + str(loc_10k))
-      locs_out_457_D1 = ls457.map(ref_pull_457_DSWE1).flatten()
-      locs_out_457_D1 = locs_out_457_D1.filter(ee.Filter.notNull(["med_Blue"]))
-      locs_srname_457_D1 = (proj 
-        + "_point_LS457_C2_SRST_DSWE1_" 
-        + str(tiles)
-        + "_" + str(loc_10k)
-        +"_v" + str(date.today()))
-      locs_dataOut_457_D1 = (ee.batch.Export.table.toDrive(collection = locs_out_457_D1,
-                                              description = locs_srname_457_D1,
-                                              folder = proj_folder,
-                                              fileFormat = "csv",
-                                              selectors = ["system:index",
-                                              "med_Blue", "med_Green", "med_Red", "med_Nir", "med_Swir1", "med_Swir2", 
-                                              "med_SurfaceTemp", "med_temp_qa", "med_atran", "med_drad", "med_emis",
-                                              "med_emsd", "med_trad", "med_urad",
-                                              "min_SurfaceTemp", "min_cloud_dist",
-                                              "sd_Blue", "sd_Green", "sd_Red", "sd_Nir", "sd_Swir1", "sd_Swir2", "sd_SurfaceTemp",
-                                              "mean_Blue", "mean_Green", "mean_Red", "mean_Nir", "mean_Swir1", "mean_Swir2", 
-                                              "mean_SurfaceTemp",
-                                              "kurt_SurfaceTemp", 
-                                              "pCount_dswe_gt0", "pCount_dswe1", "pCount_dswe3", 
-                                              "prop_clouds","prop_hillShadow","mean_hillShade"]))
-      #Check how many existing tasks are running and take a break of 120 secs if it's >10 
-      maximum_no_of_tasks(10, 120)
-      #Send next task.                                        
-      locs_dataOut_457_D1.start()
-      print("Completed Landsat 4, 5, 7 DSWE 1 stack acquisitions for site location at tile "
-        + str(tiles)
-        + " and location subset "
-        + str(loc_10k))
-    
-    else: print("Not configured to acquire DSWE 1 stack for Landsat 4, 5, 7 for sites at this location subset.")
-    
-    if "3" in dswe:
-      print("Starting Landsat 4, 5, 7 DSWE3 acquisition for site locations at tile " 
-        + str(tiles)        
-        + " and location subset "
-        + str(loc_10k))
-      locs_out_457_D3 = ls457.map(ref_pull_457_DSWE3).flatten()
-      locs_out_457_D3 = locs_out_457_D3.filter(ee.Filter.notNull(["med_Blue"]))
-      locs_srname_457_D3 = (proj
-        + "_point_LS457_C2_SRST_DSWE3_" 
-        + str(tiles)
-        + "_" + str(loc_10k)
-        +"_v" + str(date.today()))
-      locs_dataOut_457_D3 = (ee.batch.Export.table.toDrive(collection = locs_out_457_D3,
-                                              description = locs_srname_457_D3,
-                                              folder = proj_folder,
-                                              fileFormat = "csv",
-                                              selectors = ["system:index",
-                                              "med_Blue", "med_Green", "med_Red", "med_Nir", "med_Swir1", "med_Swir2", 
-                                              "med_SurfaceTemp", "med_temp_qa", "med_atran", "med_drad", "med_emis",
-                                              "med_emsd", "med_trad", "med_urad",
-                                              "min_SurfaceTemp", "min_cloud_dist",
-                                              "sd_Blue", "sd_Green", "sd_Red", "sd_Nir", "sd_Swir1", "sd_Swir2", "sd_SurfaceTemp",
-                                              "mean_Blue", "mean_Green", "mean_Red", "mean_Nir", "mean_Swir1", "mean_Swir2", 
-                                              "mean_SurfaceTemp",
-                                              "kurt_SurfaceTemp", 
-                                              "pCount_dswe_gt0", "pCount_dswe1", "pCount_dswe3",
-                                              "prop_clouds","prop_hillShadow","mean_hillShade"]))
-      #Check how many existing tasks are running and take a break of 120 secs if it's >10 
-      maximum_no_of_tasks(10, 120)
-      #Send next task.                                        
-      locs_dataOut_457_D3.start()
-      print("Completed Landsat 4, 5, 7 DSWE 3 stack acquisitions for site location at tile "
-        + str(tiles)
-        + " and location subset "
-        + str(loc_10k))
-    
-    else: print("Not configured to acquire DSWE 3 stack for Landsat 4, 5, 7 for sites at this location subset.")
-  
-  else: 
-    print("No sites to extract Landsat 4, 5, 7 at "
-      + str(tiles)
-      + 'and location subset '
-      + str(loc_10k))
-  
-  
-  
-  #########################################
-  ##---- LANDSAT 89 SITE ACQUISITION ----##
-  #########################################
-  
-  if "site" in extent:
-  
-    ## get locs feature and buffer ##
-    feat = locs_feature.map(dp_buff)
     
-    if "1" in dswe:
-      print("Starting Landsat 8, 9 DSWE1 acquisition for site locations at tile "
-        + str(tiles)
-        + " and location subset "
-        + str(loc_10k))
-      locs_out_89_D1 = ls89.map(ref_pull_89_DSWE1).flatten()
-      locs_out_89_D1 = locs_out_89_D1.filter(ee.Filter.notNull(["med_Blue"]))
-      locs_srname_89_D1 = (proj
-        + "_point_LS89_C2_SRST_DSWE1_"
-        + str(tiles)
-        + "_" + str(loc_10k)
-        + "_v" + str(date.today()))
-      locs_dataOut_89_D1 = (ee.batch.Export.table.toDrive(collection = locs_out_89_D1,
-                                              description = locs_srname_89_D1,
-                                              folder = proj_folder,
-                                              fileFormat = "csv",
-                                              selectors = ["system:index",
-                                              "med_Aerosol", "med_Blue", "med_Green", "med_Red", "med_Nir", "med_Swir1", "med_Swir2", 
-                                              "med_SurfaceTemp", "med_temp_qa", "med_atran", "med_drad", "med_emis",
-                                              "med_emsd", "med_trad", "med_urad",
-                                              "min_SurfaceTemp", "min_cloud_dist",
-                                              "sd_Aerosol", "sd_Blue", "sd_Green", "sd_Red", "sd_Nir", "sd_Swir1", "sd_Swir2", "sd_SurfaceTemp",
-                                              "mean_Aerosol", "mean_Blue", "mean_Green", "mean_Red", "mean_Nir", "mean_Swir1", "mean_Swir2", 
-                                              "mean_SurfaceTemp",
-                                              "kurt_SurfaceTemp", 
-                                              "pCount_dswe_gt0", "pCount_dswe1", "pCount_dswe3","pCount_medHighAero", 
-                                              "prop_clouds","prop_hillShadow","mean_hillShade"]))
-      #Check how many existing tasks are running and take a break of 120 secs if it's >10 
-      maximum_no_of_tasks(10, 120)
-      #Send next task.                                        
-      locs_dataOut_89_D1.start()
-      print("Completed Landsat 8, 9 DSWE 1 stack acquisitions for site location at tile " 
-        + str(tiles)
-        + " and location subset "
-        + str(loc_10k))
-    
-    else: print("Not configured to acquire DSWE 1 stack for Landsat 8, 9 for sites at this location subset.")
-    
-    if "3" in dswe:
-      print("Starting Landsat 8, 9 DSWE3 acquisition for site locations at tile "
-        + str(tiles)
-        + " and location subset "
-        + str(loc_10k))
-      locs_out_89_D3 = ls89.map(ref_pull_89_DSWE3).flatten()
-      locs_out_89_D3 = locs_out_89_D3.filter(ee.Filter.notNull(["med_Blue"]))
-      locs_srname_89_D3 = (proj
-        + "_point_LS89_C2_SRST_DSWE3_"
-        + str(tiles)
-        + "_" + str(loc_10k)
-        + "_v" + str(date.today()))
-      locs_dataOut_89_D3 = (ee.batch.Export.table.toDrive(collection = locs_out_89_D3,
-                                              description = locs_srname_89_D3,
-                                              folder = proj_folder,
-                                              fileFormat = "csv",
-                                              selectors = ["system:index",
-                                              "med_Aerosol", "med_Blue", "med_Green", "med_Red", "med_Nir", "med_Swir1", "med_Swir2", 
-                                              "med_SurfaceTemp", "med_temp_qa", "med_atran", "med_drad", "med_emis",
-                                              "med_emsd", "med_trad", "med_urad",
-                                              "min_SurfaceTemp", "min_cloud_dist",
-                                              "sd_Aerosol", "sd_Blue", "sd_Green", "sd_Red", "sd_Nir", "sd_Swir1", "sd_Swir2", "sd_SurfaceTemp",
-                                              "mean_Aerosol", "mean_Blue", "mean_Green", "mean_Red", "mean_Nir", "mean_Swir1", "mean_Swir2", 
-                                              "mean_SurfaceTemp",
-                                              "kurt_SurfaceTemp", 
-                                              "pCount_dswe_gt0", "pCount_dswe1", "pCount_dswe3","pCount_medHighAero", 
-                                              "prop_clouds","prop_hillShadow","mean_hillShade"]))
-      #Check how many existing tasks are running and take a break of 120 secs if it's >10 
-      maximum_no_of_tasks(10, 120)
-      #Send next task.                                        
-      locs_dataOut_89_D3.start()
-      print("Completed Landsat 8, 9 DSWE 3 stack acquisitions for site location at tile "
-        + str(tiles) 
-        + " and location subset "
-        + str(loc_10k))
-      
-    else: print("Not configured to acquire DSWE 3 stack for Landsat 8,9 for sites at this location subset.")
+    # map the refpull function across each stack, flatten to an array
+    for stack, collection in stacks.items():
+      label = stack_catalog[stack]["label"]
+      for dswe_value in ["1", "3"]:
+        if dswe_value not in dswe:
+          print("Not configured to acquire DSWE " + dswe_value + " stack for " + label + " for sites at this location subset.")
+          continue
+        print("Starting " + label + " DSWE" + dswe_value + " acquisition for site locations at tile "
+          + str(tiles)
+          + " and location subset "
+          + str(loc_10k))
+        locs_out = collection.map(stack_catalog[stack]["pulls"][dswe_value]).flatten()
+        locs_out = locs_out.filter(ee.Filter.notNull(["med_Blue"]))
+        locs_srname = (proj
+          + "_point_" + stack + "_C2_SRST_DSWE" + dswe_value + "_"
+          + str(tiles)
+          + "_" + str(loc_10k)
+          + "_v" + str(date.today()))
+        export_table(locs_out, locs_srname, {"sensor": stack, "tile": tiles},
+          selectors = stack_selectors(stack, statistics_mode) + buffer_selectors)
+        print("Completed " + label + " DSWE " + dswe_value + " stack acquisitions for site location at tile "
+          + str(tiles)
+          + " and location subset "
+          + str(loc_10k))
   
-  else: print("No sites to extract Landsat 8, 9 at tile " 
+  else: print("No sites to extract at tile "
           + str(tiles)
           + " and location subset "
           + str(loc_10k))
    
 
-##############################################
-##---- LANDSAT 457 METADATA ACQUISITION ----##
-##############################################
-
-print("Starting Landsat 4, 5, 7 metadata acquisition for tile " + str(tiles))
-
-## get metadata ##
-meta_srname_457 = proj+"_metadata_LS457_C2_"+str(tiles)+"_v"+str(date.today())
-meta_dataOut_457 = (ee.batch.Export.table.toDrive(collection = ls457,
-                                        description = meta_srname_457,
-                                        folder = proj_folder,
-                                        fileFormat = "csv"))
-
-#Check how many existing tasks are running and take a break of 120 secs if it's >10 
-maximum_no_of_tasks(10, 120)
-#Send next task.                                        
-meta_dataOut_457.start()
+##################################################
+##---- LANDSAT POLYGON/POLYCENTER ACQUISITION ----##
+##################################################
+
+if "polygon" in extent or "polycenter" in extent:
+  # the QA cache only covers the site footprints
+  qa_cache = None
+  # polygon centers are pulled at one radius, the site_buffer or the lake's
+  # inner radius if it is smaller (see polycenters_to_eeFeat), so a 
+  # buffer_sweep doesn't split them
+  site_buffers = [buffer]
+  # read in the lake polygon parts of the current tile, see prep_polygons
+  polygons_subset = read_tile_locations(tiles, "b_pull_Landsat_SRST_poi/out/polygons/")
+  polygons_subset["part_geojson"] = polygons_subset["part_geojson"].map(json.loads)
+  
+  # polygons are extracted from harmonized stacks so that one function covers
+  # all sensors; the polygon centers use the same functions as the sites
+  poly_stacks = [[stack, collection if stack == "LS45789" else collection.map(stack_catalog[stack]["harmonize"]),
+    stack_catalog[stack]["pulls"]] for stack, collection in stacks.items()]
+  
+  # columns of the polygon exports (partial statistics); the polygon center 
+  # exports have the same columns as the site exports (see stack_selectors)
+  polygon_selectors = (["system:index"]
+    + sufficient_stats_columns(polygon_bands, 4 if statistics_mode == "mergeable" else 2,
+                               statistics_mode == "mergeable")
+    + ["min_SurfaceTemp", "min_cloud_dist",
+       "pCount_dswe_gt0", "pCount_dswe1", "pCount_dswe3", "pCount_medHighAero",
+       "sum_clouds", "sum_hillShadow", "sum_hillShade",
+       "count_clouds", "count_hillShadow", "count_hillShade"])
+  
+  # polygons are larger requests than sites, so they are exported in smaller groups
+  for poly_1k in range(math.ceil(len(polygons_subset)/1000)):
+    polys_1k = polygons_subset[poly_1k * 1000:((poly_1k + 1) * 1000)]
+    
+    for sensor, stack, site_pulls in poly_stacks:
+      for dswe_value in ["1", "3"]:
+        if dswe_value not in dswe:
+          print("Not configured to acquire DSWE " + dswe_value + " stack for " + sensor + " for polygons at this polygon subset.")
+          continue
+        
+        if "polygon" in extent:
+          print("Starting " + sensor + " DSWE" + dswe_value + " acquisition for polygons at tile "
+            + str(tiles)
+            + " and polygon subset "
+            + str(poly_1k))
+          feat = polygons_to_eeFeat(polys_1k, tiles)
+          ref_pull = {"1": ref_pull_polygon_DSWE1, "3": ref_pull_polygon_DSWE3}[dswe_value]
+          poly_out = stack.map(ref_pull).flatten()
+          poly_out = poly_out.filter(ee.Filter.gt("count_Blue", 0))
+          poly_srname = (proj
+            + "_polygon_" + sensor + "_C2_SRST_DSWE" + dswe_value + "_"
+            + str(tiles)
+            + "_" + str(poly_1k)
+            + "_v" + str(date.today()))
+          export_table(poly_out, poly_srname, {"sensor": sensor, "tile": tiles},
+            selectors = polygon_selectors)
+        
+        if "polycenter" in extent:
+          print("Starting " + sensor + " DSWE" + dswe_value + " acquisition for polygon centers at tile "
+            + str(tiles)
+            + " and polygon subset "
+            + str(poly_1k))
+          feat = polycenters_to_eeFeat(polys_1k, tiles)
+          center_out = stack.map(site_pulls[dswe_value]).flatten()
+          center_out = center_out.filter(ee.Filter.notNull(["med_Blue"]))
+          center_srname = (proj
+            + "_polycenter_" + sensor + "_C2_SRST_DSWE" + dswe_value + "_"
+            + str(tiles)
+            + "_" + str(poly_1k)
+            + "_v" + str(date.today()))
+          export_table(center_out, center_srname, {"sensor": sensor, "tile": tiles},
+            selectors = stack_selectors(sensor, statistics_mode))
+  
+  print("Completed polygon acquisitions for tile " + str(tiles))
 
-print("Completed Landsat 4, 5, 7 metadata acquisition for tile " + str(tiles))
+else: print("No polygons to extract at tile " + str(tiles))
 
 
-#############################################
-##---- LANDSAT 89 METADATA ACQUISITION ----##
-#############################################
+#########################################
+##---- LANDSAT METADATA ACQUISITION ----##
+#########################################
 
-print("Starting Landsat 8, 9 metadata acquisition for tile " +str(tiles))
-
-## get metadata ##
-meta_srname_89 = proj+"_metadata_LS89_C2_"+str(tiles)+"_v"+str(date.today())
-meta_dataOut_89 = (ee.batch.Export.table.toDrive(collection = ls89,
-                                        description = meta_srname_89,
-                                        folder = proj_folder,
-                                        fileFormat = "csv"))
-
-#Check how many existing tasks are running and take a break of 120 secs if it's >10 
-maximum_no_of_tasks(10, 120)
-#Send next task.                                        
-meta_dataOut_89.start()
+for stack, collection in stacks.items():
+  label = stack_catalog[stack]["label"]
+  print("Starting " + label + " metadata acquisition for tile " + str(tiles))
   
+  ## get metadata ##
+  meta_srname = proj + "_metadata_" + stack + "_C2_" + str(tiles) + "_v" + str(date.today())
+  export_table(collection, meta_srname, {"sensor": stack, "tile": tiles}, meta_selectors)
   
-print("completed Landsat 8, 9 metadata acquisition for tile " + str(tiles))
+  print("Completed " + label + " metadata acquisition for tile " + str(tiles))
 
 
 #############################################
 ##---- DOCUMENT Landsat IDs ACQUIRED   ----##
 #############################################
 
-ls89_id_stack = ls89.aggregate_array("L1_LANDSAT_PRODUCT_ID").getInfo()
-ls457_id_stack = ls457.aggregate_array("L1_LANDSAT_PRODUCT_ID").getInfo()
-
-# open file in write mode and save each id as a row
-with open(("b_pull_Landsat_SRST_poi/out/L89_stack_ids_v"+str(date.today())+".txt"), "w") as fp:
-    for id in ls89_id_stack:
-        # write each item on a new line
-        fp.write("%s\n" % id)
-    print("Done")
-
-# open file in write mode and save each id as a row
-with open(("b_pull_Landsat_SRST_poi/out/L457_stack_ids_v"+str(date.today())+".txt"), "w") as fp:
-    for id in ls457_id_stack:
-        # write each item on a new line
-        fp.write("%s\n" % id)
+# the ids are listed per sensor group, also in harmonized runs (the collections
+# are memoized, see sensor_collection)
+for stack in ["LS89", "LS457"]:
+  collection = stack_collection(stack, tiles, config)
+  ids = [] if collection is None else collection.aggregate_array("L1_LANDSAT_PRODUCT_ID").getInfo()
+  
+  # open file in write mode and save each id as a row
+  with open(("b_pull_Landsat_SRST_poi/out/L" + stack[2:] + "_stack_ids_v"+str(date.today())+".txt"), "w") as fp:
+    for id in ids:
+      # write each item on a new line
+      fp.write("%s\n" % id)
     print("Done")
-      
@@ -0,0 +1,429 @@
+import ee
+import hashlib
+import importlib
+import json
+import math
+import multiprocessing
+import os
+import sys
+import warnings
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import numpy as np
+from pandas import DataFrame, concat
+from pyproj import Transformer
+
+
+# To investigate a suspicious value without re-running a tile's remote pull, the
+# pixel windows around a set of sites are cached locally, one memory-mapped .npy
+# array per scene (sites x bands x rows x columns, keyed by the scene's
+# system:index and the site's position in the window index), with the bands of
+# the harmonized stack after apply_scale_factors plus the terrain layers. The
+# site pull can then be replayed offline by replay_windows, in parallel across
+# cores, with a different site_buffer (up to the window size), DSWE thresholds
+# or min_valid_pixels.
+
+# bands of the cached windows: the harmonized bands (see bns_harmonized) and the
+# terrain layers, which don't depend on the replay settings
+window_bands = (["Aerosol", "Blue", "Green", "Red", "Nir", "Swir1", "Swir2",
+  "pixel_qa", "cloud_qa", "aerosol_qa", "radsat_qa", "SurfaceTemp",
+  "temp_qa", "ST_CDIST", "ST_ATRAN", "ST_DRAD", "ST_EMIS",
+  "ST_EMSD", "ST_TRAD", "ST_URAD", "hillShadow", "hillShade"])
+
+# masked pixels are downloaded as this value and stored as NaN
+window_sentinel = -9999
+
+# Landsat pixel size in meters
+window_scale = 30
+
+# medians of the harmonized site pull, as (band, output column)
+replay_medians = [("Aerosol", "med_Aerosol"), ("Blue", "med_Blue"), ("Green", "med_Green"),
+  ("Red", "med_Red"), ("Nir", "med_Nir"), ("Swir1", "med_Swir1"), ("Swir2", "med_Swir2"),
+  ("SurfaceTemp", "med_SurfaceTemp"), ("temp_qa", "med_temp_qa"), ("ST_ATRAN", "med_atran"),
+  ("ST_DRAD", "med_drad"), ("ST_EMIS", "med_emis"), ("ST_EMSD", "med_emsd"),
+  ("ST_TRAD", "med_trad"), ("ST_URAD", "med_urad")]
+replay_moment_bands = ["Aerosol", "Blue", "Green", "Red", "Nir", "Swir1", "Swir2", "SurfaceTemp"]
+
+# folder of this module, qa_decode.py and replay_worker.py, which the processes
+# of replay_windows run the replay from
+replay_module_dir = "b_pull_Landsat_SRST_poi/py/"
+
+# DSWE class of each test code (t in DSWE), all other codes are no water
+_dswe_class_codes = {1: [1111, 10111, 11011, 11101, 11110, 11111],
+  2: [111, 1011, 1101, 1110, 10011, 10101, 10110, 11001, 11010, 11100],
+  3: [11000],
+  4: [11, 101, 110, 1001, 1010, 1100, 10000, 10001, 10010, 10100]}
+_dswe_lookup = np.zeros(11112, dtype = np.int8)
+for _class, _codes in _dswe_class_codes.items():
+  _dswe_lookup[_codes] = _class
+
+
+def dswe_numpy(blue, green, red, nir, swir1, swir2, thresholds = None):
+  """Calculate the DSWE class of scaled reflectance arrays, the same as DSWE
+  does in Earth Engine
+
+  Args:
+      blue, green, red, nir, swir1, swir2: float arrays of scaled reflectance,
+      NaN where masked
+      thresholds: dictionary of DSWE thresholds, keys as in dswe_thresholds
+      (missing keys use the defaults)
+
+  Returns:
+      int8 array of the DSWE class, -1 where any band is masked
+  """
+  th = dict(dswe_thresholds, **(thresholds or {}))
+  with np.errstate(divide = "ignore", invalid = "ignore"):
+    mndwi = (green - swir1) / (green + swir1)
+    ndvi = (nir - red) / (nir + red)
+  mbsrv = green + red
+  mbsrn = nir + swir1
+  awesh = blue + 2.5 * green - 1.5 * mbsrn - 0.25 * swir2
+  t1 = mndwi > th["mndwi"]
+  t2 = mbsrv > mbsrn
+  t3 = awesh > th["awesh"]
+  t4 = ((mndwi > th["pswt1_mndwi"]) & (swir1 < th["pswt1_swir1"])
+    & (nir < th["pswt1_nir"]) & (ndvi < th["pswt1_ndvi"]))
+  t5 = ((mndwi > th["pswt2_mndwi"]) & (blue < th["pswt2_blue"])
+    & (swir1 < th["pswt2_swir1"]) & (swir2 < th["pswt2_swir2"]) & (nir < th["pswt2_nir"]))
+  t = t1 + 10 * t2.astype(np.int32) + 100 * t3 + 1000 * t4 + 10000 * t5
+  valid = np.isfinite(blue) & np.isfinite(green) & np.isfinite(red) & np.isfinite(nir) & np.isfinite(swir1) & np.isfinite(swir2)
+  return np.where(valid, _dswe_lookup[t], -1).astype(np.int8)
+
+
+def _scene_image(scene_id):
+  """Scaled and harmonized image of a scene, from its system:index"""
+  sensor = sensor_catalog[scene_id[:4]]
+  stack = stack_catalog[sensor["stack"]]
+  image = (apply_scale_factors(ee.Image(sensor["collection"] + "/" + scene_id))
+    .select(list(stack["bands"].keys()), list(stack["bands"].values())))
+  return stack["harmonize"](image)
+
+
+def tile_scene_ids(tile, config):
+  """List the scenes of a tile that the site pull would summarize
+
+  Args:
+      tile: WRS2 path-row as a 6-digit string
+      config: validated config, see pull_config.py
+
+  Returns:
+      sorted list of scene system:index values
+  """
+  ids = ee.List([])
+  for sensor in stack_sensors("LS45789", config):
+    ids = ids.cat(sensor_collection(sensor, str(tile),
+      config["start_date"].strftime("%Y-%m-%d"), config["end_date"].strftime("%Y-%m-%d"),
+      bool(config["cloud_filter"]), float(config["cloud_thresh"])).aggregate_array("system:index"))
+  return sorted(ids.getInfo())
+
+
+def window_dir_name(tile, site_ids, radius_px):
+  """Name of the cache directory of a set of sites and window size
+
+  Args:
+      tile: WRS2 path-row as a 6-digit string
+      site_ids: list of site ids
+      radius_px: window radius in pixels
+
+  Returns:
+      directory name, windows_<tile>_<first 12 characters of the sha256 digest>
+  """
+  digest = hashlib.sha256(json.dumps([str(tile), int(radius_px), [str(i) for i in site_ids]]).encode())
+  return "windows_" + str(tile) + "_" + digest.hexdigest()[:12]
+
+
+def _site_offsets(longitude, latitude, location_crs, projection):
+  """Offsets (x, y) in meters of sites from the center of the pixel they fall
+  in, in the scene's projection"""
+  sx, _, tx, _, sy, ty = projection["transform"]
+  x, y = Transformer.from_crs(location_crs, projection["crs"], always_xy = True).transform(longitude, latitude)
+  x = np.asarray(x)
+  y = np.asarray(y)
+  center_x = tx + (np.floor((x - tx) / sx) + 0.5) * sx
+  center_y = ty + (np.floor((y - ty) / sy) + 0.5) * sy
+  return np.stack([x - center_x, y - center_y], axis = 1)
+
+
+def _download_scene(scene_id, locations, tile, radius_px, location_crs, out_file, sites_per_request):
+  """Download the windows of one scene into a memory-mapped .npy file
+
+  Returns:
+      dictionary of the scene's projection
+  """
+  image = _scene_image(scene_id)
+  projection = image.select("Blue").projection()
+  width = 2 * radius_px + 1
+  windows = np.lib.format.open_memmap(out_file + ".tmp", mode = "w+", dtype = np.float32,
+    shape = (len(locations), len(window_bands), width, width))
+  windows[:] = np.nan
+  for start in range(0, len(locations), sites_per_request):
+    chunk = locations.iloc[start:(start + sites_per_request)]
+    sites = csv_to_eeFeat(chunk, location_crs, tile)
+    stack = (image.addBands(calc_hill_shadows(image, sites.geometry()))
+      .addBands(calc_hill_shades(image, sites.geometry()))
+      .select(window_bands)
+      .toFloat()
+      .unmask(window_sentinel)
+      # one array per band, rows from north to south
+      .neighborhoodToArray(ee.Kernel.square(radius_px, "pixels")))
+    samples = ee.data.computeFeatures({"expression": stack.sampleRegions(collection = sites,
+        properties = ["id"], scale = window_scale, projection = projection, geometries = False),
+      "fileFormat": "PANDAS_DATAFRAME"})
+    if len(samples) == 0:
+      continue
+    rows = {site_id: i for i, site_id in enumerate(chunk["id"].astype(str))}
+    index = np.array([start + rows[str(i)] for i in samples["id"]], dtype = np.int64)
+    for b, band in enumerate(window_bands):
+      values = np.asarray(list(samples[band]), dtype = np.float32)
+      windows[index, b] = np.where(values == window_sentinel, np.nan, values)
+  windows.flush()
+  del windows
+  os.replace(out_file + ".tmp", out_file)
+  return projection.getInfo()
+
+
+def cache_scene_windows(tile, site_ids = None, scene_ids = None, window_m = None, config = None,
+  cache_dir = "b_pull_Landsat_SRST_poi/out/scene_windows/", sites_per_request = 250, n_requests = 8):
+  """Download the pixel windows of a set of sites and scenes of a tile. Scenes
+  that are already cached are skipped, so an interrupted download can be rerun.
+
+  Args:
+      tile: WRS2 path-row as a 6-digit string
+      site_ids: list of site ids to cache, or None for all of the tile's sites
+      scene_ids: list of scene system:index values (e.g. the scene_id column of
+      query_sites), or None for all of the tile's scenes (see tile_scene_ids)
+      window_m: half-width of the windows in meters, the largest site_buffer that
+      can be replayed; defaults to twice the configured site_buffer
+      config: validated config, see pull_config.py; read with read_config() if
+      not provided
+      cache_dir: directory of the window caches
+      sites_per_request: number of sites sampled per Earth Engine request
+      n_requests: number of scenes downloaded concurrently
+
+  Returns:
+      directory of the windows, to pass to replay_windows
+  """
+  if config is None:
+    config = read_config()
+  ee.Initialize(project = config["ee_proj"])
+  locations = read_tile_locations(tile)
+  if site_ids is not None:
+    locations = locations[locations["id"].astype(str).isin([str(i) for i in site_ids])]
+  locations = locations.sort_values("id").reset_index(drop = True)
+  if len(locations) == 0:
+    raise ValueError("None of the sites are in tile " + str(tile))
+  if scene_ids is None:
+    scene_ids = tile_scene_ids(tile, config)
+  unknown = [s for s in scene_ids if s[:4] not in sensor_catalog]
+  if unknown:
+    raise ValueError("Unknown scene ids: " + ", ".join(unknown))
+  if window_m is None:
+    window_m = 2 * config["site_buffer"]
+  radius_px = int(math.ceil(window_m / window_scale))
+
+  window_dir = os.path.join(cache_dir, window_dir_name(tile, locations["id"], radius_px))
+  os.makedirs(window_dir, exist_ok = True)
+  index_file = os.path.join(window_dir, "windows.json")
+  if os.path.exists(index_file):
+    with open(index_file, "r") as file:
+      index = json.load(file)
+  else:
+    index = {"tile": str(tile),
+      "radius_px": radius_px,
+      "scale": window_scale,
+      "bands": window_bands,
+      "location_crs": config["location_crs"],
+      "sites": locations["id"].astype(str).tolist(),
+      "scenes": {}}
+  todo = [s for s in scene_ids if s not in index["scenes"]]
+  print("Caching " + str(len(todo)) + " of " + str(len(scene_ids)) + " scenes for "
+    + str(len(locations)) + " sites of tile " + str(tile))
+
+  def download(scene_id):
+    out_file = os.path.join(window_dir, scene_id + ".npy")
+    projection = _download_scene(scene_id, locations, tile, radius_px, config["location_crs"],
+      out_file, sites_per_request)
+    offsets = _site_offsets(locations["Longitude"], locations["Latitude"], config["location_crs"], projection)
+    return scene_id, {"crs": projection["crs"], "transform": projection["transform"],
+      "offsets": offsets.round(3).tolist()}
+
+  with ThreadPoolExecutor(max_workers = n_requests) as pool:
+    for scene_id, entry in pool.map(download, todo):
+      index["scenes"][scene_id] = entry
+      with open(index_file + ".tmp", "w") as file:
+        json.dump(index, file)
+      os.replace(index_file + ".tmp", index_file)
+  return window_dir
+
+
+def _nan_reduce(fun, values):
+  """Apply a NaN-aware reduction along the last axis, NaN where nothing is valid"""
+  with warnings.catch_warnings():
+    warnings.simplefilter("ignore", category = RuntimeWarning)
+    return fun(values, axis = -1)
+
+
+def window_stats(windows, bands, offsets, radius_px, dswe_value, site_buffer,
+  thresholds = None, min_valid_pixels = 0):
+  """Summarize the windows of one scene as the harmonized site pull does
+  (ref_pull_sites). Medians are exact, where Earth Engine's are
+  approximate for large samples.
+
+  Args:
+      windows: float array of sites x bands x rows x columns
+      bands: band names of the windows
+      offsets: array of sites x 2 of the offsets of the sites from the center
+      pixel, in meters
+      radius_px: window radius in pixels
+      dswe_value: DSWE class to summarize, 1 or 3
+      site_buffer: buffer radius around the sites in meters
+      thresholds: dictionary of DSWE thresholds, or None for dswe_thresholds
+      min_valid_pixels: sites with fewer valid pixels are dropped
+
+  Returns:
+      DataFrame with one row per site with enough valid pixels, with the
+      position of the site in the window index as "site"
+  """
+  n_sites = windows.shape[0]
+  pixels = np.asarray(windows, dtype = np.float64).reshape(n_sites, len(bands), -1)
+  band = lambda name: pixels[:, bands.index(name)]
+
+  # pixels with centers within the buffer
+  grid = (np.arange(2 * radius_px + 1) - radius_px) * window_scale
+  x = np.tile(grid, 2 * radius_px + 1)
+  y = np.repeat(-grid, 2 * radius_px + 1)
+  in_buffer = ((x[None, :] - offsets[:, 0:1]) ** 2 + (y[None, :] - offsets[:, 1:2]) ** 2) <= site_buffer ** 2
+
+  qa_valid = np.isfinite(band("pixel_qa"))
+  qa_int = lambda name: np.nan_to_num(band(name)).astype(np.uint16)
+  _, clear, clouds = decode_qa_numpy(qa_int("pixel_qa"), qa_int("radsat_qa"),
+    qa_int("cloud_qa"), qa_int("aerosol_qa"))
+  clear = clear & qa_valid
+  d = dswe_numpy(band("Blue"), band("Green"), band("Red"), band("Nir"),
+    band("Swir1"), band("Swir2"), thresholds)
+  hill_shadow = band("hillShadow")
+  img_mask = in_buffer & clear & (d == dswe_value) & (hill_shadow == 1)
+
+  out = {"site": np.arange(n_sites)}
+  selected = lambda name: np.where(img_mask, band(name), np.nan)
+  for name, column in replay_medians:
+    out[column] = _nan_reduce(np.nanmedian, selected(name))
+  out["min_SurfaceTemp"] = _nan_reduce(np.nanmin, selected("SurfaceTemp"))
+  out["min_cloud_dist"] = _nan_reduce(np.nanmin, selected("ST_CDIST"))
+  for name in replay_moment_bands:
+    out["sd_" + name] = _nan_reduce(np.nanstd, selected(name))
+    out["mean_" + name] = _nan_reduce(np.nanmean, selected(name))
+  st = selected("SurfaceTemp")
+  centered = st - out["mean_SurfaceTemp"][:, None]
+  with np.errstate(divide = "ignore", invalid = "ignore"):
+    out["kurt_SurfaceTemp"] = (_nan_reduce(np.nanmean, centered ** 4)
+      / out["sd_SurfaceTemp"] ** 4 - 3)
+  out["pCount_dswe_gt0"] = (in_buffer & clear & (d > 0)).sum(axis = 1)
+  out["pCount_dswe1"] = (in_buffer & clear & (d == 1)).sum(axis = 1)
+  out["pCount_dswe3"] = (in_buffer & clear & (d == 3)).sum(axis = 1)
+  out["pCount_medHighAero"] = (in_buffer & np.isfinite(band("aerosol_qa"))).sum(axis = 1)
+  out["prop_clouds"] = _nan_reduce(np.nanmean, np.where(in_buffer & qa_valid, clouds, np.nan))
+  out["prop_hillShadow"] = _nan_reduce(np.nanmean, np.where(in_buffer, hill_shadow, np.nan))
+  out["mean_hillShade"] = _nan_reduce(np.nanmean, np.where(in_buffer, band("hillShade"), np.nan))
+  stats = DataFrame(out)
+  n_valid = img_mask.sum(axis = 1)
+  if min_valid_pixels > 0:
+    stats = stats[n_valid >= min_valid_pixels]
+  return stats
+
+
+def _replay_scene(window_dir, scene_id, entry, index, dswe_value, site_buffer, thresholds, min_valid_pixels):
+  """Replay the site pull on the cached windows of one scene"""
+  windows = np.load(os.path.join(window_dir, scene_id + ".npy"), mmap_mode = "r")
+  stats = window_stats(windows, index["bands"], np.asarray(entry["offsets"]), index["radius_px"],
+    dswe_value, site_buffer, thresholds, min_valid_pixels)
+  stats.insert(0, "site_id", np.asarray(index["sites"])[stats["site"].to_numpy()])
+  stats.insert(0, "scene_id", scene_id)
+  stats.insert(2, "dswe", str(dswe_value))
+  return stats.drop(columns = "site")
+
+
+def replay_windows(window_dir, dswe_values = None, site_buffer = None, thresholds = None,
+  min_valid_pixels = None, config = None, n_workers = None):
+  """Replay the site pull offline on cached windows, one scene per process
+
+  Args:
+      window_dir: directory written by cache_scene_windows
+      dswe_values: DSWE classes to summarize, defaults to the DSWE_setting
+      site_buffer: buffer radius in meters, defaults to the configured
+      site_buffer. Must be within the cached windows.
+      thresholds: dictionary of DSWE thresholds to change, keys as in
+      dswe_thresholds, or None for the defaults
+      min_valid_pixels: defaults to the configured min_valid_pixels
+      config: validated config, see pull_config.py; read with read_config() if
+      not provided
+      n_workers: number of processes, defaults to the number of cores. With 1,
+      the scenes are replayed in this process. The processes are spawned and
+      run the replay from replay_worker.py.
+
+  Returns:
+      DataFrame of the summaries with scene_id, site_id and dswe columns, the
+      keys used by query_sites
+  """
+  if config is None:
+    config = read_config()
+  dswe_values = [int(v) for v in (dswe_values or config["DSWE_setting"])]
+  site_buffer = config["site_buffer"] if site_buffer is None else site_buffer
+  min_valid_pixels = config["min_valid_pixels"] if min_valid_pixels is None else min_valid_pixels
+  with open(os.path.join(window_dir, "windows.json"), "r") as file:
+    index = json.load(file)
+  if site_buffer > index["radius_px"] * index["scale"]:
+    raise ValueError("site_buffer " + str(site_buffer) + " is larger than the cached windows ("
+      + str(index["radius_px"] * index["scale"]) + " m)")
+  jobs = [(window_dir, scene_id, entry, index, v, site_buffer, thresholds, min_valid_pixels)
+    for scene_id, entry in sorted(index["scenes"].items()) for v in dswe_values]
+  if n_workers == 1:
+    results = [_replay_scene(*job) for job in jobs]
+  else:
+    # functions run by source_python live in __main__ and can't be pickled to the
+    # pool, so the processes are spawned (not forked, which is also safe to run
+    # from reticulate) and run the replay modules in replay_worker.py
+    module_dir = os.path.abspath(replay_module_dir)
+    if module_dir not in sys.path:
+      sys.path.insert(0, module_dir)
+    worker = importlib.import_module("replay_worker")
+    context = multiprocessing.get_context("spawn")
+    if not os.path.basename(sys.executable).startswith("python"):
+      context.set_executable(os.path.join(sys.exec_prefix, "bin", "python"))
+    modules = [os.path.join(module_dir, m) for m in ["qa_decode.py", "scene_windows.py"]]
+    with ProcessPoolExecutor(max_workers = n_workers, mp_context = context,
+        initializer = worker.load_modules,
+        initargs = (modules, {"dswe_thresholds": dswe_thresholds})) as pool:
+      results = list(pool.map(worker.replay_scene, *zip(*jobs)))
+  if not results:
+    return DataFrame(columns = ["scene_id", "site_id", "dswe"])
+  return concat(results, ignore_index = True)
+
+
+def compare_replay(replay, exported, columns = None):
+  """Compare replayed summaries with exported ones for the same scenes and sites
+
+  Args:
+      replay: DataFrame from replay_windows
+      exported: DataFrame of exported rows with scene_id and site_id columns
+      (e.g. from query_sites), of one DSWE setting
+      columns: columns to compare, defaults to all shared numeric columns
+
+  Returns:
+      DataFrame with one row per column: the number of matched rows, the
+      largest absolute difference and the number of rows that only one side
+      has a value for
+  """
+  exported = exported.assign(site_id = exported["site_id"].astype(str))
+  merged = replay.merge(exported, on = ["scene_id", "site_id"], suffixes = ("_replay", "_export"))
+  if columns is None:
+    columns = [c for c in replay.columns if c in exported.columns
+      and c not in ["scene_id", "site_id", "dswe"] and replay[c].dtype.kind in "fiu"]
+  rows = []
+  for c in columns:
+    a = merged[c + "_replay"].astype(float)
+    b = merged[c + "_export"].astype(float)
+    rows.append({"column": c,
+      "n": len(merged),
+      "max_abs_diff": (a - b).abs().max(),
+      "n_missing_one_side": int((a.isna() != b.isna()).sum())})
+  return DataFrame(rows)
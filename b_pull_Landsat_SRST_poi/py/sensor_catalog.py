@@ -0,0 +1,178 @@
+import ee
+import os
+from functools import lru_cache
+from pandas import read_csv
+
+
+# Sensors that can be acquired, keyed by the prefix of their scene ids. Each
+# sensor belongs to a stack whose band map, QA bands and site pulls it shares.
+# Sensors can be left out of a run with the "sensors" setting.
+sensor_catalog = {"LT04": {"collection": "LANDSAT/LT04/C02/T1_L2", "stack": "LS457"},
+  "LT05": {"collection": "LANDSAT/LT05/C02/T1_L2", "stack": "LS457"},
+  "LE07": {"collection": "LANDSAT/LE07/C02/T1_L2", "stack": "LS457"},
+  "LC08": {"collection": "LANDSAT/LC08/C02/T1_L2", "stack": "LS89"},
+  "LC09": {"collection": "LANDSAT/LC09/C02/T1_L2", "stack": "LS89"}}
+
+# Stacks of sensors that are processed together:
+#   label - name of the stack in progress messages
+#   bands - source band name to the renamed band, in the order of the stack
+#   qa_bands - QA bands of the stack, see decode_qa
+#   aerosol - True if the stack has the Aerosol band and aerosol QA
+#   harmonize - function that renames an image into bns_harmonized
+#   mergeable_bands - bands with sufficient statistics in "mergeable" mode
+#   pulls - site pull of each DSWE setting
+# LS45789 is the harmonized stack of all sensors (harmonize_sensors), built from
+# the other stacks with their harmonize functions.
+stack_catalog = {"LS457": {"label": "Landsat 4, 5, 7",
+    "bands": {"SR_B1": "Blue", "SR_B2": "Green", "SR_B3": "Red", "SR_B4": "Nir",
+      "SR_B5": "Swir1", "SR_B7": "Swir2", "QA_PIXEL": "pixel_qa",
+      "SR_CLOUD_QA": "cloud_qa", "QA_RADSAT": "radsat_qa", "ST_B6": "SurfaceTemp",
+      "ST_QA": "temp_qa", "ST_CDIST": "ST_CDIST", "ST_ATRAN": "ST_ATRAN",
+      "ST_DRAD": "ST_DRAD", "ST_EMIS": "ST_EMIS", "ST_EMSD": "ST_EMSD",
+      "ST_TRAD": "ST_TRAD", "ST_URAD": "ST_URAD"},
+    "qa_bands": qa_bands_457,
+    "aerosol": False,
+    "harmonize": harmonize_457,
+    "mergeable_bands": mergeable_bands_457,
+    "pulls": {"1": ref_pull_457_DSWE1, "3": ref_pull_457_DSWE3}},
+  "LS89": {"label": "Landsat 8, 9",
+    "bands": {"SR_B1": "Aerosol", "SR_B2": "Blue", "SR_B3": "Green", "SR_B4": "Red",
+      "SR_B5": "Nir", "SR_B6": "Swir1", "SR_B7": "Swir2", "QA_PIXEL": "pixel_qa",
+      "SR_QA_AEROSOL": "aerosol_qa", "QA_RADSAT": "radsat_qa", "ST_B10": "SurfaceTemp",
+      "ST_QA": "temp_qa", "ST_CDIST": "ST_CDIST", "ST_ATRAN": "ST_ATRAN",
+      "ST_DRAD": "ST_DRAD", "ST_EMIS": "ST_EMIS", "ST_EMSD": "ST_EMSD",
+      "ST_TRAD": "ST_TRAD", "ST_URAD": "ST_URAD"},
+    "qa_bands": qa_bands_89,
+    "aerosol": True,
+    "harmonize": harmonize_89,
+    "mergeable_bands": mergeable_bands,
+    "pulls": {"1": ref_pull_89_DSWE1, "3": ref_pull_89_DSWE3}},
+  "LS45789": {"label": "Landsat 4-9",
+    "qa_bands": qa_bands_harmonized,
+    "aerosol": True,
+    "mergeable_bands": mergeable_bands,
+    "pulls": {"1": ref_pull_harmonized_DSWE1, "3": ref_pull_harmonized_DSWE3}}}
+
+# columns of the site (and polygon center) exports, without the sufficient
+# statistics of "mergeable" mode
+site_columns = ["med_Aerosol", "med_Blue", "med_Green", "med_Red", "med_Nir", "med_Swir1", "med_Swir2",
+  "med_SurfaceTemp", "med_temp_qa", "med_atran", "med_drad", "med_emis",
+  "med_emsd", "med_trad", "med_urad",
+  "min_SurfaceTemp", "min_cloud_dist",
+  "sd_Aerosol", "sd_Blue", "sd_Green", "sd_Red", "sd_Nir", "sd_Swir1", "sd_Swir2", "sd_SurfaceTemp",
+  "mean_Aerosol", "mean_Blue", "mean_Green", "mean_Red", "mean_Nir", "mean_Swir1", "mean_Swir2",
+  "mean_SurfaceTemp",
+  "kurt_SurfaceTemp",
+  "pCount_dswe_gt0", "pCount_dswe1", "pCount_dswe3", "pCount_medHighAero",
+  "prop_clouds", "prop_hillShadow", "mean_hillShade"]
+
+
+def stack_sensors(stack, config):
+  """Sensors of a stack that are acquired in this run
+
+  Args:
+      stack: name of a stack in stack_catalog
+      config: validated config, see pull_config.py
+
+  Returns:
+      list of sensor ids, in the order of sensor_catalog. All configured sensors
+      for the harmonized LS45789 stack.
+  """
+  return [s for s, entry in sensor_catalog.items()
+    if s in config["sensors"] and (stack == "LS45789" or entry["stack"] == stack)]
+
+
+@lru_cache(maxsize = 64)
+def sensor_collection(sensor, tile, start_date, end_date, cloud_filter, cloud_thresh):
+  """Scenes of one sensor and tile, filtered by date and scene cloud cover,
+  scaled and renamed to the bands of the sensor's stack. Memoized, so tiles and
+  settings that are run again in the same session reuse the collection.
+
+  Args:
+      sensor: sensor id in sensor_catalog
+      tile: WRS2 path-row as a 6-digit string
+      start_date: first date as "YYYY-MM-DD"
+      end_date: last date as "YYYY-MM-DD"
+      cloud_filter: if True, filter scenes by CLOUD_COVER
+      cloud_thresh: maximum CLOUD_COVER of the scenes
+
+  Returns:
+      ee.ImageCollection
+  """
+  bands = stack_catalog[sensor_catalog[sensor]["stack"]]["bands"]
+  collection = filter_scene_clouds(ee.ImageCollection(sensor_catalog[sensor]["collection"]),
+    {"cloud_filter": cloud_filter, "cloud_thresh": cloud_thresh})
+  return (collection
+    .filterDate(start_date, end_date)
+    .filter(ee.Filter.eq("WRS_PATH", int(str(tile)[0:3])))
+    .filter(ee.Filter.eq("WRS_ROW", int(str(tile)[3:6])))
+    .map(apply_scale_factors)
+    .select(list(bands.keys()), list(bands.values())))
+
+
+def stack_collection(stack, tile, config):
+  """Merge the configured sensors of a stack for a tile. Images of the
+  harmonized LS45789 stack are renamed with the harmonize function of their
+  sensor's stack.
+
+  Args:
+      stack: name of a stack in stack_catalog
+      tile: WRS2 path-row as a 6-digit string
+      config: validated config, see pull_config.py
+
+  Returns:
+      ee.ImageCollection, or None if none of the stack's sensors are configured
+  """
+  merged = None
+  for sensor in stack_sensors(stack, config):
+    one = sensor_collection(sensor, str(tile),
+      config["start_date"].strftime("%Y-%m-%d"), config["end_date"].strftime("%Y-%m-%d"),
+      bool(config["cloud_filter"]), float(config["cloud_thresh"]))
+    if stack == "LS45789":
+      one = one.map(stack_catalog[sensor_catalog[sensor]["stack"]]["harmonize"])
+    merged = one if merged is None else merged.merge(one)
+  return None if merged is None else ee.ImageCollection(merged)
+
+
+def stack_selectors(stack, statistics_mode = "final"):
+  """Columns of the site and polygon center exports of a stack
+
+  Args:
+      stack: name of a stack in stack_catalog
+      statistics_mode: "final" or "mergeable"
+
+  Returns:
+      list of column names, starting with system:index
+  """
+  columns = list(site_columns)
+  if statistics_mode == "mergeable":
+    columns = columns + sufficient_stats_columns(stack_catalog[stack]["mergeable_bands"])
+  if not stack_catalog[stack]["aerosol"]:
+    columns = [c for c in columns if "Aerosol" not in c and "medHighAero" not in c]
+  return ["system:index"] + columns
+
+
+def planned_scenes(tile, config, plan_file = "b_pull_Landsat_SRST_poi/out/preflight_plan.csv"):
+  """Scene counts of a tile from the preflight plan of this run, to skip stacks
+  without scenes
+
+  Args:
+      tile: WRS2 path-row as a 6-digit string
+      config: validated config, see pull_config.py
+      plan_file: cost plan written by preflight_plan
+
+  Returns:
+      dictionary of stack to number of scenes, or an empty dictionary if the
+      preflight is off or there is no plan for the tile (then no stack is 
+      skipped)
+  """
+  # without a preflight in this run, the plan may be from other settings
+  if config["preflight"] == "False" or not os.path.exists(plan_file):
+    return {}
+  plan = read_csv(plan_file, dtype = {"tile": str})
+  plan = plan[plan["tile"] == str(tile)]
+  if len(plan) == 0:
+    return {}
+  counts = {c[len("scenes_"):]: int(plan[c].iloc[0]) for c in plan.columns if c.startswith("scenes_")}
+  counts["LS45789"] = sum(counts.values())
+  return counts
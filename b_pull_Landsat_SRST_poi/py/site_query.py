@@ -0,0 +1,276 @@
+import os
+import re
+import shutil
+import time
+from datetime import date, datetime
+from functools import lru_cache
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from pandas import DataFrame, concat, read_csv, read_parquet, to_datetime
+from pandas.util import hash_pandas_object
+
+
+# site exports are named <proj>_point_<stack>_C2_SRST_DSWE<n>_<tile>_<chunk>_v<date>
+# (polygon centers: _polycenter_), see runGEEperTile.py
+site_export_pattern = r"_(LS\d+)_C2_SRST_(DSWE\d)_"
+
+# rows of a site are sorted by these keys (and by buffer_m before the date if
+# the exports have a buffer_sweep), the site index has a row range per sensor
+# and DSWE setting of each site
+site_sort_keys = ["site_id", "sensor", "DSWE", "date"]
+
+
+def _read_site_export(file):
+  """Read one site export and add the scene, site, sensor, DSWE, date and file 
+  keys
+
+  Args:
+      file: file path of a site export (.csv or .parquet), named as exported
+
+  Returns:
+      DataFrame of the export with scene_id, site_id, sensor, DSWE, date and 
+      source_file columns. Raises a ValueError if the file name doesn't have 
+      the sensor stack and DSWE setting.
+  """
+  name = os.path.basename(file)
+  export = re.search(site_export_pattern, name)
+  if export is None:
+    raise ValueError(name + " is not named like a site export (<proj>_point_<stack>_C2_SRST_DSWE<n>_...)")
+  if file.endswith(".parquet"):
+    df = read_parquet(file)
+  else:
+    df = read_csv(file, dtype = {"system:index": str})
+  keys = split_system_index(df["system:index"])
+  df["scene_id"] = keys["scene_id"]
+  df["site_id"] = keys["site_id"]
+  df["sensor"] = export.group(1)
+  df["DSWE"] = export.group(2)
+  df["date"] = to_datetime(df["scene_id"].str[-8:], format = "%Y%m%d").dt.date
+  df["source_file"] = os.path.basename(file)
+  return df
+
+
+def build_site_dataset(site_files, out_dir = "b_pull_Landsat_SRST_poi/out/site_dataset/",
+  n_partitions = 64, row_group_size = 10000):
+  """Collate site exports into a dataset sorted by site, sensor stack, DSWE 
+  setting and date with a site index, so that time series for a list of sites can be read without scanning
+  every file. Sites are hashed into n_partitions buckets first, so only one
+  bucket is held in memory while it is sorted.
+
+  Args:
+      site_files: list of site export .csv/.parquet files
+      out_dir: directory to write the dataset to, replaced if it exists
+      n_partitions: number of partition files to hash sites into
+      row_group_size: number of rows per parquet row group; smaller row groups
+      mean less is read per lookup, larger row groups compress better
+
+  Returns:
+      out_dir. Silently writes part-*.parquet files and _site_index.parquet
+  """
+  if os.path.exists(out_dir):
+    shutil.rmtree(out_dir)
+  tmp_dir = os.path.join(out_dir, "_tmp")
+  os.makedirs(tmp_dir)
+
+  # pass 1: stream each export into its site buckets
+  for i, file in enumerate(site_files):
+    df = _read_site_export(file)
+    bucket = hash_pandas_object(df["site_id"], index = False).to_numpy() % n_partitions
+    for b in np.unique(bucket):
+      bucket_dir = os.path.join(tmp_dir, "bucket=" + str(b))
+      os.makedirs(bucket_dir, exist_ok = True)
+      df[bucket == b].to_parquet(os.path.join(bucket_dir, str(i) + ".parquet"), index = False)
+
+  # pass 2: sort each bucket and record the row range of each site, sensor 
+  # and DSWE setting
+  index = []
+  for b in range(n_partitions):
+    bucket_dir = os.path.join(tmp_dir, "bucket=" + str(b))
+    if not os.path.exists(bucket_dir):
+      continue
+    df = concat([read_parquet(os.path.join(bucket_dir, f)) for f in sorted(os.listdir(bucket_dir))],
+      ignore_index = True)
+    sort_keys = site_sort_keys[:-1] + ["buffer_m", "date"] if "buffer_m" in df.columns else site_sort_keys
+    df = df.sort_values(sort_keys, kind = "stable").reset_index(drop = True)
+    part_file = "part-" + str(b).zfill(5) + ".parquet"
+    df.to_parquet(os.path.join(out_dir, part_file), index = False, row_group_size = row_group_size)
+    new_range = np.zeros(len(df) - 1, dtype = bool)
+    for key in site_sort_keys[:-1]:
+      values = df[key].to_numpy()
+      new_range |= values[1:] != values[:-1]
+    starts = np.flatnonzero(np.r_[True, new_range])
+    ends = np.r_[starts[1:], len(df)]
+    index.append(DataFrame({"site_id": df["site_id"].to_numpy()[starts],
+      "sensor": df["sensor"].to_numpy()[starts],
+      "DSWE": df["DSWE"].to_numpy()[starts],
+      "partition": part_file,
+      "row_start": starts,
+      "row_end": ends}))
+  shutil.rmtree(tmp_dir)
+
+  index = concat(index, ignore_index = True).sort_values(site_sort_keys[:-1]).reset_index(drop = True)
+  index.to_parquet(os.path.join(out_dir, "_site_index.parquet"), index = False)
+  # the index and partition files of an earlier build of out_dir are cached
+  load_site_index.cache_clear()
+  _open_partition.cache_clear()
+  return out_dir
+
+
+@lru_cache(maxsize = 8)
+def load_site_index(dataset_dir):
+  """Load the site index of a dataset written by build_site_dataset. Cached, so
+  repeated queries against the same dataset only read it once.
+
+  Args:
+      dataset_dir: directory of the dataset
+
+  Returns:
+      dictionary of site_id to a list of (sensor, DSWE, partition, row_start, 
+      row_end), one per sensor stack and DSWE setting of the site
+  """
+  index = read_parquet(os.path.join(dataset_dir, "_site_index.parquet"))
+  ranges = {}
+  for row in zip(index["site_id"], index["sensor"], index["DSWE"],
+      index["partition"], index["row_start"], index["row_end"]):
+    ranges.setdefault(row[0], []).append(row[1:])
+  return ranges
+
+
+@lru_cache(maxsize = 128)
+def _open_partition(dataset_dir, partition):
+  """Open a partition file and get the first row of each of its row groups
+
+  Args:
+      dataset_dir: directory of the dataset
+      partition: file name of the partition
+
+  Returns:
+      tuple of (pyarrow.parquet.ParquetFile, array of row group start rows)
+  """
+  pf = pq.ParquetFile(os.path.join(dataset_dir, partition))
+  sizes = [pf.metadata.row_group(i).num_rows for i in range(pf.metadata.num_row_groups)]
+  return pf, np.r_[0, np.cumsum(sizes)]
+
+
+def query_sites(dataset_dir, site_ids, start_date = None, end_date = None, columns = None,
+  sensors = None, dswe = None):
+  """Get the full time series for a list of sites from a dataset written by
+  build_site_dataset. Only the row groups holding the requested sites are read.
+
+  Args:
+      dataset_dir: directory of the dataset
+      site_ids: list of site ids (as in the site_id column)
+      start_date: optional first date (inclusive) as "YYYY-MM-DD" or date
+      end_date: optional last date (inclusive) as "YYYY-MM-DD" or date
+      columns: optional list of columns to return; site_id, sensor, DSWE and 
+      date are always included
+      sensors: optional list of sensor stacks, e.g. ["LS89"]
+      dswe: optional list of DSWE settings, e.g. ["DSWE1"]
+
+  Returns:
+      pyarrow.Table of the requested rows, sorted by partition, site, sensor, 
+      DSWE setting and date
+  """
+  index = load_site_index(dataset_dir)
+  if columns is not None:
+    columns = list(dict.fromkeys(site_sort_keys + list(columns)))
+
+  # group the requested row ranges by partition
+  ranges = {}
+  for site in set(str(s) for s in site_ids):
+    for sensor, dswe_setting, partition, row_start, row_end in index.get(site, []):
+      if (sensors is None or sensor in sensors) and (dswe is None or dswe_setting in dswe):
+        ranges.setdefault(partition, []).append((row_start, row_end))
+
+  tables = []
+  for partition, part_ranges in sorted(ranges.items()):
+    pf, group_starts = _open_partition(dataset_dir, partition)
+    part_ranges = sorted(part_ranges)
+    # row groups that overlap any of the requested ranges
+    groups = set()
+    for row_start, row_end in part_ranges:
+      first = np.searchsorted(group_starts, row_start, side = "right") - 1
+      last = np.searchsorted(group_starts, row_end - 1, side = "right") - 1
+      groups.update(range(first, last + 1))
+    groups = sorted(groups)
+    table = pf.read_row_groups(groups, columns = columns)
+    # rows of the table are the concatenation of the row groups read, so map
+    # each requested range to its offset in the table
+    offsets = {g: o for g, o in zip(groups, np.r_[0, np.cumsum(
+      [group_starts[g + 1] - group_starts[g] for g in groups])])}
+    for row_start, row_end in part_ranges:
+      first = np.searchsorted(group_starts, row_start, side = "right") - 1
+      table_start = offsets[first] + row_start - group_starts[first]
+      tables.append(table.slice(table_start, row_end - row_start))
+
+  if not tables:
+    schema = pq.read_schema(os.path.join(dataset_dir, sorted(
+      f for f in os.listdir(dataset_dir) if f.startswith("part-"))[0]))
+    if columns is not None:
+      schema = pa.schema([schema.field(c) for c in columns])
+    return schema.empty_table()
+  out = pa.concat_tables(tables)
+
+  if start_date is not None or end_date is not None:
+    mask = None
+    if start_date is not None:
+      mask = pc.greater_equal(out["date"], pa.scalar(_query_date(start_date)))
+    if end_date is not None:
+      end_mask = pc.less_equal(out["date"], pa.scalar(_query_date(end_date)))
+      mask = end_mask if mask is None else pc.and_(mask, end_mask)
+    out = out.filter(mask)
+  return out
+
+
+def _query_date(value):
+  """Coerce a "YYYY-MM-DD" string or date to a date
+
+  Args:
+      value: string or date
+
+  Returns:
+      datetime.date
+  """
+  if isinstance(value, date):
+    return value
+  return datetime.strptime(value, "%Y-%m-%d").date()
+
+
+def benchmark_site_query(dataset_dir, n_sites = 1000, n_reps = 5, seed = 37):
+  """Time index lookups of a random set of sites against a full scan of the
+  dataset
+
+  Args:
+      dataset_dir: directory of the dataset
+      n_sites: number of sites to query
+      n_reps: number of times to repeat each query
+      seed: random seed for choosing sites
+
+  Returns:
+      DataFrame of the median seconds and rows returned per method
+  """
+  index = load_site_index(dataset_dir)
+  rng = np.random.default_rng(seed)
+  sites = list(rng.choice(list(index.keys()), size = min(n_sites, len(index)), replace = False))
+
+  def time_it(fun):
+    times = []
+    for i in range(n_reps):
+      t0 = time.perf_counter()
+      n_rows = fun().num_rows
+      times.append(time.perf_counter() - t0)
+    return np.median(times), n_rows
+
+  def full_scan():
+    parts = [os.path.join(dataset_dir, f) for f in sorted(os.listdir(dataset_dir)) if f.startswith("part-")]
+    table = pa.concat_tables([pq.read_table(p) for p in parts])
+    return table.filter(pc.is_in(table["site_id"], value_set = pa.array(sites)))
+
+  indexed_s, indexed_n = time_it(lambda: query_sites(dataset_dir, sites))
+  scan_s, scan_n = time_it(full_scan)
+  return DataFrame({"method": ["site index", "full scan"],
+    "n_sites": len(sites),
+    "median_seconds": [indexed_s, scan_s],
+    "n_rows": [indexed_n, scan_n]})
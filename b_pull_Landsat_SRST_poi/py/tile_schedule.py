@@ -0,0 +1,266 @@
+import heapq
+import math
+import os
+import numpy as np
+from pandas import DataFrame, read_csv
+
+
+# Tiles are submitted one after the other, and start_task holds each task until
+# fewer than max_active tasks are running (see maximum_no_of_tasks). When the
+# heaviest tiles are submitted last, the run ends with a few long tasks and idle
+# slots. In tile_order "cost" mode, tiles are submitted longest-first from an
+# estimate of their cost (location-scene reductions from the preflight plan), which
+# is replaced by their observed task durations once a tile has been run.
+
+# concurrency cap and polling interval of start_task, see gee_functions.py
+max_active_tasks = 10
+task_poll_seconds = 120
+
+# rough EE seconds per site-scene reduction, to put estimates in seconds before
+# any tile has been observed (about 3 hours for 10000 sites and 1000 scenes)
+reduction_seconds = 0.001
+
+# observed durations of earlier runs, see record_tile_durations in preflight.py
+durations_file = "b_pull_Landsat_SRST_poi/out/tile_durations.csv"
+
+
+def tile_costs(tiles, config, plan_file = "b_pull_Landsat_SRST_poi/out/preflight_plan.csv",
+  locations_dir = "b_pull_Landsat_SRST_poi/out/locations/",
+  polygons_dir = "b_pull_Landsat_SRST_poi/out/polygons/"):
+  """Estimate the cost of each tile as its number of location-scene reductions
+  (sites and polygon parts), and the number of export tasks it submits
+
+  Args:
+      tiles: list of WRS2 path-rows as 6-digit strings
+      config: validated config, see pull_config.py
+      plan_file: cost plan written by preflight_plan
+      locations_dir: directory of the partitioned locations, see prep_locations.py
+      polygons_dir: directory of the partitioned polygon parts, see prep_polygons
+
+  Returns:
+      DataFrame with tile, n_sites, n_polygons, n_tasks and cost. Without a
+      preflight plan for all tiles, scene counts are unknown and the cost is the
+      number of location reductions per scene.
+  """
+  tiles = [str(t) for t in tiles]
+  plan = None
+  if config["preflight"] != "False" and os.path.exists(plan_file):
+    plan = read_csv(plan_file, dtype = {"tile": str}).set_index("tile")
+    if not set(tiles) <= set(plan.index) or "n_polygons" not in plan.columns:
+      plan = None
+  if plan is not None:
+    plan = plan.loc[tiles]
+    reductions = plan[[c for c in plan.columns if c.startswith("reductions_")]].sum(axis = 1)
+    return DataFrame({"tile": tiles, "n_sites": plan["n_sites"].values,
+      "n_polygons": plan["n_polygons"].values, "n_tasks": plan["n_tasks"].values,
+      "cost": reductions.values})
+
+  # the same counts as preflight_plan
+  counts = tile_locations(tiles, config, locations_dir, polygons_dir)
+  return DataFrame({"tile": tiles, "n_sites": counts["n_sites"].values,
+    "n_polygons": counts["n_polygons"].values, "n_tasks": counts["n_tasks"].values,
+    "cost": counts["n_reductions"].values})
+
+
+def estimate_tile_seconds(costs, observed = None):
+  """Estimate the run time of each tile. Tiles that have been run keep their
+  observed duration; the others are scaled from their cost by the seconds per
+  unit of cost of the observed tiles (or reduction_seconds without any).
+
+  Args:
+      costs: DataFrame returned by tile_costs
+      observed: dictionary of tile to observed seconds, or None
+
+  Returns:
+      dictionary of tile to estimated seconds
+  """
+  observed = observed or {}
+  cost = dict(zip(costs["tile"], costs["cost"].astype(float)))
+  seen = [t for t in cost if t in observed and cost[t] > 0]
+  rate = sum(observed[t] for t in seen) / sum(cost[t] for t in seen) if seen else reduction_seconds
+  # tiles without sites (e.g. polygons only) still export their metadata
+  floor = min([v for v in cost.values() if v > 0], default = 1) * rate
+  return {t: float(observed[t]) if t in observed else max(c * rate, floor) for t, c in cost.items()}
+
+
+def simulate_makespan(order, seconds, n_tasks, max_active = max_active_tasks,
+  poll_seconds = task_poll_seconds, submit_seconds = 5, task_seconds = None):
+  """Simulate a run on a fake Earth Engine backend: tiles are submitted in
+  order, one task at a time, and a task is only started while fewer than
+  max_active tasks are running; a blocked submitter checks again every
+  poll_seconds, as start_task does. Each tile's run time is split evenly
+  between its tasks.
+
+  Args:
+      order: list of tiles in submission order
+      seconds: dictionary of tile to run time
+      n_tasks: dictionary of tile to number of export tasks
+      max_active: concurrency cap
+      poll_seconds: waiting time of a blocked submitter
+      submit_seconds: time to build and start one task
+      task_seconds: optional function of (tile, task number) to a task's run
+      time, to simulate durations that differ from the estimates
+
+  Returns:
+      time at which the last task finishes
+  """
+  clock = 0.0
+  running = []
+  makespan = 0.0
+  for tile in order:
+    k = max(int(n_tasks[tile]), 1)
+    for i in range(k):
+      while running and running[0] <= clock:
+        heapq.heappop(running)
+      if len(running) >= max_active:
+        clock = clock + math.ceil((running[0] - clock) / poll_seconds) * poll_seconds
+        while running and running[0] <= clock:
+          heapq.heappop(running)
+      clock = clock + submit_seconds
+      run = seconds[tile] / k if task_seconds is None else task_seconds(tile, i)
+      heapq.heappush(running, clock + run)
+      makespan = max(makespan, clock + run)
+  return makespan
+
+
+def _interleave(order, n_tasks, max_active):
+  """Follow each tile of a longest-first order with the lightest remaining
+  tiles until its tasks and theirs fill the concurrency cap"""
+  remaining = list(order)
+  out = []
+  while remaining:
+    tile = remaining.pop(0)
+    out.append(tile)
+    wave = n_tasks[tile]
+    while remaining and wave + n_tasks[remaining[-1]] <= max_active:
+      wave = wave + n_tasks[remaining[-1]]
+      out.append(remaining.pop())
+  return out
+
+
+def schedule_tiles(seconds, n_tasks, max_active = max_active_tasks, poll_seconds = task_poll_seconds):
+  """Order tiles for submission: longest-first (LPT), and longest-first with
+  light tiles interleaved so that tiles with few tasks don't leave slots idle.
+  The order with the shorter simulated makespan is kept.
+
+  Args:
+      seconds: dictionary of tile to estimated run time
+      n_tasks: dictionary of tile to number of export tasks
+      max_active: concurrency cap
+      poll_seconds: waiting time of a blocked submitter
+
+  Returns:
+      list of tiles in submission order
+  """
+  # longest tasks first within equally long tiles, ties by tile
+  lpt = sorted(seconds, key = lambda t: (-seconds[t], -seconds[t] / max(n_tasks[t], 1), t))
+  orders = [lpt, _interleave(lpt, n_tasks, max_active)]
+  makespans = [simulate_makespan(o, seconds, n_tasks, max_active, poll_seconds) for o in orders]
+  return orders[makespans.index(min(makespans))]
+
+
+def _observed_seconds(tiles, file = durations_file):
+  """Observed durations of the tiles in a durations .csv, if any"""
+  if not os.path.exists(file):
+    return {}
+  durations = read_csv(file, dtype = {"tile": str})
+  return {t: s for t, s in zip(durations["tile"], durations["seconds"]) if t in tiles}
+
+
+def order_tiles(tiles, config = None):
+  """Order the tiles of a run for submission
+
+  Args:
+      tiles: list of WRS2 path-rows as 6-digit strings, or a single path-row
+      config: validated config, see pull_config.py; read with read_config() if
+      not provided
+
+  Returns:
+      list of tiles: sorted by path-row with tile_order "tile", the schedule of
+      schedule_tiles with tile_order "cost"
+  """
+  if config is None:
+    config = read_config()
+  # reticulate converts an R vector of length one to a str, not a list
+  if isinstance(tiles, str):
+    tiles = [tiles]
+  tiles = sorted(str(t) for t in tiles)
+  if config["tile_order"] == "tile":
+    return tiles
+  costs = tile_costs(tiles, config)
+  seconds = estimate_tile_seconds(costs, _observed_seconds(tiles))
+  order = schedule_tiles(seconds, dict(zip(costs["tile"], costs["n_tasks"])))
+  print("Scheduled " + str(len(order)) + " tiles, heaviest first: " + ", ".join(order[0:5]))
+  return order
+
+
+def random_tiles(n_tiles = 300, seed = 1):
+  """Simulate the tiles of a run, with a long tail of dense tiles
+
+  Args:
+      n_tiles: number of tiles
+      seed: random seed
+
+  Returns:
+      DataFrame with tile, n_sites, n_polygons, n_tasks and cost, as returned by
+      tile_costs (sites only, one DSWE setting, two sensor groups)
+  """
+  rng = np.random.default_rng(seed)
+  n_sites = np.maximum(rng.lognormal(6, 1.5, n_tiles).astype(int), 1)
+  scenes = rng.integers(300, 1500, n_tiles)
+  return DataFrame({"tile": [str(100000 + i) for i in range(n_tiles)],
+    "n_sites": n_sites,
+    "n_polygons": 0,
+    "n_tasks": [math.ceil(n / 10000) * 2 + 2 for n in n_sites],
+    "cost": n_sites * scenes})
+
+
+def benchmark_tile_schedule(costs = None, observed = None, max_active = max_active_tasks,
+  noise = 0.5, n_reps = 20, seed = 1):
+  """Compare submission orders on the fake backend of simulate_makespan: by
+  path-row (the order without a schedule), longest-first, longest-first with
+  interleaving, and schedule_tiles. The orders are built from the estimated run
+  times, and every repetition draws each task's actual run time from the
+  estimate with lognormal noise.
+
+  Args:
+      costs: DataFrame returned by tile_costs; simulated with random_tiles if
+      not provided
+      observed: dictionary of tile to observed seconds, or None
+      max_active: concurrency cap
+      noise: standard deviation of the log of the actual over estimated run time
+      n_reps: number of repetitions
+      seed: random seed
+
+  Returns:
+      DataFrame with one row per order: the mean makespan in hours, the ratio to
+      the path-row order, and the lower bound of the makespan (the longer of the
+      work spread over all slots and the longest task)
+  """
+  if costs is None:
+    costs = random_tiles(seed = seed)
+  seconds = estimate_tile_seconds(costs, observed)
+  n_tasks = dict(zip(costs["tile"], costs["n_tasks"]))
+  lpt = sorted(seconds, key = lambda t: (-seconds[t], t))
+  orders = {"tile": sorted(seconds),
+    "lpt": lpt,
+    "lpt_interleaved": _interleave(lpt, n_tasks, max_active),
+    "schedule_tiles": schedule_tiles(seconds, n_tasks, max_active)}
+
+  rng = np.random.default_rng(seed)
+  makespans = {name: [] for name in orders}
+  bounds = []
+  for rep in range(n_reps):
+    actual = {t: seconds[t] / max(n_tasks[t], 1) * rng.lognormal(0, noise, max(n_tasks[t], 1))
+      for t in seconds}
+    bounds.append(max(sum(a.sum() for a in actual.values()) / max_active,
+      max(a.max() for a in actual.values())))
+    for name, order in orders.items():
+      makespans[name].append(simulate_makespan(order, seconds, n_tasks, max_active,
+        task_seconds = lambda tile, i: actual[tile][i]))
+
+  result = DataFrame({"order": list(orders),
+    "makespan_h": [np.mean(makespans[n]) / 3600 for n in orders]})
+  result["vs_tile_order"] = result["makespan_h"] / result["makespan_h"].iloc[0]
+  result["lower_bound_h"] = np.mean(bounds) / 3600
+  return result
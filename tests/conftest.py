@@ -0,0 +1,36 @@
+import os
+import pytest
+
+
+# The python modules of the pipeline are loaded with reticulate's source_python,
+# which runs each file in one shared __main__ namespace, so modules use each
+# other's functions and the per-tile globals without importing them. Tests load
+# them the same way: every file is run in the same dictionary of globals.
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+py_dir = os.path.join(repo_dir, "b_pull_Landsat_SRST_poi", "py")
+
+
+def load_modules(*names, **settings):
+  """Run python module files in one namespace, as source_python does
+
+  Args:
+      names: module file names in b_pull_Landsat_SRST_poi/py without .py, in
+      the order they are sourced
+      settings: globals to set before the modules are run (e.g. the per-tile
+      settings of runGEEperTile.py)
+
+  Returns:
+      dictionary of the namespace
+  """
+  namespace = {"__name__": "__main__"}
+  namespace.update(settings)
+  for name in names:
+    path = os.path.join(py_dir, name + ".py")
+    with open(path, "r") as file:
+      exec(compile(file.read(), path, "exec"), namespace)
+  return namespace
+
+
+@pytest.fixture
+def modules():
+  return load_modules
@@ -0,0 +1,48 @@
+import os
+import pytest
+from pandas import DataFrame, Series, read_feather
+
+# exported_files reads the manifests of export_sinks.py, which imports the Earth
+# Engine API; no Earth Engine requests are made
+pytest.importorskip("ee")
+
+
+def test_split_system_index(modules):
+  collate = modules("collate_functions")
+  parts = collate["split_system_index"](Series(["1_2_LC08_044034_20140318_12345",
+    "LT05_044034_19900101", "bad"]))
+  assert list(parts["scene_id"][:2]) == ["LC08_044034_20140318", "LT05_044034_19900101"]
+  assert parts["site_id"][0] == "12345"
+  assert parts["scene_id"].isna()[2]
+
+
+def test_exported_files_and_scene_table(modules, tmp_path):
+  ns = modules("export_sinks", "collate_functions")
+  config = {"export_sink": "local", "export_path": str(tmp_path), "proj_folder": "f",
+    "export_bucket": "", "proj": "LSC2", "config_hash": "abc"}
+  for tile, scenes in [["035032", ["1_LC08_035032_20200101", "2_LC08_035032_20200117"]],
+      ["036032", ["1_LC08_036032_20200101"]]]:
+    df = DataFrame({"system:index": scenes, "CLOUD_COVER": ["1", "2"][:len(scenes)]})
+    partition = {"sensor": "LS89", "tile": tile}
+    description = "LSC2_metadata_LS89_C2_" + tile + "_v2024-01-01"
+    location = ns["write_local_table"](df, description, partition, None, "csv",
+      os.path.join(str(tmp_path), "f"))
+    for d, l in [[description, location], ["LSC2_point_LS89_C2_SRST_DSWE1_" + tile + "_0_v2024-01-01", "x"]]:
+      ns["append_manifest"](dict(partition, description = d, location = l, format = "csv",
+        config_hash = "abc"), ns["manifest_location"](partition, config))
+    # a tile that is run again on a later day exports again, and a run with
+    # other settings is not collated
+    ns["append_manifest"](dict(partition, description = description[:-12] + "_v2024-02-01",
+      location = location, format = "csv", config_hash = "abc"), ns["manifest_location"](partition, config))
+    ns["append_manifest"](dict(partition, description = description, location = "old.csv",
+      format = "csv", config_hash = "def"), ns["manifest_location"](partition, config))
+
+  files = ns["exported_files"]("metadata", ["035032", "036032", "037032"], config)
+  assert len(files) == 2 and all(f.endswith(".csv") for f in files)
+  assert "old.csv" not in files
+  out_file = ns["collate_scene_metadata"](files, str(tmp_path / "scenes.feather"))
+  scenes = read_feather(out_file)
+  assert list(scenes["scene_id"]) == ["LC08_035032_20200101", "LC08_035032_20200117", "LC08_036032_20200101"]
+
+  with pytest.raises(ValueError):
+    ns["exported_files"]("metadata", ["035032"], dict(config, export_sink = "drive"))
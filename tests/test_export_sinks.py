@@ -0,0 +1,57 @@
+import os
+import pytest
+from pandas import DataFrame, read_csv
+
+# export_sinks.py imports the Earth Engine API; no Earth Engine requests are made
+pytest.importorskip("ee")
+
+
+def test_partition_prefix_keeps_order(modules):
+  sinks = modules("export_sinks")
+  assert sinks["partition_prefix"]({"sensor": "LS457", "tile": "035032"}) == "sensor=LS457/tile=035032/"
+  assert sinks["partition_prefix"]({}) == ""
+
+
+def test_write_local_table_partitions_and_selects(modules, tmp_path):
+  sinks = modules("export_sinks")
+  df = DataFrame({"system:index": ["a_1", "a_2"], "med_Blue": [0.1, 0.2],
+    "extra": [1, 2], "geo": [None, None]})
+  out_file = sinks["write_local_table"](df, "LSC2_point_LS457_035032_0",
+    {"sensor": "LS457", "tile": "035032"}, ["system:index", "med_Blue", "med_Red"],
+    "csv", str(tmp_path / "proj"))
+  assert out_file == os.path.join(str(tmp_path / "proj"), "sensor=LS457", "tile=035032",
+    "LSC2_point_LS457_035032_0.csv")
+  written = read_csv(out_file)
+  # selectors set the columns, missing columns are kept empty, geo is dropped
+  assert list(written.columns) == ["system:index", "med_Blue", "med_Red"]
+  assert written["med_Red"].isna().all()
+
+
+def test_write_local_table_parquet(modules, tmp_path):
+  pytest.importorskip("pyarrow")
+  from pandas import read_parquet
+  sinks = modules("export_sinks")
+  df = DataFrame({"system:index": ["a_1"], "med_Blue": [0.1]})
+  out_file = sinks["write_local_table"](df, "d", {"tile": "035032"}, None, "parquet", str(tmp_path))
+  assert out_file.endswith(os.path.join("tile=035032", "d.parquet"))
+  assert read_parquet(out_file).equals(df)
+
+
+def test_manifest_location_per_sink(modules, tmp_path):
+  sinks = modules("export_sinks")
+  config = {"proj_folder": "proj", "export_bucket": "bucket", "export_path": str(tmp_path)}
+  location = lambda sink: sinks["manifest_location"]({"tile": "035032"}, dict(config, export_sink = sink))
+  assert location("local") == os.path.join(str(tmp_path), "proj", "_manifest", "manifest_035032.csv")
+  assert location("gcs") == "gs://bucket/proj/_manifest/manifest_035032.csv"
+  assert location("drive").endswith(os.path.join("export_manifest", "manifest_035032.csv"))
+
+
+def test_append_manifest_writes_header_once(modules, tmp_path):
+  sinks = modules("export_sinks")
+  manifest = str(tmp_path / "proj" / "_manifest" / "manifest_035032.csv")
+  for k in range(3):
+    sinks["append_manifest"]({"sensor": "LS457", "tile": "035032", "description": "d" + str(k),
+      "location": "x"}, manifest)
+  written = read_csv(manifest, dtype = {"tile": str})
+  assert list(written["description"]) == ["d0", "d1", "d2"]
+  assert (written["tile"] == "035032").all()
@@ -0,0 +1,108 @@
+import numpy as np
+import pytest
+from pandas import DataFrame, Series, concat
+
+
+def simulate_shards(ns, n_sites = 200, n_shards = 4, seed = 1):
+  """Pixels of simulated sites, split at random into shards with the sufficient
+  statistics of each shard"""
+  rng = np.random.default_rng(seed)
+  site = np.repeat(np.arange(n_sites), rng.poisson(300, n_sites))
+  shard = rng.integers(0, n_shards, len(site))
+  pixels = {"Blue": rng.gamma(4, 0.01, len(site)),
+    "SurfaceTemp": 285 + rng.normal(0, 3, len(site)) + rng.normal(0, 5, n_sites)[site]}
+  tables = []
+  for k in range(n_shards):
+    in_shard = shard == k
+    one_shard = DataFrame({"site_id": np.arange(n_sites), "shard": k})
+    for band, values in pixels.items():
+      one_shard = one_shard.join(ns["pixel_sufficient_stats"](values[in_shard], site[in_shard], n_sites, band))
+    tables.append(one_shard)
+  return site, pixels, concat(tables, ignore_index = True)
+
+
+def test_merge_shards_matches_single_pass(modules):
+  ns = modules("merge_stats")
+  site, pixels, shards = simulate_shards(ns)
+  merged = ns["merge_shards"](shards, ["site_id"])
+  assert (merged["n_shards"] == 4).all()
+  for band, values in pixels.items():
+    x = Series(values).groupby(site)
+    centered = values - x.transform("mean").to_numpy()
+    m2 = Series(centered ** 2).groupby(site).mean().to_numpy()
+    # the moments are recovered exactly
+    np.testing.assert_array_equal(merged["count_" + band], x.size())
+    np.testing.assert_allclose(merged["mean_" + band], x.mean(), rtol = 1e-10)
+    np.testing.assert_allclose(merged["sd_" + band], np.sqrt(m2), rtol = 1e-8)
+    np.testing.assert_allclose(merged["skew_" + band],
+      Series(centered ** 3).groupby(site).mean() / m2 ** 1.5, rtol = 1e-6, atol = 1e-8)
+    np.testing.assert_allclose(merged["kurt_" + band],
+      Series(centered ** 4).groupby(site).mean() / m2 ** 2 - 3, rtol = 1e-6, atol = 1e-8)
+    # the median is within one histogram bin
+    lo, hi = ns["sketch_ranges"][band]
+    assert np.max(np.abs(merged["med_" + band] - x.median())) <= (hi - lo) / ns["sketch_bins"]
+
+
+def test_merged_rows_merge_again(modules):
+  ns = modules("merge_stats")
+  site, pixels, shards = simulate_shards(ns)
+  once = ns["merge_shards"](shards, ["site_id"])
+  halves = [ns["merge_shards"](shards[shards["shard"] < 2], ["site_id"]),
+    ns["merge_shards"](shards[shards["shard"] >= 2], ["site_id"])]
+  twice = ns["merge_shards"](concat(halves, ignore_index = True).drop(columns = "n_shards"), ["site_id"])
+  for column in ["count_Blue", "hist_Blue"]:
+    assert list(twice[column]) == list(once[column])
+  np.testing.assert_allclose(twice["sum4_SurfaceTemp"], once["sum4_SurfaceTemp"], rtol = 1e-12)
+  np.testing.assert_allclose(twice["kurt_SurfaceTemp"], once["kurt_SurfaceTemp"], rtol = 1e-10)
+
+
+def test_merge_shards_minimums_and_empty_groups(modules):
+  ns = modules("merge_stats")
+  shards = DataFrame({"site_id": ["a", "a", "b"], "count_Blue": [2, 0, 0],
+    "sum_Blue": [0.3, 0.0, 0.0], "sumsq_Blue": [0.05, 0.0, 0.0],
+    "min_cloud_dist": [150.0, 90.0, np.nan]})
+  merged = ns["merge_shards"](shards, ["site_id"]).set_index("site_id")
+  assert merged.loc["a", "min_cloud_dist"] == 90.0
+  assert merged.loc["a", "mean_Blue"] == pytest.approx(0.15)
+  assert merged.loc["a", "sd_Blue"] == pytest.approx(0.05)
+  assert np.isnan(merged.loc["b", "mean_Blue"]) and np.isnan(merged.loc["b", "min_cloud_dist"])
+
+
+def test_moments_to_stats_with_shift(modules):
+  ns = modules("merge_stats")
+  values = np.array([280.0, 285.0, 287.5, 300.0])
+  x = values - 273.15
+  stats = ns["moments_to_stats"]([len(x)], *[np.array([(x ** k).sum()]) for k in range(1, 5)], shift = 273.15)
+  assert stats["mean"][0] == pytest.approx(values.mean())
+  assert stats["sd"][0] == pytest.approx(values.std())
+  centered = values - values.mean()
+  assert stats["skew"][0] == pytest.approx((centered ** 3).mean() / values.var() ** 1.5)
+  assert stats["kurt"][0] == pytest.approx((centered ** 4).mean() / values.var() ** 2 - 3)
+  empty = ns["moments_to_stats"]([0], np.array([0.0]), np.array([0.0]))
+  assert np.isnan(empty["mean"][0]) and np.isnan(empty["sd"][0])
+
+
+def test_sketch_quantile(modules):
+  ns = modules("merge_stats")
+  bins = ns["sketch_bins"]
+  lo, hi = ns["sketch_ranges"]["Blue"]
+  width = (hi - lo) / bins
+  counts = np.zeros((3, bins), dtype = np.int64)
+  # all pixels in one bin: the median is the middle of the bin
+  counts[0, 10] = 4
+  # half of the pixels in each of two bins: the median is the edge between them
+  counts[1, [20, 21]] = 5
+  # the third row is empty
+  med = ns["sketch_quantile"](counts, "Blue")
+  assert med[0] == pytest.approx(lo + 10.5 * width)
+  assert med[1] == pytest.approx(lo + 21 * width)
+  assert np.isnan(med[2])
+  assert ns["sketch_quantile"](counts[:1], "Blue", q = 0.25)[0] == pytest.approx(lo + 10.25 * width)
+
+
+def test_sketches_round_trip(modules):
+  ns = modules("merge_stats")
+  counts = np.arange(2 * ns["sketch_bins"]).reshape(2, -1)
+  parsed = ns["parse_sketches"](Series(ns["format_sketches"](counts) + [None]))
+  np.testing.assert_array_equal(parsed[:2], counts)
+  assert parsed[2].sum() == 0
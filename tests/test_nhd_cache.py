@@ -0,0 +1,66 @@
+import os
+import pytest
+
+# nhd_cache.py imports the spatial packages; no NHDPlusHR is downloaded
+pytest.importorskip("pyogrio")
+pytest.importorskip("shapely")
+pytest.importorskip("pyproj")
+pytest.importorskip("pyarrow")
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def nhd_cache():
+  """Run nhd_cache.py in its own namespace, as source_python does"""
+  path = os.path.join(repo_dir, "a_Calculate_Centers", "py", "nhd_cache.py")
+  namespace = {"__name__": "__main__"}
+  with open(path, "r") as file:
+    exec(compile(file.read(), path, "exec"), namespace)
+  return namespace
+
+
+def write_entries(cache_dir, entries):
+  """Write cache files of the given sizes, last used in the order given"""
+  paths = []
+  for i, (sub, name, size) in enumerate(entries):
+    os.makedirs(os.path.join(cache_dir, sub), exist_ok = True)
+    path = os.path.join(cache_dir, sub, name)
+    with open(path, "wb") as file:
+      file.write(b"0" * size)
+    os.utime(path, (1000 + i, 1000 + i))
+    paths.append(path)
+  return paths
+
+
+def test_evict_cache_removes_least_recently_used(nhd_cache, tmp_path):
+  cache_dir = str(tmp_path)
+  old_zip, old_layer, new_zip, new_layer = write_entries(cache_dir, [["archives", "a.zip", 100],
+    ["waterbodies", "a.parquet", 10], ["archives", "b.zip", 100], ["waterbodies", "b.parquet", 10]])
+  # files being written are not counted or removed
+  write_entries(cache_dir, [["archives", "c.zip.tmp", 1000]])
+  assert nhd_cache["evict_cache"](cache_dir, max_bytes = 220) == []
+  assert nhd_cache["evict_cache"](cache_dir, max_bytes = 110) == [old_zip, old_layer]
+  assert os.path.exists(new_zip) and os.path.exists(new_layer)
+
+
+def test_evict_cache_keeps_files(nhd_cache, tmp_path):
+  cache_dir = str(tmp_path)
+  old_zip, old_layer, new_zip = write_entries(cache_dir, [["archives", "a.zip", 100],
+    ["waterbodies", "a.parquet", 10], ["archives", "b.zip", 100]])
+  # the oldest file is kept, so the next ones are removed instead
+  assert nhd_cache["evict_cache"](cache_dir, max_bytes = 100, keep = [old_zip]) == [old_layer, new_zip]
+  assert os.path.exists(old_zip)
+
+
+def test_waterbody_key_changes_with_its_parameters(nhd_cache):
+  key = nhd_cache["waterbody_key"]
+  base = key("abc", (390, 436, 361), 0.01)
+  # the order and type of the ftypes and area don't matter
+  assert key("abc", ["361", 390, 436], 0.01) == base
+  assert key("abc", (390, 436, 361), "0.01") == base
+  assert key("abd", (390, 436, 361), 0.01) != base
+  assert key("abc", (390, 436), 0.01) != base
+  assert key("abc", (390, 436, 361), 0.1) != base
+  nhd_cache["layer_version"] += 1
+  assert key("abc", (390, 436, 361), 0.01) != base
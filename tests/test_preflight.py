@@ -0,0 +1,45 @@
+import os
+import pytest
+from pandas import DataFrame
+
+# preflight.py and sensor_catalog.py import the Earth Engine API and
+# prep_locations.py the spatial packages; no Earth Engine requests are made
+pytest.importorskip("ee")
+pytest.importorskip("pyogrio")
+pytest.importorskip("shapely")
+pytest.importorskip("pyproj")
+
+
+def write_tiles(out_dir, counts):
+  """Write the _tiles.csv of a dataset written by prep_locations/prep_polygons"""
+  os.makedirs(out_dir)
+  DataFrame({"WRS2_PR": list(counts), "n_locations": list(counts.values())}).to_csv(
+    os.path.join(out_dir, "_tiles.csv"), index = False)
+  return out_dir
+
+
+def test_tile_locations_counts_polygon_parts(modules, tmp_path):
+  ns = modules("gee_functions", "qa_decode", "sensor_catalog", "preflight", "prep_locations", "tile_schedule")
+  locations = write_tiles(str(tmp_path / "locations"), {"035032": 25000})
+  polygons = write_tiles(str(tmp_path / "polygons"), {"035032": 10, "036032": 2500})
+  config = {"extent": frozenset({"site", "polygon", "polycenter"}), "DSWE_setting": frozenset({"1", "3"}),
+    "harmonize_sensors": True, "sensors": ["LANDSAT_8"], "preflight": "False"}
+  counts = ns["tile_locations"](["035032", "036032"], config, locations, polygons).set_index("tile")
+  # 3 site groups and 1 polygon group, twice for polygon and polycenter, per
+  # DSWE setting, and one metadata export
+  assert counts.loc["035032", "n_tasks"] == (3 + 2) * 2 + 1
+  # a tile with only polygons is still planned
+  assert counts.loc["036032", "n_sites"] == 0
+  assert counts.loc["036032", "n_tasks"] == 3 * 2 * 2 + 1
+  assert counts.loc["036032", "n_reductions"] == 5000
+
+  # without a preflight plan, tile_costs uses the same counts
+  costs = ns["tile_costs"](["036032", "035032"], config, str(tmp_path / "none.csv"), locations, polygons)
+  assert list(costs["n_polygons"]) == [2500, 10]
+  assert list(costs["cost"]) == [5000, 25020]
+
+  # polygon parts are not counted if the extent has no polygons
+  counts = ns["tile_locations"](["035032", "036032"], dict(config, extent = frozenset({"site"})),
+    locations, polygons)
+  assert list(counts["n_polygons"]) == [0, 0]
+  assert list(counts["n_tasks"]) == [3 * 2 + 1, 1]
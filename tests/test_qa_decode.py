@@ -0,0 +1,34 @@
+import numpy as np
+
+
+def test_packed_decoder_matches_per_mask_decoding(modules):
+  ns = modules("qa_decode")
+  pixel_qa, radsat_qa, cloud_qa = ns["random_qa"](200000)
+  clear, clouds = ns["_decode_qa_per_mask"](pixel_qa, radsat_qa, cloud_qa)
+  flags, packed_clear, packed_clouds = ns["decode_qa_numpy"](pixel_qa, radsat_qa, cloud_qa)
+  assert flags.dtype == np.uint8
+  np.testing.assert_array_equal(packed_clear, clear)
+  np.testing.assert_array_equal(packed_clouds, clouds)
+  # the simulated bands cover clear, cloudy and masked but not cloudy pixels
+  assert clear.any() and clouds.any() and (~clear & ~clouds).any()
+
+
+def test_qa_flag_bits(modules):
+  ns = modules("qa_decode")
+  # dilated cloud, cloud, shadow and snow of QA_PIXEL are bits 0-3; the clear
+  # bit 6 and water bit 7 of QA_PIXEL are not flags
+  pixel_qa = np.array([1 << 1, 1 << 3, 1 << 4, 1 << 5, (1 << 6) | (1 << 7), 0, 0, 0])
+  radsat_qa = np.array([0, 0, 0, 0, 0, 4, 0, 0])
+  cloud_qa = np.array([0, 0, 0, 0, 0, 0, 1 << 2, 1 << 5])
+  aerosol_qa = np.array([0, 0, 0, 0, 0, 0, 0, 1 << 7])
+  flags, clear, clouds = ns["decode_qa_numpy"](pixel_qa, radsat_qa, cloud_qa, aerosol_qa)
+  assert list(flags) == [1, 2, 4, 8, 0, 16, 32, 64]
+  # medium or high aerosol (bit 6) and the SR_CLOUD_QA water bit 5 don't mask
+  assert list(clear) == [False] * 4 + [True, False, False, True]
+  assert list(clouds) == [True] * 4 + [False] * 4
+
+
+def test_decode_without_optional_bands(modules):
+  ns = modules("qa_decode")
+  flags, clear, clouds = ns["decode_qa_numpy"]([0, 1 << 3], [0, 0])
+  assert list(flags) == [0, 2] and list(clear) == [True, False]
@@ -0,0 +1,51 @@
+import json
+import os
+import numpy as np
+import pytest
+from conftest import py_dir
+
+# scene_windows.py imports the Earth Engine API and pyproj; no Earth Engine
+# requests are made
+pytest.importorskip("ee")
+pytest.importorskip("pyproj")
+
+
+def write_windows(window_dir, bands, n_sites = 20, radius_px = 3, scenes = ("LC08_035032_20200101",
+    "LC08_035032_20200117")):
+  """Write a window cache as cache_scene_windows does, with open water pixels"""
+  rng = np.random.default_rng(1)
+  width = 2 * radius_px + 1
+  os.makedirs(window_dir)
+  index = {"tile": "035032", "radius_px": radius_px, "scale": 30, "bands": bands,
+    "location_crs": "EPSG:4326", "sites": [str(i) for i in range(n_sites)], "scenes": {}}
+  for scene_id in scenes:
+    windows = np.zeros((n_sites, len(bands), width, width), dtype = np.float32)
+    windows[:, bands.index("Blue")] = rng.uniform(0.02, 0.06, (n_sites, width, width))
+    windows[:, bands.index("Green")] = rng.uniform(0.04, 0.08, (n_sites, width, width))
+    windows[:, bands.index("Red")] = 0.03
+    windows[:, bands.index("Nir")] = 0.01
+    windows[:, bands.index("Swir1")] = 0.005
+    windows[:, bands.index("Swir2")] = 0.004
+    windows[:, bands.index("SurfaceTemp")] = rng.normal(290, 2, (n_sites, width, width))
+    windows[:, bands.index("hillShadow")] = 1
+    # a cloudy corner in every window
+    windows[:, bands.index("pixel_qa"), 0, 0] = 1 << 3
+    np.save(os.path.join(window_dir, scene_id + ".npy"), windows)
+    index["scenes"][scene_id] = {"offsets": np.zeros((n_sites, 2)).tolist()}
+  with open(os.path.join(window_dir, "windows.json"), "w") as file:
+    json.dump(index, file)
+  return window_dir
+
+
+def test_replay_windows_in_spawned_processes(modules, tmp_path):
+  ns = modules("gee_functions", "qa_decode", "scene_windows")
+  ns["replay_module_dir"] = py_dir
+  window_dir = write_windows(str(tmp_path / "windows"), ns["window_bands"])
+  config = {"DSWE_setting": frozenset({"1"}), "site_buffer": 90, "min_valid_pixels": 0}
+  local = ns["replay_windows"](window_dir, config = config, n_workers = 1)
+  spawned = ns["replay_windows"](window_dir, config = config, n_workers = 2)
+  assert len(local) == 40 and (local["pCount_dswe1"] > 0).all()
+  assert local.equals(spawned)
+  # a larger buffer than the cached windows can't be replayed
+  with pytest.raises(ValueError):
+    ns["replay_windows"](window_dir, site_buffer = 200, config = config, n_workers = 1)
@@ -0,0 +1,52 @@
+import ast
+import os
+import re
+import pytest
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# The targets file sources its python modules into one namespace (see
+# conftest.py), so a top-level name defined in two modules is silently replaced
+# by the module that is sourced last. Scripts that are run per tile or target
+# (runGEEperTile.py, ...) redefine their settings on purpose and are not checked.
+def sourced_modules(targets_file = "b_pull_Landsat_SRST_poi.R"):
+  with open(os.path.join(repo_dir, targets_file), "r") as file:
+    return re.findall(r'^source_python\("([^"]+)"\)', file.read(), re.MULTILINE)
+
+
+def top_level_names(module):
+  with open(os.path.join(repo_dir, module), "r") as file:
+    tree = ast.parse(file.read())
+  names = set()
+  for node in tree.body:
+    if isinstance(node, (ast.FunctionDef, ast.ClassDef)):
+      names.add(node.name)
+    elif isinstance(node, ast.Assign):
+      names.update(t.id for t in node.targets if isinstance(t, ast.Name))
+  return names
+
+
+def test_sourced_modules_do_not_redefine_names():
+  modules = sourced_modules()
+  assert "b_pull_Landsat_SRST_poi/py/pull_config.py" in modules
+  defined = {}
+  clashes = []
+  for module in modules:
+    for name in top_level_names(module):
+      if name in defined:
+        clashes.append(name + " in " + defined[name] + " and " + module)
+      defined[name] = module
+  assert clashes == []
+
+
+def test_parse_config_after_sourcing(modules):
+  pytest.importorskip("ee")
+  pytest.importorskip("yaml")
+  pytest.importorskip("pyarrow")
+  # the modules up to site_query.py, in the order of the targets file
+  names = [os.path.basename(m)[:-3] for m in sourced_modules()]
+  ns = modules(*names[:names.index("site_query") + 1])
+  config = ns["parse_config"](os.path.join(repo_dir, "b_pull_Landsat_SRST_poi/config_files/config_poi.yml"))
+  assert config["start_date"] < config["end_date"]
+  assert ns["_query_date"]("2020-01-02") == config["start_date"].__class__(2020, 1, 2)
@@ -0,0 +1,69 @@
+import pytest
+from pandas import DataFrame
+
+pytest.importorskip("pyarrow")
+
+
+def write_exports(tmp_path, values, sensor = "LS89", dswe = "DSWE1"):
+  """Write one site export with a row per site and scene date, named as 
+  runGEEperTile.py names them"""
+  rows = [["1_LC08_035032_" + d + "_" + site, v] for site, d, v in values]
+  out_file = str(tmp_path / ("LSC2_point_" + sensor + "_C2_SRST_" + dswe + "_035032_0_v2024-01-01.csv"))
+  DataFrame(rows, columns = ["system:index", "med_Blue"]).to_csv(out_file, index = False)
+  return out_file
+
+
+def test_query_sites_by_index(modules, tmp_path):
+  ns = modules("collate_functions", "site_query")
+  export = write_exports(tmp_path, [["a", "20200101", 1.0], ["b", "20200101", 2.0],
+    ["a", "20200117", 3.0], ["c", "20200202", 4.0]])
+  dataset = ns["build_site_dataset"]([export], str(tmp_path / "dataset"), n_partitions = 4,
+    row_group_size = 1)
+  out = ns["query_sites"](dataset, ["a", "c", "missing"]).to_pandas()
+  assert sorted(zip(out["site_id"], out["med_Blue"])) == [("a", 1.0), ("a", 3.0), ("c", 4.0)]
+  out = ns["query_sites"](dataset, ["a"], start_date = "2020-01-10").to_pandas()
+  assert list(out["med_Blue"]) == [3.0]
+
+
+def test_rebuild_is_not_served_from_cache(modules, tmp_path):
+  ns = modules("collate_functions", "site_query")
+  dataset = str(tmp_path / "dataset")
+  ns["build_site_dataset"]([write_exports(tmp_path, [["a", "20200101", 1.0]])], dataset, n_partitions = 2)
+  assert list(ns["query_sites"](dataset, ["a"]).to_pandas()["med_Blue"]) == [1.0]
+  ns["build_site_dataset"]([write_exports(tmp_path, [["a", "20200101", 5.0], ["a", "20200117", 6.0]])],
+    dataset, n_partitions = 2)
+  assert list(ns["query_sites"](dataset, ["a"]).to_pandas()["med_Blue"]) == [5.0, 6.0]
+
+
+def test_buffer_sweep_rows_are_kept_apart(modules, tmp_path):
+  ns = modules("collate_functions", "site_query")
+  # rows of a buffer_sweep have the same system:index and differ by buffer_m
+  export = str(tmp_path / "LSC2_point_LS89_C2_SRST_DSWE1_035032_0_v2024-01-01.csv")
+  DataFrame({"system:index": ["1_LC08_035032_20200117_a", "1_LC08_035032_20200101_a",
+      "1_LC08_035032_20200117_a", "1_LC08_035032_20200101_a"],
+    "buffer_m": [200, 200, 60, 60],
+    "med_Blue": [4.0, 3.0, 2.0, 1.0]}).to_csv(export, index = False)
+  dataset = ns["build_site_dataset"]([export], str(tmp_path / "dataset"), n_partitions = 2)
+  out = ns["query_sites"](dataset, ["a"]).to_pandas()
+  assert list(out["buffer_m"]) == [60, 60, 200, 200]
+  assert list(out["med_Blue"]) == [1.0, 2.0, 3.0, 4.0]
+
+
+def test_sensors_and_dswe_settings_are_kept_apart(modules, tmp_path):
+  ns = modules("collate_functions", "site_query")
+  # the same scenes of a site in the DSWE1 and DSWE3 exports of two stacks
+  exports = [write_exports(tmp_path, [["a", "20200117", v], ["a", "20200101", v - 1]], sensor, dswe)
+    for sensor, dswe, v in [["LS89", "DSWE3", 4.0], ["LS89", "DSWE1", 2.0], ["LS457", "DSWE1", 6.0]]]
+  dataset = ns["build_site_dataset"](exports, str(tmp_path / "dataset"), n_partitions = 2,
+    row_group_size = 2)
+  out = ns["query_sites"](dataset, ["a"]).to_pandas()
+  assert list(zip(out["sensor"], out["DSWE"], out["med_Blue"])) == [("LS457", "DSWE1", 5.0),
+    ("LS457", "DSWE1", 6.0), ("LS89", "DSWE1", 1.0), ("LS89", "DSWE1", 2.0), ("LS89", "DSWE3", 3.0),
+    ("LS89", "DSWE3", 4.0)]
+  out = ns["query_sites"](dataset, ["a"], dswe = ["DSWE3"], columns = ["med_Blue"]).to_pandas()
+  assert list(out["med_Blue"]) == [3.0, 4.0] and set(out["DSWE"]) == {"DSWE3"}
+  out = ns["query_sites"](dataset, ["a"], sensors = ["LS89"], dswe = ["DSWE1"]).to_pandas()
+  assert list(out["med_Blue"]) == [1.0, 2.0]
+
+  with pytest.raises(ValueError):
+    ns["build_site_dataset"]([str(tmp_path / "renamed.csv")], str(tmp_path / "other"))
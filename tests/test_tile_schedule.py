@@ -0,0 +1,57 @@
+import pytest
+from pandas import DataFrame
+
+
+def test_simulate_makespan_respects_the_cap(modules):
+  ns = modules("tile_schedule")
+  seconds = {"a": 1000.0, "b": 1000.0, "c": 1000.0}
+  n_tasks = {"a": 1, "b": 1, "c": 1}
+  # all tasks run at once below the cap
+  assert ns["simulate_makespan"](["a", "b", "c"], seconds, n_tasks, max_active = 3,
+    submit_seconds = 0) == 1000
+  # with two slots the third task waits for a slot, checking every 120 s
+  assert ns["simulate_makespan"](["a", "b", "c"], seconds, n_tasks, max_active = 2,
+    poll_seconds = 120, submit_seconds = 0) == 1080 + 1000
+  # a tile's time is split between its tasks
+  assert ns["simulate_makespan"](["a"], {"a": 1000.0}, {"a": 4}, max_active = 4,
+    submit_seconds = 10) == pytest.approx(40 + 250)
+
+
+def test_longest_first_beats_tile_order(modules):
+  ns = modules("tile_schedule")
+  # the heaviest tile is last in path-row order
+  seconds = {"035032": 100.0, "035033": 100.0, "035034": 100.0, "035035": 100.0, "036032": 1000.0}
+  n_tasks = {t: 1 for t in seconds}
+  order = ns["schedule_tiles"](seconds, n_tasks, max_active = 2, poll_seconds = 10)
+  assert order[0] == "036032"
+  makespan = lambda o: ns["simulate_makespan"](o, seconds, n_tasks, max_active = 2, poll_seconds = 10)
+  assert makespan(order) < makespan(sorted(seconds))
+  assert makespan(order) == pytest.approx(1005)
+
+
+def test_schedule_tiles_is_a_permutation(modules):
+  ns = modules("tile_schedule")
+  costs = ns["random_tiles"](n_tiles = 60, seed = 3)
+  seconds = ns["estimate_tile_seconds"](costs)
+  n_tasks = dict(zip(costs["tile"], costs["n_tasks"]))
+  order = ns["schedule_tiles"](seconds, n_tasks)
+  assert sorted(order) == sorted(costs["tile"])
+  makespan = lambda o: ns["simulate_makespan"](o, seconds, n_tasks)
+  assert makespan(order) <= makespan(sorted(seconds))
+
+
+def test_estimate_tile_seconds_scales_from_observed(modules):
+  ns = modules("tile_schedule")
+  costs = DataFrame({"tile": ["a", "b", "c"], "cost": [100, 300, 0]})
+  seconds = ns["estimate_tile_seconds"](costs, {"a": 50.0})
+  assert seconds["a"] == 50.0
+  assert seconds["b"] == pytest.approx(150.0)
+  # tiles without locations still get the time of the lightest tile
+  assert seconds["c"] == pytest.approx(50.0)
+  assert ns["estimate_tile_seconds"](costs)["b"] == pytest.approx(300 * ns["reduction_seconds"])
+
+
+def test_order_tiles_takes_a_single_tile(modules):
+  ns = modules("tile_schedule")
+  assert ns["order_tiles"]("035032", {"tile_order": "tile"}) == ["035032"]
+  assert ns["order_tiles"](["036032", "035032"], {"tile_order": "tile"}) == ["035032", "036032"]